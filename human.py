@@ -5,582 +5,4127 @@
 
 # Modified by Nicholas Anthony, 2021
 
+import abc
+import bisect
+import collections
+import contextlib
+import hashlib
+import heapq
+import importlib
+import itertools
+import json
 import random
 import re
 import logging
+import math
+import mmap
+import struct
+import tempfile
 import threading
-from datetime import time
+import time
+from ctypes import (
+    Structure, Union, byref, c_long, c_size_t, c_ulong, c_ushort, c_wchar,
+    memmove, sizeof
+)
+
+import subprocess, random, os, sys
+
+try:
+    from lib.common.abstracts import Auxiliary
+    from lib.common.results import upload_to_host
+    from lib.common.defines import (
+        KERNEL32, USER32, WM_GETTEXT, WM_GETTEXTLENGTH, WM_CLOSE, BM_CLICK,
+        EnumWindowsProc, EnumChildProc, create_unicode_buffer
+    )
+except (ImportError, NameError):
+    # Not running inside the Windows analyzer, e.g., when running the
+    # benchmarks on Linux. Only the fake backends work there. On Windows a
+    # broken analyzer must not go unnoticed.
+    if sys.platform == "win32":
+        raise
+
+    from ctypes import create_unicode_buffer
+    KERNEL32 = USER32 = EnumWindowsProc = EnumChildProc = None
+    WM_GETTEXT, WM_GETTEXTLENGTH, WM_CLOSE, BM_CLICK = 0x0D, 0x0E, 0x10, 0xF5
+    upload_to_host = None
+
+    class Auxiliary(object):
+        def __init__(self, options={}, analyzer=None):
+            self.options = options
+            self.analyzer = analyzer
+
+# Cuckoo stuff
+log = logging.getLogger(__name__)
+
+
+class Resolution(dict):
+    """The screen resolution, only queried the first time it is used."""
+
+    def __missing__(self, axis):
+        self["x"] = USER32.GetSystemMetrics(0)
+        self["y"] = USER32.GetSystemMetrics(1)
+        return self[axis]
+
+
+# Cuckoo stuff
+RESOLUTION = Resolution()
+
+
+class LazyModule(object):
+    """Stands in for a module until one of its attributes is used, so the
+    heavy dependencies are only imported once an interaction needs them."""
+
+    def __init__(self, name):
+        self.name = name
+        self.module = None
+        self.missing = False
+
+    def __getattr__(self, attr):
+        # Only called for attributes the proxy itself does not have.
+        return getattr(self.load(), attr)
+
+    def load(self):
+        if self.module is None:
+            with METRICS.timer("import.%s" % self.name):
+                self.module = importlib.import_module(self.name)
+        return self.module
+
+    def available(self):
+        # Whether the module can be imported. A missing module is only
+        # looked for once.
+        if self.module is None and not self.missing:
+            try:
+                self.load()
+            except ImportError:
+                log.warning("Unable to import %s.", self.name)
+                self.missing = True
+        return self.module is not None
+
+
+pywinauto = LazyModule("pywinauto")
+application = LazyModule("pywinauto.application")
+mouse = LazyModule("pywinauto.mouse")
+pyautogui = LazyModule("pyautogui")
+numpy = LazyModule("numpy")
+
+# What importing this module used to pull in, see benchmark_import()
+# in human_bench.py.
+HEAVY_MODULES = "pywinauto.application", "pywinauto", "pyautogui"
+
+# Where the metrics summary is uploaded to.
+METRICS_PATH = "logs/human.json"
+
+
+class Metrics(object):
+    """Wall and CPU time per interaction and step, latency histograms for
+    the background tasks and counters, summarized as JSON when the
+    auxiliary finishes. Steps are recorded under the interaction that is
+    running on the current thread, e.g., "notepad.type"."""
+
+    # Upper bounds of the histogram buckets, in milliseconds.
+    BUCKETS = 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 5000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.timings = {}
+        self.histograms = {}
+        self.counters = collections.Counter()
+
+    def record(self, name, wall, cpu):
+        with self.lock:
+            timing = self.timings.setdefault(name, {
+                "count": 0, "wall": 0.0, "cpu": 0.0, "max_wall": 0.0,
+            })
+            timing["count"] += 1
+            timing["wall"] += wall
+            timing["cpu"] += cpu
+            timing["max_wall"] = max(timing["max_wall"], wall)
+
+    @contextlib.contextmanager
+    def timer(self, name):
+        wall, cpu = time.time(), thread_cpu_time()
+        try:
+            yield
+        finally:
+            self.record(name, time.time() - wall, thread_cpu_time() - cpu)
+
+    @contextlib.contextmanager
+    def interaction(self, name):
+        self.local.interaction = name
+        try:
+            with self.timer("interaction.%s" % name):
+                yield
+        finally:
+            self.local.interaction = None
+
+    def step(self, step):
+        interaction = getattr(self.local, "interaction", None)
+        return self.timer("%s.%s" % (interaction, step) if interaction else step)
+
+    def observe(self, name, seconds):
+        idx = bisect.bisect_left(self.BUCKETS, seconds * 1000)
+        with self.lock:
+            counts = self.histograms.setdefault(name, [0] * (len(self.BUCKETS) + 1))
+            counts[idx] += 1
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def summary(self):
+        # Everything is copied under its own lock, as the other threads
+        # keep recording while the summary is serialized.
+        with self.lock:
+            timings = dict(
+                (name, dict(timing)) for name, timing in self.timings.items()
+            )
+            histograms = dict(
+                (name, list(counts)) for name, counts in self.histograms.items()
+            )
+            counters = dict(self.counters)
+
+        return {
+            "timings": timings,
+            "histograms": {
+                "buckets_ms": list(self.BUCKETS),
+                "counts": histograms,
+            },
+            "counters": counters,
+            "waits": WAITS.report(),
+            "locator": LOCATOR_STATS.report(),
+            "governor": GOVERNOR.report(),
+            "visual": dict(VISUAL.stats),
+            "clicks": CLICK_QUEUE.report(),
+            "pool": APP_POOL.report(),
+            "trace": TRACE.report(),
+            "scenarios": dict(SCENARIOS.stats),
+            "steps": STEP_STATS.report(),
+        }
+
+
+# Where the batches of the action trace are uploaded to, numbered in order.
+TRACE_PATH = "logs/human_trace_%04d.jsonl"
+
+
+class ActionTrace(object):
+    """What the auxiliary did to the desktop, and when: the action, the
+    window it went to, screen coordinates and how much text was typed.
+    Recording only appends a tuple to a ring buffer of "capacity" entries;
+    the buffer is handed to an uploader thread as one batch every
+    "interval" seconds and when the auxiliary stops, so the thread that
+    sends input never waits on the host. Entries that did not fit between
+    two flushes are dropped, oldest first, and counted."""
+
+    FIELDS = "time", "action", "hwnd", "title", "x", "y", "length"
+
+    def __init__(self, capacity=4096, interval=30.0, upload=None):
+        self.capacity = capacity
+        self.interval = interval
+        self.upload = upload
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.cond = threading.Condition()
+        self.batches = collections.deque()
+        self.uploading = False
+        self.stopped = False
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.buffer = collections.deque(maxlen=self.capacity)
+            self.stats = {"recorded": 0, "dropped": 0, "flushed": 0, "batches": 0}
+
+    def record(self, action, hwnd=None, title=None, x=None, y=None, length=None):
+        if not self.enabled:
+            return
+
+        entry = BACKEND.time(), action, hwnd, title, x, y, length
+        with self.lock:
+            if len(self.buffer) == self.capacity:
+                self.stats["dropped"] += 1
+            self.buffer.append(entry)
+            self.stats["recorded"] += 1
+
+    def flush(self):
+        # Queues everything recorded since the last flush as one batch.
+        with self.lock:
+            entries = list(self.buffer)
+            self.buffer.clear()
+            batch = self.stats["batches"]
+            self.stats["batches"] += bool(entries)
+        if not entries or (self.upload or upload_to_host) is None:
+            return 0
+
+        with self.cond:
+            self.batches.append((batch, entries))
+            if self.thread is None:
+                self.stopped = False
+                self.thread = threading.Thread(target=self.run)
+                self.thread.daemon = True
+                self.thread.start()
+            self.cond.notify_all()
+        return len(entries)
+
+    def stop(self, timeout=10):
+        # Gives the queued batches up to "timeout" seconds to be uploaded.
+        deadline = time.time() + timeout
+        with self.cond:
+            while self.batches or self.uploading:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    log.warning("Dropped %d batches of the action trace.", len(self.batches))
+                    self.batches.clear()
+                    break
+                self.cond.wait(remaining)
+            self.stopped = True
+            self.cond.notify_all()
+            thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join(max(deadline - time.time(), 0))
+
+    def run(self):
+        with GOVERNOR.metered():
+            while True:
+                with self.cond:
+                    while not self.batches and not self.stopped:
+                        self.cond.wait()
+                    if not self.batches:
+                        return
+                    batch, entries = self.batches.popleft()
+                    self.uploading = True
+                try:
+                    self.send(batch, entries)
+                finally:
+                    with self.cond:
+                        self.uploading = False
+                        self.cond.notify_all()
+
+    def send(self, batch, entries):
+        upload = self.upload or upload_to_host
+        fd, path = tempfile.mkstemp(suffix=".jsonl")
+        try:
+            with os.fdopen(fd, "w") as f:
+                for entry in entries:
+                    f.write(json.dumps(dict(
+                        (field, value) for field, value in zip(self.FIELDS, entry)
+                        if value is not None
+                    )))
+                    f.write("\n")
+            upload(path, TRACE_PATH % batch)
+        except Exception:
+            log.exception("Error uploading the action trace")
+            return
+        finally:
+            os.remove(path)
+
+        with self.lock:
+            self.stats["flushed"] += len(entries)
+
+    def report(self):
+        with self.lock:
+            report = dict(self.stats)
+            report["buffered"] = len(self.buffer)
+        with self.cond:
+            report["queued"] = len(self.batches)
+        return report
+
+
+TRACE = ActionTrace()
+
+
+# Access right needed to read the times of another thread.
+THREAD_QUERY_INFORMATION = 0x0040
+
+
+def thread_cpu_time(ident=None):
+    # User and kernel time of a thread of this process, by default the
+    # current one, in seconds. None if the thread is gone.
+    current = ident is None or ident == threading.current_thread().ident
+    if KERNEL32 is None:
+        # Only the process as a whole can be measured here.
+        return time.clock() if current else None
+
+    from ctypes import c_ulonglong
+    creation, exit, kernel, user = (c_ulonglong() for _ in range(4))
+    if current:
+        handle = KERNEL32.GetCurrentThread()
+    else:
+        # Thread identifiers are the Windows thread ids.
+        handle = KERNEL32.OpenThread(THREAD_QUERY_INFORMATION, False, ident)
+        if not handle:
+            return None
+
+    try:
+        ok = KERNEL32.GetThreadTimes(
+            handle, byref(creation), byref(exit), byref(kernel), byref(user)
+        )
+    finally:
+        if not current:
+            KERNEL32.CloseHandle(handle)
+    if not ok and not current:
+        return None
+    return (kernel.value + user.value) / 1e7
+
+
+METRICS = Metrics()
+
+
+class InputLock(object):
+    """A reentrant lock that a waiting thread can give up on once its cancel
+    event is set, and that can be taken away from a thread that no longer
+    responds. Releasing a lock that was taken away does nothing."""
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.owner = None
+        self.count = 0
+        self.revoked = set()
+
+    def acquire(self, blocking=True, cancel=None):
+        me = threading.current_thread()
+        with self.cond:
+            while self.owner is not None and self.owner is not me:
+                if not blocking or cancel is not None and cancel.is_set():
+                    return False
+                # Without a cancel event there is nothing to check.
+                self.cond.wait(0.25 if cancel is not None else None)
+            self.owner = me
+            self.count += 1
+            return True
+
+    def release(self):
+        me = threading.current_thread()
+        with self.cond:
+            if self.owner is not me:
+                if me in self.revoked:
+                    return
+                raise RuntimeError("cannot release un-acquired lock")
+            self.count -= 1
+            if not self.count:
+                self.owner = None
+                self.cond.notify()
+
+    def revoke(self, thread):
+        # The later releases of "thread" are ignored.
+        with self.cond:
+            self.revoked.add(thread)
+            if self.owner is thread:
+                self.owner = None
+                self.count = 0
+                self.cond.notify()
+
+    def __enter__(self):
+        # A cancelled interaction stops waiting for the lock.
+        if not self.acquire(cancel=getattr(WAITS.local, "cancel", None)):
+            raise Cancelled("Cancelled while waiting for the input lock")
+
+    def __exit__(self, *exc):
+        self.release()
+
+
+# Held while an interaction, the button clicker or a mouse task sends input,
+# so that only one of them has the foreground at any time. Everything that
+# sends input takes it: click(), the Typist, the MouseMover, the
+# SessionPlayer and the steps of an interaction that type, press keys, click
+# or scroll. It is not held while they wait, so that buttons are clicked
+# while an interaction waits for a window. An interaction that is abandoned
+# has it taken away.
+INPUT_LOCK = InputLock()
+
+
+# Cuckoo Module
+def click(hwnd):
+    with INPUT_LOCK:
+        BACKEND.click_button(hwnd)
+
+
+class ClickQueue(object):
+    """Clicks matched buttons off the enumeration path. A button that is
+    already queued is not queued again, and a window that was clicked less
+    than "cooldown" seconds ago is ignored. A worker thread drains the
+    queue, waiting "pacing" seconds between clicks. While an interaction
+    sends input, buttons stay queued until it is done. Backends
+    without real time (a fake desktop) have step() scheduled as a task
+    instead."""
+
+    def __init__(self, pacing=0.5, cooldown=3.0):
+        self.pacing = pacing
+        self.cooldown = cooldown
+        self.cond = threading.Condition()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.reset()
+
+    def reset(self):
+        with self.cond:
+            self.queue = collections.deque()
+            self.pending = set()
+            self.clicked = {}
+            self.stats = {
+                "queued": 0, "duplicates": 0, "cooling_down": 0,
+                "clicked": 0, "deferred": 0, "latency": 0.0,
+                "max_latency": 0.0,
+            }
+
+    def push(self, hwnd, title):
+        with self.cond:
+            now = BACKEND.time()
+            if hwnd in self.pending:
+                self.stats["duplicates"] += 1
+                return False
+
+            if hwnd in self.clicked and now - self.clicked[hwnd] < self.cooldown:
+                self.stats["cooling_down"] += 1
+                return False
+
+            self.queue.append((hwnd, title, now))
+            self.pending.add(hwnd)
+            self.stats["queued"] += 1
+            self.cond.notify()
+            return True
+
+    def step(self):
+        # Clicks the oldest queued button, if any, and if nothing else is
+        # sending input. Bringing its window to the foreground would take
+        # the focus away from an interaction.
+        if not INPUT_LOCK.acquire(False):
+            with self.cond:
+                self.stats["deferred"] += 1
+            return False
+
+        try:
+            with self.cond:
+                if not self.queue:
+                    return False
+                hwnd, title, queued = self.queue.popleft()
+                self.pending.discard(hwnd)
+
+            log.info("Found button %r, clicking it", title)
+            TRACE.record("click_button", hwnd, title)
+            click(hwnd)
+        finally:
+            INPUT_LOCK.release()
+
+        now = BACKEND.time()
+        METRICS.count("buttons.clicked")
+        METRICS.observe("buttons.click_latency", now - queued)
+        with self.cond:
+            self.clicked[hwnd] = now
+            self.stats["clicked"] += 1
+            self.stats["latency"] += now - queued
+            self.stats["max_latency"] = max(self.stats["max_latency"], now - queued)
+        return True
+
+    def drain(self):
+        while self.step():
+            pass
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        with self.cond:
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(5)
+            self.thread = None
+
+    def run(self):
+        with GOVERNOR.metered():
+            while not self.stopped.is_set():
+                with self.cond:
+                    while not self.queue and not self.stopped.is_set():
+                        self.cond.wait()
+                # Also waits before trying a deferred click again.
+                self.step()
+                BACKEND.wait(self.stopped, self.pacing)
+
+    def report(self):
+        with self.cond:
+            report = dict(self.stats)
+            report["backlog"] = len(self.queue)
+        report["latency"] /= max(report["clicked"], 1)
+        return report
+
+
+CLICK_QUEUE = ClickQueue()
+
+
+# Keyword packs used to decide which buttons to click, per locale.
+# "click" are partial button labels to click, "complete" are complete button
+# texts to click (these take precedence) and "dontclick" are partial button
+# labels to never click. Packs can be selected with "human.button_locales".
+BUTTON_KEYWORDS = {
+    "en": {
+        "click": [
+            "yes", "ok", "i accept", "next", "new", "install", "file",
+            "run", "start", "extract", "i agree", "enable", "don't send",
+            "don't save", "continue", "personal", "scan", "unzip", "open",
+            "close the program", "execute", "launch", "save", "download",
+            "load", "end", "later", "finish", "allow access",
+            "remind me later",
+        ],
+        "complete": [],
+        "dontclick": [
+            "don't run",
+            "i do not accept",
+        ],
+    },
+    "fr": {
+        "click": [
+            "oui", "suivant", "nouveau", "installer", "fichier", "marrer",
+            "cuter", "accepte", "activer", "accord", "valider",
+            "ne pas envoyer", "continuer", "personnel", "scanner", "dezip",
+            "ouvrir", "executer", "lancer", "sauvegarder", "charger", "fin",
+            "terminer",
+        ],
+        "complete": [],
+        "dontclick": [],
+    },
+    "nl": {
+        "click": [],
+        "complete": [
+            "&Ja",  # E.g., Dutch Office Word 2013.
+        ],
+        "dontclick": [],
+    },
+}
+
+
+# Compile a list of partial labels into a single alternation, longest first.
+def _keyword_regex(keywords):
+    if not keywords:
+        return None
+    keywords = sorted(set(keywords), key=len, reverse=True)
+    return re.compile("|".join(re.escape(keyword) for keyword in keywords))
+
+
+class ButtonMatcher(object):
+    """Decides whether a button should be clicked, caching per window."""
+
+    def __init__(self, locales=None, cache_size=4096):
+        self.cache_size = cache_size
+        self.load_locales(locales)
+
+    def load_locales(self, locales=None):
+        click, complete, dontclick = [], set(), []
+        for locale in locales or sorted(BUTTON_KEYWORDS):
+            if locale not in BUTTON_KEYWORDS:
+                log.warning("Unknown button keyword locale %r", locale)
+                continue
+
+            pack = BUTTON_KEYWORDS[locale]
+            click.extend(pack.get("click", []))
+            complete.update(pack.get("complete", []))
+            dontclick.extend(pack.get("dontclick", []))
+
+        self.complete = frozenset(complete)
+        self.click_re = _keyword_regex(click)
+        self.dontclick_re = _keyword_regex(dontclick)
+        self.cache = {}
+
+    def match(self, text):
+        if text in self.complete:
+            return True
+
+        textval = text.replace("&", "").lower()
+        if self.dontclick_re and self.dontclick_re.search(textval):
+            return False
+        return bool(self.click_re and self.click_re.search(textval))
+
+    def should_click(self, hwnd, classname, text):
+        # Windows that did not change since the last time we saw them are
+        # not evaluated again.
+        key = hwnd, classname, text
+        decision = self.cache.get(key)
+        if decision is None:
+            decision = "button" in classname.lower() and self.match(text)
+            if len(self.cache) >= self.cache_size:
+                self.cache.clear()
+            self.cache[key] = decision
+        return decision
+
+
+BUTTON_MATCHER = ButtonMatcher()
+
+
+# A visible top-level window, or one of its children. For children the title
+# is only fetched for buttons, as nothing else looks at it.
+Window = collections.namedtuple("Window", ("hwnd", "classname", "title", "parent"))
+
+
+class WindowSnapshot(object):
+    """Visible top-level windows and their children, taken in one pass."""
+
+    def __init__(self, windows=None, children=None):
+        self.windows = windows or []
+        self.children = children or {}
+
+
+class WindowSource(object):
+    """Where window snapshots come from. The Win32 source walks the real
+    desktop; other sources (such as a fake desktop) can drive the window
+    handlers without Windows."""
+
+    __metaclass__ = abc.ABCMeta
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    def has_changes(self):
+        # Sources that cannot tell whether anything changed always say so.
+        return True
+
+    @abc.abstractmethod
+    def snapshot(self):
+        pass
+
+
+class Win32WindowSource(WindowSource):
+    """Walks the desktop once per call. The callback thunks and buffers are
+    created once and reused for every enumeration. When WinEvent hooks can be
+    installed, the desktop is only walked again after a window was created,
+    destroyed, shown, hidden or renamed."""
+
+    # WinEvent ranges we listen to: create/destroy/show/hide and name change.
+    WINEVENT_RANGES = (0x8000, 0x8003), (0x800C, 0x800C)
+    WINEVENT_OUTOFCONTEXT = 0
+    OBJID_WINDOW = 0
+    PM_REMOVE = 1
+
+    # Walk the desktop anyway every so many calls in case an event was missed.
+    RESYNC_INTERVAL = 30
+
+    def __init__(self):
+        self.classname = create_unicode_buffer(256)
+        self.title = create_unicode_buffer(1024)
+        self.enum_windows_proc = None
+        self.enum_child_proc = None
+        self.snap = None
+        self.hooks = []
+        self.win_event_proc = None
+        self.msg = None
+        self.dirty = True
+        self.idle = 0
+
+    def start(self):
+        # The hooks are out-of-context, so they are delivered through the
+        # message queue of this thread, which has_changes() pumps.
+        from ctypes import WINFUNCTYPE, byref, c_long, c_void_p
+        from ctypes.wintypes import DWORD, HWND, MSG
+
+        WinEventProc = WINFUNCTYPE(
+            None, c_void_p, DWORD, HWND, c_long, c_long, DWORD, DWORD
+        )
+        self.win_event_proc = WinEventProc(self._on_win_event)
+        self.msg = byref(MSG())
+
+        for first, last in self.WINEVENT_RANGES:
+            hook = USER32.SetWinEventHook(
+                first, last, None, self.win_event_proc, 0, 0,
+                self.WINEVENT_OUTOFCONTEXT
+            )
+            if not hook:
+                log.warning("Unable to install WinEvent hooks, polling the desktop instead.")
+                self.stop()
+                return
+            self.hooks.append(hook)
+
+    def stop(self):
+        for hook in self.hooks:
+            USER32.UnhookWinEvent(hook)
+        self.hooks = []
+
+    def has_changes(self):
+        if not self.hooks:
+            return True
+
+        while USER32.PeekMessageW(self.msg, None, 0, 0, self.PM_REMOVE):
+            USER32.TranslateMessage(self.msg)
+            USER32.DispatchMessageW(self.msg)
+
+        self.idle += 1
+        return self.dirty or self.idle >= self.RESYNC_INTERVAL
+
+    def _on_win_event(self, hook, event, hwnd, id_object, id_child, thread, timestamp):
+        if id_object == self.OBJID_WINDOW:
+            self.dirty = True
+
+    def snapshot(self):
+        if self.enum_windows_proc is None:
+            self.enum_windows_proc = EnumWindowsProc(self._on_window)
+            self.enum_child_proc = EnumChildProc(self._on_child)
+
+        self.dirty, self.idle = False, 0
+        self.snap = WindowSnapshot()
+        try:
+            USER32.EnumWindows(self.enum_windows_proc, 0)
+            return self.snap
+        finally:
+            self.snap = None
+
+    def _on_window(self, hwnd, lparam):
+        if USER32.IsWindowVisible(hwnd):
+            USER32.GetClassNameW(hwnd, self.classname, 256)
+            USER32.GetWindowTextW(hwnd, self.title, 1024)
+            self.snap.windows.append(Window(
+                hwnd, self.classname.value, self.title.value, None
+            ))
+            self.snap.children[hwnd] = []
+            USER32.EnumChildWindows(hwnd, self.enum_child_proc, hwnd)
+        return True
+
+    def _on_child(self, hwnd, lparam):
+        USER32.GetClassNameW(hwnd, self.classname, 256)
+        classname = self.classname.value
+
+        text = ""
+        if "button" in classname.lower():
+            length = USER32.SendMessageW(hwnd, WM_GETTEXTLENGTH, 0, 0)
+            buf = create_unicode_buffer(length + 1)
+            USER32.SendMessageW(hwnd, WM_GETTEXT, length + 1, buf)
+            text = buf.value
+
+        self.snap.children[lparam].append(Window(hwnd, classname, text, lparam))
+        # Recursively search for childs (USER32.EnumChildWindows).
+        return True
+
+
+# Windows that appeared, disappeared or changed their class or title between
+# two snapshots.
+WindowDelta = collections.namedtuple("WindowDelta", ("created", "destroyed", "changed"))
+
+
+def diff_snapshots(previous, current):
+    before = dict((window.hwnd, window) for window in iter_windows(previous))
+    created, changed = [], []
+    for window in iter_windows(current):
+        old = before.pop(window.hwnd, None)
+        if old is None:
+            created.append(window)
+        elif old.classname != window.classname or old.title != window.title:
+            changed.append(window)
+    return WindowDelta(created, list(before.values()), changed)
+
+
+def iter_windows(snapshot):
+    for window in snapshot.windows:
+        yield window
+        for child in snapshot.children.get(window.hwnd, []):
+            yield child
+
+
+class WindowTracker(object):
+    """Keeps the previous snapshot of a window source around and turns every
+    update into a delta. In non-incremental mode every window is reported as
+    created on every update, and the ones that are gone as destroyed."""
+
+    def __init__(self, source, incremental=True):
+        self.source = source
+        self.incremental = incremental
+        self.snapshot = WindowSnapshot()
+
+    def update(self):
+        if not self.source.has_changes():
+            return self.snapshot, WindowDelta([], [], [])
+
+        current = self.source.snapshot()
+        METRICS.count("windows.scanned", len(current.windows) + sum(
+            len(children) for children in current.children.values()
+        ))
+        if self.incremental:
+            delta = diff_snapshots(self.snapshot, current)
+        else:
+            delta = WindowDelta(
+                list(iter_windows(current)),
+                diff_snapshots(self.snapshot, current).destroyed, []
+            )
+        self.snapshot = current
+        return current, delta
+
+
+WINDOW_SOURCE = Win32WindowSource()
+
+# Window policies, by name. Each handler is invoked every "interval" seconds
+# with the current snapshot and the delta since the previous update.
+WINDOW_HANDLERS = {}
+
+
+def register_window_handler(name, handler, interval=1.0):
+    WINDOW_HANDLERS[name] = handler, interval
+
+
+class WindowDispatcher(object):
+    """Takes a single snapshot for all window handlers that are due, so
+    handlers with different intervals never walk the desktop twice."""
+
+    def __init__(self, tracker, handlers, clock=time.time):
+        self.tracker = tracker
+        self.handlers = handlers
+        self.clock = clock
+        now = clock()
+        self.next_due = dict(
+            (name, now + interval) for name, (_, interval) in handlers.items()
+        )
+
+    @property
+    def interval(self):
+        return min(interval for _, interval in self.handlers.values())
+
+    def __call__(self):
+        now = self.clock()
+        due = [
+            name for name in sorted(self.handlers)
+            if self.next_due[name] <= now
+        ]
+        if not due:
+            return
+
+        snapshot, delta = self.tracker.update()
+        for name in due:
+            handler, interval = self.handlers[name]
+            self.next_due[name] = now + interval
+            handler(snapshot, delta)
+
+
+class ButtonClicker(object):
+    """Keeps the matched buttons that are still on screen, from the new or
+    changed windows of every delta, and offers all of them to the click
+    queue on every update. A wizard's "Next >" button keeps its window and
+    title from page to page, and a button may only be enabled later on, so
+    they are clicked again once the queue's cooldown has passed."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.buttons = {}
+
+    def update(self, snapshot, delta):
+        for window in delta.destroyed:
+            self.buttons.pop(window.hwnd, None)
+
+        for window in delta.created + delta.changed:
+            if window.parent is None:
+                continue
+
+            if BUTTON_MATCHER.should_click(window.hwnd, window.classname, window.title):
+                self.buttons[window.hwnd] = window.title
+            else:
+                self.buttons.pop(window.hwnd, None)
+
+        for hwnd, title in self.buttons.items():
+            CLICK_QUEUE.push(hwnd, title)
+
+
+BUTTON_CLICKER = ButtonClicker()
+
+
+# Cuckoo module
+# Queue any button on screen that the matcher considers clickable.
+def click_buttons(snapshot, delta):
+    BUTTON_CLICKER.update(snapshot, delta)
+
+
+# TODO Would " - Microsoft (Word|Excel|PowerPoint)$" be better?
+OFFICE_TITLE_RE = re.compile("- (Microsoft|Word|Excel|PowerPoint)")
+
+
+# Cuckoo module
+# Purpose is to close any office window. Not while an interaction is running,
+# as it may be typing into Word, nor the ones kept warm for an interaction.
+def close_office_windows(snapshot, delta):
+    if InteractionWorker.active:
+        return
+
+    pooled = APP_POOL.pids()
+    for window in snapshot.windows:
+        if OFFICE_TITLE_RE.search(window.title):
+            if pooled and BACKEND.window_pid(window.hwnd) in pooled:
+                continue
+            TRACE.record("close_window", window.hwnd, window.title)
+            BACKEND.close_window(window.hwnd)
+            log.info("Closed Office window.")
+            METRICS.count("office.closed")
+
+
+register_window_handler("close_office", close_office_windows, interval=60)
+register_window_handler("click_buttons", click_buttons)
+
+
+# Default interval and jitter, in seconds, of the periodic background tasks.
+# Can be overridden with the "human.<task>.interval" and "human.<task>.jitter"
+# options.
+TASK_INTERVALS = {
+    "move_mouse": (1.0, 0.25),
+    "click_mouse": (1.0, 0.25),
+}
+
+
+class Task(object):
+    def __init__(self, name, func, interval=None, jitter=0, gaps=None):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.jitter = jitter
+        # Planned times between runs, used up before falling back to the
+        # interval.
+        self.gaps = collections.deque(gaps or ())
+        # Metric names, formatted once rather than on every run.
+        self.metric = "task.%s" % name
+        self.metrics = dict(
+            (metric, "task.%s.%s" % (name, metric))
+            for metric in ("lateness", "duration", "errors")
+        )
+
+
+class Scheduler(object):
+    """Runs tasks off a heap ordered by due time, each on its own interval
+    and with its own jitter. Sleeps until the next task is due; stop() wakes
+    it up immediately. With a virtual clock, "wait" is what moves time
+    forward. Intervals are multiplied by what "scale" returns, if given."""
+
+    def __init__(self, clock=time.time, wait=None, scale=None):
+        self.clock = clock
+        self.wait = wait or (lambda event, timeout: event.wait(timeout))
+        self.scale = scale
+        self.queue = []
+        self.counter = itertools.count()
+        self.stopped = threading.Event()
+
+    def add(self, name, func, interval=None, jitter=0, delay=0, gaps=None):
+        # Tasks without an interval or gaps only run once.
+        task = Task(name, func, interval, jitter, gaps)
+        if task.gaps:
+            delay += task.gaps.popleft()
+        self._push(self.clock() + delay, task)
+
+    def _push(self, due, task):
+        heapq.heappush(self.queue, (due, next(self.counter), task))
+
+    def stop(self):
+        self.stopped.set()
+
+    def run(self):
+        while self.queue and not self.stopped.is_set():
+            due, _, task = self.queue[0]
+            delay = due - self.clock()
+            if delay > 0:
+                self.wait(self.stopped, delay)
+                continue
+
+            heapq.heappop(self.queue)
+            METRICS.observe(task.metrics["lateness"], self.clock() - due)
+            started = self.clock()
+            with METRICS.timer(task.metric):
+                try:
+                    task.func()
+                except Exception:
+                    # One failing task must not take the others down.
+                    log.exception("Error in the %s task", task.name)
+                    METRICS.count(task.metrics["errors"])
+            METRICS.observe(task.metrics["duration"], self.clock() - started)
+
+            if task.gaps or task.interval:
+                interval, jitter = task.interval, task.jitter
+                if task.gaps:
+                    interval, jitter = task.gaps.popleft(), 0
+                if self.scale:
+                    interval *= self.scale()
+                due = max(due + interval, self.clock())
+                if jitter:
+                    due += random.uniform(-jitter, jitter)
+                self._push(due, task)
+
+
+# Cuckoo method
+def move_mouse():
+    # Originally was:
+    # USER32.mouse_event(0x8000, x, y, 0, None)
+    # Changed to SetCurorPos, since using GetCursorPos would not detect
+    # the mouse events. This actually moves the cursor around which might
+    # cause some unintended activity on the desktop. We might want to make
+    # this featur optional.
+    # Now the cursor travels to a random point along a human-like path,
+    # see MouseMover. Not while an interaction uses the mouse, though.
+    if not INPUT_LOCK.acquire(False):
+        METRICS.count("mouse.skipped")
+        return
+
+    try:
+        MOUSE_MOVER.wander()
+    finally:
+        INPUT_LOCK.release()
+
+
+# Cuckoo method
+def click_mouse():
+    if not INPUT_LOCK.acquire(False):
+        METRICS.count("mouse.skipped")
+        return
+
+    try:
+        width, _ = BACKEND.screen_size()
+        # Move mouse to top-middle position.
+        MOUSE_MOVER.move_to(width // 2, 0)
+        TRACE.record("mouse_click", x=width // 2, y=0)
+        BACKEND.mouse_click()
+    finally:
+        INPUT_LOCK.release()
+
+
+# -------- START MODIFICATIONS --------
+#
+#
+#
+#
+#
+#
+# -------- GENERAL NOTES --------
+# | Script function |
+#
+# This collection of methods utilizes pywinauto and pyautogui to simulate user interaction across multiple applications:
+# Notepad, Adobe Acrobat PDF Reader, Microsoft Word 2007, Paint, VLC, Internet Explorer, & Calculator.
+# In general, pywinauto is used for most operations since the goal is to directly interact with GUI elements.
+# However, pyautogui is used often for moving and clicking the mouse as well as pressing hotkeys.
+#
+# | Recommendations for future development |
+#
+# TODO: Move some pywinauto calls to their own respective flexible methods so we can use always_wait_until
+# TODO: General changes to make script less dependent on coordinate-based interactions
+# TODO: Optimize CPU usage
+# TODO: More error catching
+#
+
+
+class PROCESSENTRY32W(Structure):
+    _fields_ = [
+        ("dwSize", c_ulong),
+        ("cntUsage", c_ulong),
+        ("th32ProcessID", c_ulong),
+        ("th32DefaultHeapID", c_size_t),
+        ("th32ModuleID", c_ulong),
+        ("cntThreads", c_ulong),
+        ("th32ParentProcessID", c_ulong),
+        ("pcPriClassBase", c_long),
+        ("dwFlags", c_ulong),
+        ("szExeFile", c_wchar * 260),
+    ]
+
+
+class ProcessSource(object):
+    """Where process table snapshots come from, as (pid, image name) pairs."""
+
+    __metaclass__ = abc.ABCMeta
+
+    @abc.abstractmethod
+    def processes(self):
+        pass
+
+
+class Toolhelp32ProcessSource(ProcessSource):
+    """Takes the snapshot in-process through Toolhelp32."""
+
+    TH32CS_SNAPPROCESS = 0x00000002
+    INVALID_HANDLE_VALUE = -1
+
+    def processes(self):
+        snapshot = KERNEL32.CreateToolhelp32Snapshot(self.TH32CS_SNAPPROCESS, 0)
+        if snapshot == self.INVALID_HANDLE_VALUE:
+            log.warning("Unable to take a snapshot of the process table.")
+            return []
+
+        entry = PROCESSENTRY32W()
+        entry.dwSize = sizeof(entry)
+
+        processes = []
+        try:
+            ok = KERNEL32.Process32FirstW(snapshot, byref(entry))
+            while ok:
+                processes.append((entry.th32ProcessID, entry.szExeFile))
+                ok = KERNEL32.Process32NextW(snapshot, byref(entry))
+        finally:
+            KERNEL32.CloseHandle(snapshot)
+        return processes
+
+
+class ProcessTable(object):
+    """Answers process lookups from a single snapshot of the process table.
+    The snapshot is retaken once it is older than "ttl" seconds, or after
+    invalidate(), which should be called after launching or closing an app."""
+
+    def __init__(self, source, ttl=2.0, clock=time.time):
+        self.source = source
+        self.ttl = ttl
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.taken = None
+        self.by_name = {}
+
+    def invalidate(self):
+        self.taken = None
+
+    def pids(self, process_name):
+        with self.lock:
+            now = self.clock()
+            if self.taken is None or now - self.taken > self.ttl:
+                self.by_name = {}
+                for pid, name in self.source.processes():
+                    self.by_name.setdefault(name.lower(), []).append(pid)
+                self.taken = now
+            return list(self.by_name.get(process_name.lower(), []))
+
+
+PROCESS_TABLE = ProcessTable(Toolhelp32ProcessSource())
+
+
+# Check to see if process exists, if so we can connect to the existing session
+def process_exists(process_name):
+    return bool(PROCESS_TABLE.pids(process_name))
+
+
+class WaitTimeout(Exception):
+    pass
+
+
+class Cancelled(Exception):
+    pass
+
+
+class Waits(object):
+    """Condition-based waits. A condition is polled with exponential backoff
+    until it holds or its deadline passes. Every timeout and pause is
+    multiplied by "scale" (the "human.time_scale" option), and how long each
+    named wait actually took is recorded so the defaults can be tuned. Once
+    the cancel event of a thread is set, its waits raise Cancelled."""
+
+    def __init__(self, scale=1.0, initial=0.05, maximum=1.0, factor=2.0,
+                 clock=time.time, sleep=time.sleep, wait=None):
+        self.scale = scale
+        self.clock = clock
+        self.sleep = sleep
+        self.wait = wait or (lambda event, timeout: event.wait(timeout))
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.local = threading.local()
+
+    def check(self, name):
+        cancel = getattr(self.local, "cancel", None)
+        if cancel is not None and cancel.is_set():
+            raise Cancelled("Cancelled while waiting for %s" % name)
+
+    def until(self, name, condition, timeout=20, raise_on_timeout=False):
+        started = self.clock()
+        deadline = started + timeout * self.scale
+        delay = self.initial
+
+        while True:
+            self.check(name)
+            result = condition()
+            if result:
+                self.record(name, self.clock() - started)
+                return result
+
+            remaining = deadline - self.clock()
+            if remaining <= 0:
+                self.record(name, self.clock() - started, timed_out=True)
+                if raise_on_timeout:
+                    raise WaitTimeout("Timed out waiting for %s" % name)
+                log.warning("Timed out waiting for %s", name)
+                return result
+
+            self.sleep(min(delay, remaining))
+            delay = min(delay * self.factor, self.maximum)
+
+    def pause(self, name, seconds):
+        # Deliberate dwell time, e.g., watching a video.
+        seconds *= self.scale
+        cancel = getattr(self.local, "cancel", None)
+        if cancel is None:
+            self.sleep(seconds)
+        else:
+            self.wait(cancel, seconds)
+            self.check(name)
+        self.record(name, seconds)
+
+    def record(self, name, elapsed, timed_out=False):
+        with self.lock:
+            stats = self.stats.setdefault(name, {
+                "count": 0, "timeouts": 0, "total": 0.0, "max": 0.0,
+            })
+            stats["count"] += 1
+            stats["timeouts"] += int(timed_out)
+            stats["total"] += elapsed
+            stats["max"] = max(stats["max"], elapsed)
+
+    def report(self):
+        with self.lock:
+            return dict((name, dict(stats)) for name, stats in self.stats.items())
+
+
+WAITS = Waits()
+
+
+# Conditions for WAITS.until().
+def file_written(path, since):
+    return os.path.exists(path) and os.path.getmtime(path) >= since
+
+
+class Backend(object):
+    """The desktop the background tasks act upon: a clock, a window source,
+    a process source and the few mouse and window actions they take."""
+
+    __metaclass__ = abc.ABCMeta
+
+    window_source = None
+    process_source = None
+
+    # Whether time passes on its own, so worker threads can wait on it.
+    realtime = True
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def wait(self, event, timeout):
+        return event.wait(timeout)
+
+    @abc.abstractmethod
+    def system_times(self):
+        # Idle and total CPU time of all processors, in seconds.
+        pass
+
+    @abc.abstractmethod
+    def screen_size(self):
+        pass
+
+    @abc.abstractmethod
+    def capture(self, rect):
+        # Grayscale pixels within (left, top, right, bottom) as an array,
+        # or None.
+        pass
+
+    @abc.abstractmethod
+    def set_cursor(self, x, y):
+        pass
+
+    @abc.abstractmethod
+    def cursor_position(self):
+        pass
+
+    @abc.abstractmethod
+    def move_cursor(self, points):
+        # Moves the cursor through all points in one go.
+        pass
+
+    @abc.abstractmethod
+    def mouse_click(self):
+        pass
+
+    @abc.abstractmethod
+    def click_button(self, hwnd):
+        pass
+
+    @abc.abstractmethod
+    def close_window(self, hwnd):
+        pass
+
+    @abc.abstractmethod
+    def find_windows(self, classname=None):
+        # (hwnd, title, pid) of the visible top-level windows of a class, or
+        # of all of them.
+        pass
+
+    @abc.abstractmethod
+    def window_pid(self, hwnd):
+        pass
+
+    @abc.abstractmethod
+    def foreground_rect(self):
+        # (left, top, right, bottom) of the foreground window, or None.
+        pass
+
+    @abc.abstractmethod
+    def pressed_keys(self):
+        # The virtual keys, mouse buttons included, that are down.
+        pass
+
+    @abc.abstractmethod
+    def press(self, vk, down):
+        pass
+
+
+class Win32Backend(Backend):
+    """The real desktop."""
+
+    def __init__(self, window_source, process_source):
+        self.window_source = window_source
+        self.process_source = process_source
+
+    def system_times(self):
+        from ctypes import c_ulonglong
+        idle, kernel, user = c_ulonglong(), c_ulonglong(), c_ulonglong()
+        KERNEL32.GetSystemTimes(byref(idle), byref(kernel), byref(user))
+        # Kernel time includes the idle time.
+        return idle.value / 1e7, (kernel.value + user.value) / 1e7
+
+    def screen_size(self):
+        return RESOLUTION["x"], RESOLUTION["y"]
+
+    def capture(self, rect):
+        left, top, right, bottom = rect
+        image = pyautogui.screenshot(region=(left, top, right - left, bottom - top))
+        return numpy.asarray(image.convert("L"), dtype=float)
+
+    def set_cursor(self, x, y):
+        USER32.SetCursorPos(x, y)
+
+    def cursor_position(self):
+        from ctypes.wintypes import POINT
+        point = POINT()
+        USER32.GetCursorPos(byref(point))
+        return point.x, point.y
+
+    def find_windows(self, classname=None):
+        # FindWindowEx only visits top-level windows of the class, unlike
+        # EnumWindows or a UI Automation search of the whole tree.
+        from ctypes.wintypes import DWORD
+        windows, hwnd, pid = [], None, DWORD()
+        while True:
+            hwnd = USER32.FindWindowExW(None, hwnd, classname, None)
+            if not hwnd:
+                return windows
+            if USER32.IsWindowVisible(hwnd):
+                length = USER32.GetWindowTextLengthW(hwnd)
+                title = create_unicode_buffer(length + 1)
+                USER32.GetWindowTextW(hwnd, title, length + 1)
+                USER32.GetWindowThreadProcessId(hwnd, byref(pid))
+                windows.append((hwnd, title.value, pid.value))
+
+    def window_pid(self, hwnd):
+        from ctypes.wintypes import DWORD
+        pid = DWORD()
+        USER32.GetWindowThreadProcessId(hwnd, byref(pid))
+        return pid.value
+
+    def move_cursor(self, points):
+        width, height = self.screen_size()
+        send_input(mouse_inputs(points, width, height))
+
+    def foreground_rect(self):
+        from ctypes.wintypes import RECT
+        rect = RECT()
+        hwnd = USER32.GetForegroundWindow()
+        if not hwnd or not USER32.GetWindowRect(hwnd, byref(rect)):
+            return None
+        return rect.left, rect.top, rect.right, rect.bottom
+
+    def pressed_keys(self):
+        return set(
+            vk for vk in RECORDED_KEYS if USER32.GetAsyncKeyState(vk) & 0x8000
+        )
+
+    def press(self, vk, down):
+        if vk in MOUSE_BUTTONS:
+            flags = MOUSE_BUTTONS[vk][0 if down else 1]
+            send_input([INPUT(INPUT_MOUSE, _INPUTUNION(mi=MOUSEINPUT(0, 0, 0, flags, 0, 0)))])
+        else:
+            flags = 0 if down else KEYEVENTF_KEYUP
+            send_input([INPUT(INPUT_KEYBOARD, _INPUTUNION(ki=KEYBDINPUT(vk, 0, flags, 0, 0)))])
+
+    def mouse_click(self):
+        # Mouse down.
+        USER32.mouse_event(2, 0, 0, 0, None)
+        KERNEL32.Sleep(50)
+        # Mouse up.
+        USER32.mouse_event(4, 0, 0, 0, None)
+
+    def click_button(self, hwnd):
+        USER32.SetForegroundWindow(hwnd)
+        KERNEL32.Sleep(1000)
+        USER32.SendMessageW(hwnd, BM_CLICK, 0, 0)
+
+    def close_window(self, hwnd):
+        USER32.SendNotifyMessageW(hwnd, WM_CLOSE, None, None)
+
+
+BACKEND = Win32Backend(WINDOW_SOURCE, PROCESS_TABLE.source)
+
+
+# Point the window handlers, process lookups, waits and background tasks at
+# another desktop, e.g., a fake one. Returns the previous backend.
+def use_backend(backend):
+    global BACKEND, WINDOW_SOURCE
+    previous = BACKEND
+    BACKEND = backend
+    WINDOW_SOURCE = backend.window_source
+    PROCESS_TABLE.source = backend.process_source
+    PROCESS_TABLE.clock = WAITS.clock = backend.time
+    PROCESS_TABLE.invalidate()
+    WAITS.sleep = backend.sleep
+    WAITS.wait = backend.wait
+    return previous
+
+
+class Governor(object):
+    """Keeps the auxiliary under a CPU budget. The CPU time of its own
+    threads, those running within metered(), and the load of the whole
+    guest are sampled at most every "interval" seconds; the rest of the
+    analyzer process is not counted. While the threads use more than
+    "budget" of a CPU, or the guest is busier than "busy", the throttling
+    factor grows; once both are back under their limits it decays back to
+    1. The factor stretches the background task intervals and the typing
+    delays, and interactions are not started while the guest is busy, for
+    up to "max_defer" seconds. It is off unless "human.governor" is set,
+    until the budget has been calibrated on real guests."""
+
+    def __init__(self, budget=0.1, busy=0.85, interval=1.0, growth=1.5,
+                 decay=1.25, max_factor=8.0, max_defer=30):
+        self.enabled = False
+        self.budget = budget
+        self.busy = busy
+        self.interval = interval
+        self.growth = growth
+        self.decay = decay
+        self.max_factor = max_factor
+        self.max_defer = max_defer
+        self.lock = threading.Lock()
+        # The CPU time of every metered thread when it was last sampled.
+        self.threads = {}
+        self.reset()
+
+    def reset(self):
+        self.factor = 1.0
+        self.own = self.load = 0.0
+        self.last = None
+        # The CPU time of the metered threads that ended since then.
+        self.retired = 0.0
+        self.stats = {
+            "samples": 0, "throttled": 0, "throttled_seconds": 0.0,
+            "max_factor": 1.0, "own_cpu": 0.0, "guest_load": 0.0,
+            "deferred": 0, "deferred_seconds": 0.0,
+        }
+
+    def update(self):
+        # Returns the current throttling factor, sampling first if due.
+        if not self.enabled:
+            return 1.0
+
+        with self.lock:
+            now = BACKEND.time()
+            if self.last is not None and now - self.last[0] < self.interval:
+                return self.factor
+
+            cpu = self._own_cpu()
+            idle, total = BACKEND.system_times()
+            if self.last is not None:
+                then, last_idle, last_total = self.last
+                self.own = cpu / (now - then)
+                if total > last_total:
+                    self.load = 1 - float(idle - last_idle) / (total - last_total)
+                self._adapt(now - then)
+            self.last = now, idle, total
+            return self.factor
+
+    def _own_cpu(self):
+        # CPU time of the metered threads since the last sample, with the
+        # lock held.
+        cpu, self.retired = self.retired, 0.0
+        for ident, last in list(self.threads.items()):
+            current = thread_cpu_time(ident)
+            if current is None:
+                del self.threads[ident]
+                continue
+            cpu += current - last
+            self.threads[ident] = current
+        return cpu
+
+    @contextlib.contextmanager
+    def metered(self):
+        # Counts the CPU time the current thread spends in the block
+        # against the budget.
+        ident = threading.current_thread().ident
+        with self.lock:
+            nested = ident in self.threads
+            if not nested:
+                self.threads[ident] = thread_cpu_time()
+        try:
+            yield
+        finally:
+            if not nested:
+                with self.lock:
+                    last = self.threads.pop(ident, None)
+                    if last is not None:
+                        self.retired += thread_cpu_time() - last
+
+    def _adapt(self, elapsed):
+        stats = self.stats
+        stats["samples"] += 1
+        stats["own_cpu"] += self.own
+        stats["guest_load"] += self.load
+
+        if self.own > self.budget or self.load > self.busy:
+            self.factor = min(self.factor * self.growth, self.max_factor)
+            stats["throttled"] += 1
+        else:
+            self.factor = max(self.factor / self.decay, 1.0)
+
+        if self.factor > 1.0:
+            stats["throttled_seconds"] += elapsed
+        stats["max_factor"] = max(stats["max_factor"], self.factor)
+
+    def quiet(self):
+        self.update()
+        return self.load <= self.busy
+
+    def defer(self, name):
+        # Hold off starting an interaction while the guest is busy.
+        if not self.enabled:
+            return
+
+        started = BACKEND.time()
+        WAITS.until("governor.%s" % name, self.quiet, timeout=self.max_defer)
+        deferred = BACKEND.time() - started
+        if deferred > 0:
+            with self.lock:
+                self.stats["deferred"] += 1
+                self.stats["deferred_seconds"] += deferred
+
+    def report(self):
+        with self.lock:
+            report = dict(self.stats)
+        samples = max(report["samples"], 1)
+        report["own_cpu"] /= samples
+        report["guest_load"] /= samples
+        return report
+
+
+GOVERNOR = Governor()
+
+
+# Class of the standard dialogs (Save As, Open, properties), which the win32
+# backend finds a lot faster than UI Automation does. So are top-level
+# windows, by their title or class.
+DIALOG_CLASS = "#32770"
+
+# Criteria of a top-level window the win32 lookup understands.
+WIN32_WINDOW_CRITERIA = "title", "title_re", "class_name", "found_index"
+
+# Controls within dialogs that the win32 backend knows by their class.
+WIN32_CONTROL_CLASSES = {
+    "Button": "Button",
+    "Edit": "Edit",
+}
+
+
+def criteria_pid(criteria):
+    # The process of the application a specification was made from, None
+    # for one of the desktop. pywinauto keeps the Application object as
+    # "app", or only its process id as "process".
+    app = criteria.get("app")
+    if app is not None:
+        return app.process
+    return criteria.get("process")
+
+
+def find_top_level(criteria, pid, classname=None):
+    # The handle of the first visible top-level window of process "pid", or
+    # of any process if None, that matches the criteria, or None. The class
+    # defaults to "classname".
+    criteria = dict(
+        (key, value) for key, value in criteria.items()
+        if key not in ("backend", "app", "process")
+    )
+    if set(criteria) - set(WIN32_WINDOW_CRITERIA) or criteria.get("found_index", 0):
+        return None
+
+    for hwnd, title, owner in BACKEND.find_windows(criteria.get("class_name", classname)):
+        if pid is not None and owner != pid:
+            continue
+        if "title" in criteria and title != criteria["title"]:
+            continue
+        if "title_re" in criteria and not re.match(criteria["title_re"], title):
+            continue
+        return hwnd
+
+
+def win32_criteria(criteria):
+    # UIA search criteria for a control as the win32 backend knows them, or
+    # None if they only make sense to UIA.
+    criteria = dict(criteria)
+    for key in ("backend", "app", "process"):
+        criteria.pop(key, None)
+
+    control_type = criteria.pop("control_type", None)
+    if control_type is not None:
+        if control_type not in WIN32_CONTROL_CLASSES:
+            return None
+        criteria.setdefault("class_name", WIN32_CONTROL_CLASSES[control_type])
+
+    if "auto_id" in criteria:
+        if not criteria["auto_id"].isdigit():
+            return None
+        criteria["control_id"] = int(criteria.pop("auto_id"))
+    return criteria
+
+
+def win32_spec(spec, dialog=None):
+    # The UIA specification for the win32 backend: a top-level window, or
+    # rooted at the top-level standard dialog whose criteria are at index
+    # "dialog". Only here is the dialog class looked for, UIA may see the
+    # dialog differently. None when the rest needs what only UIA knows, or
+    # the window is not there now.
+    criteria = spec.criteria
+    pid = criteria_pid(criteria[0])
+    if dialog is None:
+        if len(criteria) != 1:
+            return None
+        hwnd, children = find_top_level(criteria[0], pid), []
+    else:
+        children = [win32_criteria(child) for child in criteria[dialog + 1:]]
+        if None in children:
+            return None
+        hwnd = find_top_level(criteria[dialog], pid, DIALOG_CLASS)
+    if hwnd is None:
+        return None
+
+    found = application.WindowSpecification({"handle": hwnd, "backend": "win32"})
+    for child in children:
+        found = found.child_window(**child)
+    return found
+
+
+class LocatorStats(object):
+    """What the locator caches of all sessions did, and the backend that
+    last found every element. The caches live on the interaction threads,
+    while the metrics summary is taken on another one."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.totals = {
+            "hits": 0, "misses": 0, "stale": 0,
+            "win32": 0, "uia": 0, "fallback": 0,
+            "win32_seconds": 0.0, "uia_seconds": 0.0,
+        }
+        self.backends = {}
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.totals[counter] += value
+
+    def backend(self, name):
+        with self.lock:
+            return self.backends.get(name)
+
+    def found(self, name, backend, fallback):
+        with self.lock:
+            self.totals[backend] += 1
+            self.totals["fallback"] += int(fallback)
+            self.backends[name] = backend
+
+    def report(self):
+        # The totals, with the time the win32 lookups saved compared to
+        # the average UIA lookup.
+        with self.lock:
+            report = dict(self.totals)
+            report["backends"] = dict(self.backends)
+        if report["win32"] and report["uia"]:
+            report["saved"] = max(
+                report["win32"] * report["uia_seconds"] / report["uia"] -
+                report["win32_seconds"], 0
+            )
+        return report
+
+
+LOCATOR_STATS = LocatorStats()
+
+
+class LocatorCache(object):
+    """Resolves pywinauto window specifications to element wrappers once per
+    application session. A cached element is dropped, and searched for
+    again, as soon as the window owning it is destroyed or its runtime id
+    changes. Top-level windows, and elements within standard dialogs whose
+    criteria are at the "dialog" index of their specification, are looked
+    for with the win32 backend, falling back to UIA; which of them found an
+    element is remembered per name, over all sessions, and tried first next
+    time. Other controls are only looked for with UIA."""
+
+    def __init__(self):
+        self.elements = {}
+        self.hits = self.misses = self.stale = 0
+
+    def _count(self, counter):
+        setattr(self, counter, getattr(self, counter) + 1)
+        LOCATOR_STATS.count(counter)
+
+    def _alive(self, wrapper, runtime_id, owner):
+        if owner and not USER32.IsWindow(owner):
+            return False
+        try:
+            return getattr(wrapper.element_info, "runtime_id", None) == runtime_id
+        except Exception:
+            # UIA raises a COMError for elements that are gone.
+            return False
+
+    def find(self, name, spec, dialog=None):
+        # Returns the wrapper for spec, or None if it does not exist right now.
+        cached = self.elements.get(name)
+        if cached is not None:
+            if self._alive(*cached):
+                self._count("hits")
+                return cached[0]
+            self._count("stale")
+            del self.elements[name]
+
+        self._count("misses")
+        wrapper = self._resolve(name, spec, dialog)
+        if wrapper is None:
+            return None
+
+        runtime_id = getattr(wrapper.element_info, "runtime_id", None)
+        owner = wrapper.top_level_parent().handle
+        self.elements[name] = wrapper, runtime_id, owner
+        return wrapper
+
+    def _resolve(self, name, spec, dialog):
+        backends = ["uia"]
+        if dialog is not None or len(spec.criteria) == 1:
+            backends = ["win32", "uia"]
+            if LOCATOR_STATS.backend(name) == "uia":
+                backends.reverse()
+
+        for backend in backends:
+            started = time.time()
+            try:
+                found = win32_spec(spec, dialog) if backend == "win32" else spec
+                wrapper = found.wrapper_object() if found and found.exists(timeout=0) else None
+            except Exception:
+                # The win32 backend does not take every UIA criterion.
+                log.debug("Unable to find %s with the %s backend", name, backend, exc_info=True)
+                wrapper = None
+
+            elapsed = time.time() - started
+            METRICS.observe("locate.%s" % backend, elapsed)
+            LOCATOR_STATS.count("%s_seconds" % backend, elapsed)
+            if wrapper is not None:
+                LOCATOR_STATS.found(name, backend, backend != backends[0])
+                return wrapper
+
+    def get(self, name, spec, timeout=20, ready=True, dialog=None):
+        # Waits until spec resolves to an element, that is also visible and
+        # enabled unless "ready" is unset.
+        def found():
+            wrapper = self.find(name, spec, dialog)
+            if wrapper and (not ready or wrapper.is_visible() and wrapper.is_enabled()):
+                return wrapper
+
+        with METRICS.step("locate"):
+            return WAITS.until(name, found, timeout, raise_on_timeout=True)
+
+    def invalidate(self, name=None):
+        if name is None:
+            self.elements.clear()
+        else:
+            self.elements.pop(name, None)
+
+
+class KEYBDINPUT(Structure):
+    _fields_ = [
+        ("wVk", c_ushort),
+        ("wScan", c_ushort),
+        ("dwFlags", c_ulong),
+        ("time", c_ulong),
+        ("dwExtraInfo", c_size_t),
+    ]
+
+
+class MOUSEINPUT(Structure):
+    _fields_ = [
+        ("dx", c_long),
+        ("dy", c_long),
+        ("mouseData", c_ulong),
+        ("dwFlags", c_ulong),
+        ("time", c_ulong),
+        ("dwExtraInfo", c_size_t),
+    ]
+
+
+class _INPUTUNION(Union):
+    _fields_ = [
+        ("mi", MOUSEINPUT),
+        ("ki", KEYBDINPUT),
+    ]
+
+
+class INPUT(Structure):
+    _fields_ = [
+        ("type", c_ulong),
+        ("union", _INPUTUNION),
+    ]
+
+
+INPUT_MOUSE = 0
+INPUT_KEYBOARD = 1
+KEYEVENTF_KEYUP = 0x0002
+KEYEVENTF_UNICODE = 0x0004
+
+# Characters that are sent as virtual keys rather than as unicode characters.
+VIRTUAL_KEYS = {
+    "\b": 0x08,  # VK_BACK
+    "\t": 0x09,  # VK_TAB
+    "\n": 0x0D,  # VK_RETURN
+}
+VK_CONTROL = 0x11
+
+# Neighbouring keys on a QWERTY keyboard, used to make typos.
+KEYBOARD_ROWS = "qwertyuiop", "asdfghjkl", "zxcvbnm"
+NEIGHBOUR_KEYS = {}
+for _row in KEYBOARD_ROWS:
+    for _idx, _key in enumerate(_row):
+        NEIGHBOUR_KEYS[_key] = _row[max(_idx - 1, 0):_idx] + _row[_idx + 1:_idx + 2]
+
+
+def key_inputs(char, keyup=True):
+    vk = VIRTUAL_KEYS.get(char, 0)
+    flags = 0 if vk else KEYEVENTF_UNICODE
+    scan = 0 if vk else ord(char)
+
+    inputs = [INPUT(INPUT_KEYBOARD, _INPUTUNION(ki=KEYBDINPUT(vk, scan, flags, 0, 0)))]
+    if keyup:
+        inputs.append(INPUT(INPUT_KEYBOARD, _INPUTUNION(
+            ki=KEYBDINPUT(vk, scan, flags | KEYEVENTF_KEYUP, 0, 0)
+        )))
+    return inputs
+
+
+def vk_inputs(*vks):
+    # Press the virtual keys in order, release them in reverse order.
+    inputs = [
+        INPUT(INPUT_KEYBOARD, _INPUTUNION(ki=KEYBDINPUT(vk, 0, 0, 0, 0)))
+        for vk in vks
+    ]
+    inputs.extend(
+        INPUT(INPUT_KEYBOARD, _INPUTUNION(ki=KEYBDINPUT(vk, 0, KEYEVENTF_KEYUP, 0, 0)))
+        for vk in reversed(vks)
+    )
+    return inputs
+
+
+def send_input(inputs):
+    array = (INPUT * len(inputs))(*inputs)
+    return USER32.SendInput(len(inputs), array, sizeof(INPUT))
+
+
+class high_resolution_timer(object):
+    """Raises the system timer resolution to 1ms so that sleeps between
+    synthesized events don't drift by a whole 15.6ms scheduler tick."""
+
+    def __enter__(self):
+        try:
+            from ctypes import windll
+        except ImportError:
+            # Not on Windows, e.g., replaying onto a fake desktop.
+            self.winmm = None
+            return
+
+        self.winmm = windll.winmm
+        self.winmm.timeBeginPeriod(1)
+
+    def __exit__(self, *exc):
+        if self.winmm is not None:
+            self.winmm.timeEndPeriod(1)
+
+
+# The clipboard functions, with private prototypes so those of the shared
+# KERNEL32 and USER32 of the analyzer are left as they are.
+CLIPBOARD_DLLS = None
+
+
+def clipboard_dlls():
+    global CLIPBOARD_DLLS
+    if CLIPBOARD_DLLS is None:
+        from ctypes import WinDLL, c_void_p
+        from ctypes.wintypes import BOOL, HWND, UINT
+        kernel32, user32 = WinDLL("kernel32"), WinDLL("user32")
+        for dll, name, restype, argtypes in (
+            (kernel32, "GlobalAlloc", c_void_p, (UINT, c_size_t)),
+            (kernel32, "GlobalLock", c_void_p, (c_void_p,)),
+            (kernel32, "GlobalUnlock", BOOL, (c_void_p,)),
+            (kernel32, "GlobalFree", c_void_p, (c_void_p,)),
+            (user32, "OpenClipboard", BOOL, (HWND,)),
+            (user32, "EmptyClipboard", BOOL, ()),
+            (user32, "SetClipboardData", c_void_p, (UINT, c_void_p)),
+            (user32, "CloseClipboard", BOOL, ()),
+        ):
+            func = getattr(dll, name)
+            func.restype, func.argtypes = restype, argtypes
+        CLIPBOARD_DLLS = kernel32, user32
+    return CLIPBOARD_DLLS
+
+
+def set_clipboard_text(text):
+    GMEM_MOVEABLE, CF_UNICODETEXT = 0x0002, 13
+    kernel32, user32 = clipboard_dlls()
+
+    data = text.encode("utf-16-le") + b"\0\0"
+    if not user32.OpenClipboard(None):
+        return False
+
+    try:
+        user32.EmptyClipboard()
+        handle = kernel32.GlobalAlloc(GMEM_MOVEABLE, len(data))
+        if not handle:
+            return False
+
+        pointer = kernel32.GlobalLock(handle)
+        if not pointer:
+            kernel32.GlobalFree(handle)
+            return False
+
+        memmove(pointer, data, len(data))
+        kernel32.GlobalUnlock(handle)
+        if not user32.SetClipboardData(CF_UNICODETEXT, handle):
+            # The memory only belongs to the clipboard once it is set.
+            kernel32.GlobalFree(handle)
+            return False
+        return True
+    finally:
+        user32.CloseClipboard()
+
+
+class Typist(object):
+    """Types text from a keystroke schedule that is computed up front.
+    Inter-key delays are drawn from a log-normal distribution around the
+    configured speed in characters per minute, and the occasional typo is
+    corrected with a backspace. Keystrokes that are due within "batch"
+    seconds of each other are sent with a single SendInput call.
+
+    With "fast" set, text that only needs to exist is entered through
+    set_edit_text() or the clipboard instead."""
+
+    def __init__(self, cpm=900, jitter=0.35, typo_rate=0.02, batch=0.05,
+                 fast=False, rng=None):
+        self.cpm = cpm
+        self.jitter = jitter
+        self.typo_rate = typo_rate
+        self.batch = batch
+        self.fast = fast
+        self.rng = rng or random.Random()
+
+    def delay(self):
+        # The mean of the log-normal distribution is 60 / cpm.
+        mu = math.log(60.0 / self.cpm) - self.jitter ** 2 / 2
+        return self.rng.lognormvariate(mu, self.jitter)
+
+    def schedule(self, text):
+        # List of (seconds since start, character) tuples.
+        keys, at = [], 0.0
+        for char in text.replace("\r", ""):
+            neighbours = NEIGHBOUR_KEYS.get(char.lower())
+            if neighbours and self.rng.random() < self.typo_rate:
+                at += self.delay()
+                keys.append((at, self.rng.choice(neighbours)))
+                # Noticing the typo takes a little longer.
+                at += self.delay() * 2
+                keys.append((at, "\b"))
+
+            at += self.delay()
+            keys.append((at, char))
+        return keys
+
+    def batches(self, keys):
+        # (seconds since start, inputs) of every SendInput call.
+        idx = 0
+        while idx < len(keys):
+            due, inputs = keys[idx][0], []
+            while idx < len(keys) and keys[idx][0] - due <= self.batch:
+                inputs.extend(key_inputs(keys[idx][1]))
+                idx += 1
+            yield due, inputs
+
+    def type(self, wrapper, text):
+        if self.fast and self.paste(wrapper, text):
+            TRACE.record("paste", getattr(wrapper, "handle", None), length=len(text))
+            return
+
+        keys = self.schedule(text)
+        METRICS.count("keys.typed", len(keys))
+        # Type slower while the governor is throttling.
+        factor = GOVERNOR.update()
+        with INPUT_LOCK, METRICS.step("type"), high_resolution_timer():
+            if wrapper is not None:
+                wrapper.set_focus()
+
+            started = time.time()
+            for due, inputs in self.batches(keys):
+                # Sleep until an absolute deadline, so delays don't add up.
+                delay = started + due * factor - time.time()
+                if delay > 0:
+                    WAITS.pause("type", delay)
+                send_input(inputs)
+        TRACE.record("type", getattr(wrapper, "handle", None), length=len(text))
+
+    def paste(self, wrapper, text):
+        if hasattr(wrapper, "set_edit_text"):
+            wrapper.set_edit_text(text)
+            return True
+
+        if not set_clipboard_text(text):
+            return False
+
+        with INPUT_LOCK:
+            if wrapper is not None:
+                wrapper.set_focus()
+            send_input(vk_inputs(VK_CONTROL, ord("V")))
+        return True
+
+
+TYPIST = Typist()
+
+
+MOUSEEVENTF_MOVE = 0x0001
+MOUSEEVENTF_ABSOLUTE = 0x8000
+
+
+# Mouse buttons by virtual key, with their down and up flags.
+MOUSE_BUTTONS = {
+    0x01: (0x0002, 0x0004),  # VK_LBUTTON
+    0x02: (0x0008, 0x0010),  # VK_RBUTTON
+    0x04: (0x0020, 0x0040),  # VK_MBUTTON
+}
+
+# Virtual keys a recording polls. Shift, Ctrl and Alt are only recorded as
+# their left and right keys, which also report as the generic ones.
+RECORDED_KEYS = [vk for vk in range(1, 256) if vk not in (0x10, 0x11, 0x12)]
+
+
+def mouse_inputs(points, width, height):
+    # Absolute coordinates are normalized to 0..65535 across the screen.
+    return [
+        INPUT(INPUT_MOUSE, _INPUTUNION(mi=MOUSEINPUT(
+            x * 65535 // max(width - 1, 1), y * 65535 // max(height - 1, 1),
+            0, MOUSEEVENTF_MOVE | MOUSEEVENTF_ABSOLUTE, 0, 0
+        )))
+        for x, y in points
+    ]
+
+
+class MouseMover(object):
+    """Moves the cursor along human-like paths instead of teleporting it.
+    Paths are planned up front with NumPy, many at a time: a cubic Bezier
+    curve bent away from the straight line, traversed with a minimum-jerk
+    velocity profile in the time Fitts' law gives, now and then overshooting
+    the target and correcting, with some tremor on top. Replay sleeps until
+    absolute deadlines and sends all points that are due within "batch"
+    seconds of each other with a single SendInput call. Without NumPy the
+    cursor is set to its destination at once, as it used to be."""
+
+    # Fitts' law: movement time = a + b * log2(distance / width + 1).
+    FITTS_A = 0.1
+    FITTS_B = 0.15
+
+    def __init__(self, rate=125, batch=0.008, overshoot=0.15, tremor=0.6,
+                 curvature=0.15, target_width=24, seed=None):
+        self.rate = rate
+        self.batch = batch
+        self.overshoot = overshoot
+        self.tremor = tremor
+        self.curvature = curvature
+        self.target_width = target_width
+        self.pending = collections.deque()
+        self.seed(seed)
+
+    def seed(self, seed=None):
+        # NumPy is only imported once the first path is planned.
+        self.seed_value = seed
+        self.rng = None
+        self.fallback_rng = random.Random(seed)
+        self.pending.clear()
+
+    def _rng(self):
+        if self.rng is None:
+            self.rng = numpy.random.RandomState(self.seed_value)
+        return self.rng
+
+    def plan(self, start, targets, bounds=None):
+        # Returns one path per target, each an array of (seconds since the
+        # start of the path, x, y) rows. Every path starts where the previous
+        # one ended.
+        np, rng = numpy, self._rng()
+        targets = np.asarray(targets, dtype=float).reshape(-1, 2)
+        origins = np.vstack([np.asarray(start, dtype=float), targets[:-1]])
+
+        # Overshot targets get an extra segment: past the target, then back.
+        overshot = rng.random_sample(len(targets)) < self.overshoot
+        beyond = targets + (targets - origins) * rng.uniform(
+            0.03, 0.12, (len(targets), 1)
+        )
+        ends, owners, widths = [], [], []
+        for idx in range(len(targets)):
+            if overshot[idx]:
+                ends.append(beyond[idx])
+                owners.append(idx)
+                widths.append(self.target_width * 4)
+            ends.append(targets[idx])
+            owners.append(idx)
+            widths.append(self.target_width)
+        ends, owners = np.array(ends), np.array(owners)
+        begins = np.vstack([np.asarray(start, dtype=float), ends[:-1]])
+
+        delta = ends - begins
+        distance = np.hypot(delta[:, 0], delta[:, 1])
+        durations = self.FITTS_A + self.FITTS_B * np.log2(
+            distance / np.array(widths) + 1
+        )
+        counts = np.maximum(np.ceil(durations * self.rate).astype(int) + 1, 2)
+
+        # The correction follows the overshoot after a short reaction time.
+        corrections = np.r_[False, owners[1:] == owners[:-1]]
+        offsets = np.where(
+            corrections,
+            np.r_[0.0, durations[:-1]] + rng.uniform(0.05, 0.15, len(owners)),
+            0.0
+        )
+
+        # Control points are pushed sideways, proportionally to the distance.
+        normal = np.column_stack([-delta[:, 1], delta[:, 0]]) / np.maximum(
+            distance, 1e-9
+        )[:, None]
+        bends = rng.normal(0, self.curvature, (len(owners), 2)) * distance[:, None]
+        first = begins + delta * 0.3 + normal * bends[:, :1]
+        second = begins + delta * 0.7 + normal * bends[:, 1:]
+
+        # Every sample of every segment at once.
+        segment = np.repeat(np.arange(len(owners)), counts)
+        index = np.arange(len(segment)) - np.repeat(np.cumsum(counts) - counts, counts)
+        tau = index / (counts[segment] - 1.0)
+        s = (10 * tau ** 3 - 15 * tau ** 4 + 6 * tau ** 5)[:, None]
+        points = (
+            (1 - s) ** 3 * begins[segment] + 3 * (1 - s) ** 2 * s * first[segment] +
+            3 * (1 - s) * s ** 2 * second[segment] + s ** 3 * ends[segment]
+        )
+        # No tremor at either end of a segment, so the targets are hit.
+        points += rng.normal(0, self.tremor, points.shape) * np.sin(np.pi * tau)[:, None]
+        if bounds is not None:
+            points[:, 0] = np.clip(points[:, 0], 0, bounds[0] - 1)
+            points[:, 1] = np.clip(points[:, 1], 0, bounds[1] - 1)
+
+        rows = np.column_stack([
+            tau * durations[segment] + offsets[segment], np.round(points)
+        ])
+        splits = np.cumsum(np.bincount(owners, weights=counts).astype(int))[:-1]
+        return np.split(rows, splits)
+
+    def replay(self, path):
+        # Returns how late every batch of points was sent, in seconds.
+        np, errors = numpy, []
+        times = path[:, 0]
+        with INPUT_LOCK, high_resolution_timer():
+            started, idx = BACKEND.time(), 0
+            while idx < len(path):
+                due = times[idx]
+                end = int(np.searchsorted(times, due + self.batch, side="right"))
+                delay = started + due - BACKEND.time()
+                if delay > 0:
+                    BACKEND.sleep(delay)
+                errors.append(BACKEND.time() - started - due)
+                BACKEND.move_cursor([
+                    (int(x), int(y)) for x, y in path[idx:end, 1:]
+                ])
+                idx = end
+
+        for error in errors:
+            METRICS.observe("mouse.replay_error", error)
+        METRICS.count("mouse.points", len(path))
+        return errors
+
+    def move_to(self, x, y):
+        TRACE.record("move", x=int(x), y=int(y))
+        if not numpy.available():
+            BACKEND.set_cursor(int(x), int(y))
+            return []
+
+        width, height = BACKEND.screen_size()
+        path = self.plan(BACKEND.cursor_position(), [(x, y)], (width, height))
+        return self.replay(path[0])
+
+    def wander(self, batch=16):
+        # Random destinations are planned "batch" at a time. They are thrown
+        # away when something else moved the cursor in the meantime.
+        if not numpy.available():
+            width, height = BACKEND.screen_size()
+            return self.move_to(
+                self.fallback_rng.randint(0, width - 1),
+                self.fallback_rng.randint(0, height - 1)
+            )
+
+        position = list(BACKEND.cursor_position())
+        if not self.pending or self.pending[0][0, 1:].astype(int).tolist() != position:
+            width, height = BACKEND.screen_size()
+            rng = self._rng()
+            targets = numpy.column_stack([
+                rng.randint(0, width, batch), rng.randint(0, height, batch)
+            ])
+            self.pending = collections.deque(
+                self.plan(position, targets, (width, height))
+            )
+        path = self.pending.popleft()
+        TRACE.record("move", x=int(path[-1, 1]), y=int(path[-1, 2]))
+        return self.replay(path)
+
+
+MOUSE_MOVER = MouseMover()
+
+
+Image = LazyModule("PIL.Image")
+
+# Reference images of what the interactions click on, "<name>.png" per
+# target. Can be overridden with the "human.templates" option.
+TEMPLATE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "templates")
+
+
+def downscale(image):
+    # Halves both dimensions by averaging 2x2 blocks.
+    height, width = image.shape[0] // 2 * 2, image.shape[1] // 2 * 2
+    return image[:height, :width].reshape(
+        height // 2, 2, width // 2, 2
+    ).mean(axis=(1, 3))
+
+
+def ncc_map(image, template):
+    # Normalized cross-correlation of the template at every position in the
+    # image, using integral images for the window means and deviations.
+    np = numpy
+    th, tw = template.shape
+    height, width = image.shape[0] - th + 1, image.shape[1] - tw + 1
+    if height <= 0 or width <= 0:
+        return None
+
+    zero_mean = template - template.mean()
+    norm = np.sqrt((zero_mean ** 2).sum())
+    windows = np.lib.stride_tricks.as_strided(
+        image, shape=(height, width, th, tw), strides=image.strides * 2
+    )
+    numerator = np.einsum("ijkl,kl->ij", windows, zero_mean)
+
+    def box(values):
+        integral = np.zeros((values.shape[0] + 1, values.shape[1] + 1))
+        integral[1:, 1:] = values.cumsum(0).cumsum(1)
+        return (integral[th:, tw:] - integral[:-th, tw:] -
+                integral[th:, :-tw] + integral[:-th, :-tw])
+
+    count = float(th * tw)
+    sums = box(image)
+    variance = box(image ** 2) - sums ** 2 / count
+    return numerator / (np.sqrt(np.maximum(variance, 1e-9)) * max(norm, 1e-9))
+
+
+class VisualLocator(object):
+    """Finds on-screen targets by a reference image instead of by fixed
+    coordinates. Templates are loaded once and kept as grayscale image
+    pyramids. The screen is only captured within the owning window's
+    rectangle; the location a template was last found at is checked first,
+    otherwise the best normalized cross-correlation is searched for at the
+    coarsest level and the few best candidates are refined level by level.
+    When a template is missing
+    or does not match, the caller's fallback coordinates are used."""
+
+    MIN_SIZE = 8
+    MAX_LEVELS = 3
+
+    def __init__(self, directory=TEMPLATE_DIR, threshold=0.8, radius=2,
+                 candidates=4):
+        self.directory = directory
+        self.threshold = threshold
+        self.radius = radius
+        self.candidates = candidates
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.templates = {}
+        self.recent = {}
+        self.stats = {"recent": 0, "found": 0, "missed": 0, "fallback": 0}
+
+    def register(self, name, image):
+        # Keeps the pyramid of a grayscale image, finest level first.
+        pyramid = [numpy.asarray(image, dtype=float)]
+        while (len(pyramid) <= self.MAX_LEVELS and
+               min(pyramid[-1].shape) // 2 >= self.MIN_SIZE):
+            pyramid.append(downscale(pyramid[-1]))
+        self.templates[name] = pyramid
+        return pyramid
+
+    def template(self, name):
+        with self.lock:
+            if name not in self.templates:
+                path = os.path.join(self.directory, "%s.png" % name)
+                if not os.path.exists(path):
+                    self.templates[name] = None
+                else:
+                    with METRICS.timer("visual.load"):
+                        self.register(name, Image.open(path).convert("L"))
+            return self.templates[name]
+
+    def locate(self, name, rect, fallback=None):
+        # Returns the screen coordinates of the center of the target within
+        # rect, a (left, top, right, bottom) tuple, or the fallback.
+        pyramid = self.template(name) if self.enabled else None
+        image = BACKEND.capture(rect) if pyramid else None
+        found = None
+        if image is not None:
+            image = numpy.asarray(image, dtype=float)
+            with METRICS.timer("visual.locate"):
+                found = self.match(name, pyramid, image)
+
+        if found is None:
+            self.stats["fallback"] += 1
+            return fallback
+
+        th, tw = pyramid[0].shape
+        return rect[0] + found[1] + tw // 2, rect[1] + found[0] + th // 2
+
+    def match(self, name, pyramid, image):
+        # Returns the (y, x) of the template within the image, or None.
+        th, tw = pyramid[0].shape
+        recent = self.recent.get(name)
+        if recent is not None:
+            y, x = recent
+            window = image[y:y + th, x:x + tw]
+            if window.shape == (th, tw):
+                scores = ncc_map(window, pyramid[0])
+                if scores is not None and scores[0, 0] >= self.threshold:
+                    self.stats["recent"] += 1
+                    return recent
+
+        images = [image]
+        for _ in pyramid[1:]:
+            images.append(downscale(images[-1]))
+
+        # Exhaustive search at the coarsest level only.
+        top = len(pyramid) - 1
+        scores = ncc_map(images[top], pyramid[top])
+        if scores is None:
+            self.stats["missed"] += 1
+            return None
+
+        best, score = None, -1.0
+        for y, x in self.peaks(scores, pyramid[top].shape):
+            # Then only around the estimate on every finer level.
+            candidate = self.refine(pyramid, images, top, y, x, scores[y, x])
+            if candidate is not None and candidate[2] > score:
+                best, score = candidate[:2], candidate[2]
+
+        if best is None or score < self.threshold:
+            self.stats["missed"] += 1
+            return None
+
+        y, x = best
+        self.stats["found"] += 1
+        self.recent[name] = int(y), int(x)
+        return self.recent[name]
+
+    def peaks(self, scores, shape):
+        # The best positions, at least half a template apart.
+        scores = scores.copy()
+        th, tw = max(shape[0] // 2, 1), max(shape[1] // 2, 1)
+        for _ in range(self.candidates):
+            y, x = numpy.unravel_index(numpy.argmax(scores), scores.shape)
+            if scores[y, x] == -numpy.inf:
+                break
+            yield y, x
+            scores[max(y - th, 0):y + th + 1, max(x - tw, 0):x + tw + 1] = -numpy.inf
+
+    def refine(self, pyramid, images, level, y, x, score):
+        for level in range(level - 1, -1, -1):
+            th, tw = pyramid[level].shape
+            y0 = max(2 * y - self.radius, 0)
+            x0 = max(2 * x - self.radius, 0)
+            crop = images[level][
+                y0:2 * y + self.radius + th, x0:2 * x + self.radius + tw
+            ]
+            scores = ncc_map(crop, pyramid[level])
+            if scores is None:
+                return None
+            dy, dx = numpy.unravel_index(numpy.argmax(scores), scores.shape)
+            y, x, score = y0 + dy, x0 + dx, scores[dy, dx]
+        return y, x, score
+
+
+VISUAL = VisualLocator()
+
+
+# Where to click on a window for the named target. "window" is a pywinauto
+# wrapper; "fallback" are the coordinates that used to be hard-coded.
+def locate_visual(name, window, fallback):
+    rect = window.rectangle()
+    return VISUAL.locate(
+        name, (rect.left, rect.top, rect.right, rect.bottom), fallback
+    )
+
+
+# Recordings of real sessions are a header followed by records, each a prefix
+# of the milliseconds since the previous record and its type, then the
+# fields of that type. Gaps longer than a prefix can hold are padded with
+# idle records.
+RECORDING_MAGIC = b"HREC"
+RECORDING_VERSION = 1
+RECORDING_HEADER = struct.Struct("<4sBHH")
+RECORD_PREFIX = struct.Struct("<HB")
+REC_IDLE, REC_MOVE, REC_DOWN, REC_UP, REC_WINDOW = range(5)
+RECORD_FIELDS = {
+    REC_IDLE: struct.Struct("<"),
+    REC_MOVE: struct.Struct("<hh"),
+    REC_DOWN: struct.Struct("<B"),
+    REC_UP: struct.Struct("<B"),
+    REC_WINDOW: struct.Struct("<hhhh"),
+}
+
+
+class SessionRecorder(object):
+    """Records what a real user does on the desktop: the cursor, the mouse
+    buttons and keys are polled every "interval" seconds and every change is
+    written as a record, as is the rectangle of the foreground window when it
+    moves or another window comes to the front."""
+
+    def __init__(self, path, interval=0.01):
+        self.path = path
+        self.interval = interval
+        self.records = 0
+
+    def record(self, duration, stopped=None):
+        stopped = stopped or threading.Event()
+        width, height = BACKEND.screen_size()
+        with open(self.path, "wb") as f:
+            f.write(RECORDING_HEADER.pack(
+                RECORDING_MAGIC, RECORDING_VERSION, width, height
+            ))
+            self.f, self.last = f, BACKEND.time()
+            position, pressed, rect = None, set(), None
+            end = self.last + duration
+            while BACKEND.time() < end and not stopped.is_set():
+                current = BACKEND.foreground_rect()
+                if current is not None and current != rect:
+                    self.write(REC_WINDOW, *current)
+                rect = current
+
+                cursor = BACKEND.cursor_position()
+                if cursor != position:
+                    self.write(REC_MOVE, *cursor)
+                position = cursor
+
+                keys = BACKEND.pressed_keys()
+                for vk in sorted(keys - pressed):
+                    self.write(REC_DOWN, vk)
+                for vk in sorted(pressed - keys):
+                    self.write(REC_UP, vk)
+                pressed = keys
+                BACKEND.wait(stopped, self.interval)
+        return self.records
+
+    def write(self, kind, *fields):
+        elapsed = int(round((BACKEND.time() - self.last) * 1000))
+        while elapsed > 0xFFFF:
+            self.f.write(RECORD_PREFIX.pack(0xFFFF, REC_IDLE))
+            elapsed -= 0xFFFF
+        self.f.write(RECORD_PREFIX.pack(elapsed, kind))
+        self.f.write(RECORD_FIELDS[kind].pack(*fields))
+        # Rounding errors don't add up as the next delay is measured from
+        # the recorded time.
+        self.last += elapsed / 1000.0
+        self.records += 1
+
+
+class Recording(object):
+    """A session recording, read straight out of a memory map so that long
+    recordings are streamed instead of loaded. Iterating gives (seconds since
+    the start, type, fields) for every record. A recording that is not one,
+    or ends in the middle of a record, raises ValueError."""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < RECORDING_HEADER.size:
+            self.close()
+            raise ValueError("%s is not a session recording" % path)
+
+        magic, version, self.width, self.height = RECORDING_HEADER.unpack_from(self.map)
+        if magic != RECORDING_MAGIC or version != RECORDING_VERSION or \
+                not self.width or not self.height:
+            self.close()
+            raise ValueError("%s is not a session recording" % path)
+
+    def close(self):
+        self.map.close()
+
+    def __iter__(self):
+        offset, at, size = RECORDING_HEADER.size, 0.0, len(self.map)
+        while offset < size:
+            if offset + RECORD_PREFIX.size > size:
+                raise ValueError("Truncated record at offset %d" % offset)
+            elapsed, kind = RECORD_PREFIX.unpack_from(self.map, offset)
+            if kind not in RECORD_FIELDS:
+                raise ValueError("Unknown record type %d at offset %d" % (kind, offset))
+            offset += RECORD_PREFIX.size
+            if offset + RECORD_FIELDS[kind].size > size:
+                raise ValueError("Truncated record at offset %d" % offset)
+            fields = RECORD_FIELDS[kind].unpack_from(self.map, offset)
+            offset += RECORD_FIELDS[kind].size
+            at += elapsed / 1000.0
+            if kind != REC_IDLE:
+                yield at, kind, fields
+
+
+class SessionPlayer(object):
+    """Replays a recording onto the current desktop. Coordinates are scaled
+    from the recorded screen to RESOLUTION; within the window that was in
+    the foreground they are mapped onto "rect" instead, the window the
+    replay is meant for, if given. Idle gaps are cut to "max_idle" seconds
+    and everything is sped up "speed" times. Events less than "batch"
+    seconds apart are sent together. The recording is streamed, never held
+    in memory as a whole."""
+
+    def __init__(self, speed=1.0, max_idle=2.0, batch=0.008):
+        self.speed = speed
+        self.max_idle = max_idle
+        self.batch = batch
+
+    def timeline(self, recording):
+        # The records with their time as they will be replayed.
+        at, previous = 0.0, 0.0
+        for when, kind, fields in recording:
+            at += min(when - previous, self.max_idle) / self.speed
+            previous = when
+            yield at, kind, fields
+
+    def schedule(self, recording, rect=None):
+        # Yields (seconds since the start, type, fields) of the events to
+        # replay.
+        width, height = BACKEND.screen_size()
+        scale = float(width) / recording.width, float(height) / recording.height
+        window = None
+        for at, kind, fields in self.timeline(recording):
+            if kind == REC_WINDOW:
+                window = fields
+            elif kind == REC_MOVE:
+                yield at, kind, self.remap(fields, scale, window, rect)
+            else:
+                yield at, kind, fields
+
+    def remap(self, point, scale, window, rect):
+        x, y = point
+        if rect is not None and window is not None:
+            left, top, right, bottom = window
+            if left <= x < right and top <= y < bottom:
+                return (
+                    rect[0] + (x - left) * (rect[2] - rect[0]) // (right - left),
+                    rect[1] + (y - top) * (rect[3] - rect[1]) // (bottom - top),
+                )
+        return int(x * scale[0]), int(y * scale[1])
+
+    def duration(self, recording):
+        last = 0.0
+        for at, kind, _ in self.timeline(recording):
+            if kind != REC_WINDOW:
+                last = at
+        return last
+
+    def replay(self, recording, rect=None):
+        # Keys and buttons that are still down when the replay ends, or is
+        # cancelled, are released.
+        events = self.schedule(recording, rect)
+        event = next(events, None)
+        started, count, pressed = BACKEND.time(), 0, set()
+        with INPUT_LOCK, high_resolution_timer():
+            try:
+                while event is not None:
+                    due, points = event[0], []
+                    delay = started + due - BACKEND.time()
+                    if delay > 0:
+                        WAITS.check("replay")
+                        BACKEND.sleep(delay)
+
+                    while event is not None and event[0] - due <= self.batch:
+                        _, kind, fields = event
+                        if kind == REC_MOVE:
+                            points.append(fields)
+                        else:
+                            if points:
+                                BACKEND.move_cursor(points)
+                                points = []
+                            BACKEND.press(fields[0], kind == REC_DOWN)
+                            if kind == REC_DOWN:
+                                pressed.add(fields[0])
+                            else:
+                                pressed.discard(fields[0])
+                        count += 1
+                        event = next(events, None)
+                    if points:
+                        BACKEND.move_cursor(points)
+            finally:
+                for vk in sorted(pressed):
+                    BACKEND.press(vk, False)
+
+        METRICS.count("replay.events", count)
+        return count
+
+
+# How to find or start every application. "process" is the image name of an
+# existing session to connect to, "main" the criteria of its main window.
+APPLICATIONS = {
+    "notepad": {
+        "process": "notepad.exe",
+        # For some reason, starting a new Notepad session did not work with ".*Notepad*." so here we are.
+        "command": r"notepad.exe",
+        "main": {"best_match": "UntitledNotepad"},
+    },
+    "acrobat": {
+        "process": "AcroRD32.exe",
+        "command": r"C:\Program Files (x86)\Adobe\Acrobat Reader DC\Reader\AcroRD32.exe",
+        "main": {"class_name": "AcrobatSDIWindow"},
+        # The main window belongs to another process than the one we started.
+        "reconnect": {"title": "Adobe Acrobat Reader DC (32-bit)"},
+    },
+    "word": {
+        "process": "WINWORD.exe",
+        "command": r"C:\Program Files (x86)\Microsoft Office\Office12\WINWORD.exe",
+        # "Document 1 - Microsoft Word non-commercial use"
+        "main": {"best_match": "Document1MicrosoftWord"},
+    },
+    "calculator": {
+        "process": "calc.exe",
+        "command": r"C:\Windows\System32\calc.exe",
+        "main": {"title": "Calculator"},
+    },
+    "paint": {
+        "command": r"C:\Windows\System32\mspaint.exe",
+        "main": {"title_re": ".* - Paint"},
+    },
+    "ie": {
+        "command": r"C:\Program Files (x86)\Internet Explorer\iexplore.exe https://google.com",
+        "main": {"title_re": "Google - Windows Internet Explorer"},
+        "timeout": 100,
+    },
+    "vlc": {
+        "process": "vlc.exe",
+        "command": r"C:\Program Files\VideoLAN\VLC\vlc.exe",
+        "main": {"title_re": ".*VLC media player"},
+    },
+}
+
+SW_SHOWMINNOACTIVE = 7
+
+class Session(object):
+    """An application we are connected to, with its main window, the
+    locator cache for this session and its process id."""
+
+    def __init__(self, name, app, main, locator, connected, pid=None):
+        self.name = name
+        self.app = app
+        self.main = main
+        self.locator = locator
+        self.connected = connected
+        self.pid = pid
+
+
+def launch(name, background=False):
+    TRACE.record("launch", title=name)
+    with METRICS.timer("%s.launch" % name):
+        return _launch(name, background)
+
+
+def _launch(name, background):
+    # Connect to an existing session of the application, or start a new one,
+    # and wait for its main window. In the background, applications are
+    # started minimized without being activated so they don't take the
+    # focus away from the interaction that is running.
+    config = APPLICATIONS[name]
+    timeout = config.get("timeout", 20)
+    locator = LocatorCache()
+
+    pids = PROCESS_TABLE.pids(config["process"]) if "process" in config else []
+    if pids:
+        log.info("%s session already exists. Connecting...", name)
+        # We are using the UIA backend here, which is the cornerstone of modern pywinauto
+        # and makes some things easier for developers.
+        app = application.Application(backend="uia").connect(process=pids[0], timeout=timeout)
+    elif background:
+        log.info("Starting a new %s session in the background...", name)
+        startupinfo = subprocess.STARTUPINFO()
+        startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
+        startupinfo.wShowWindow = SW_SHOWMINNOACTIVE
+        process = subprocess.Popen(config["command"], startupinfo=startupinfo)
+        app = application.Application(backend="uia").connect(process=process.pid, timeout=timeout)
+        PROCESS_TABLE.invalidate()
+    else:
+        log.info("%s session does not exist. Starting a new one...", name)
+        app = application.Application(backend="uia").start(config["command"], timeout=timeout)
+        PROCESS_TABLE.invalidate()
+
+    if "reconnect" in config and not pids:
+        locator.get(
+            "%s.launch" % name, pywinauto.Desktop(backend="uia").window(**config["reconnect"]),
+            timeout, ready=False
+        )
+        app.connect(**config["reconnect"])
+
+    main = app.window(**config["main"])
+    locator.get("%s.main" % name, main, timeout, ready=False)
+    log.info("Connected to %s.", name)
+    return Session(name, app, main, locator, bool(pids), app.process)
+
+
+class Launcher(threading.Thread):
+    """Launches an application in the background while the current
+    interaction is still running. "done" is called with the launcher once
+    the launch finished, whether it succeeded or not."""
+
+    def __init__(self, name, launch=launch, done=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.name = name
+        self.launch = launch
+        self.done = done
+        self.session = None
+        self.started = self.finished = None
+
+    def run(self):
+        self.started = BACKEND.time()
+        try:
+            with GOVERNOR.metered():
+                self.session = self.launch(self.name, background=True)
+        except Exception:
+            log.exception("Error launching %s in the background", self.name)
+        finally:
+            self.finished = BACKEND.time()
+            if self.done is not None:
+                self.done(self)
+
+    def result(self):
+        # None if the launch failed, the interaction then launches the
+        # application itself.
+        self.join()
+        return self.session
+
+
+class AppPool(object):
+    """Keeps the applications of the planned interactions warm. They are
+    launched up front, minimized, in the order they are needed and no more
+    than "concurrency" at a time, so a small guest is not swamped while the
+    sample starts. Their sessions are handed to the interactions as they
+    run; an application whose launch has not begun by then is left to its
+    interaction. Applications that were started for the pool but never
+    handed out are killed on release(), also when they finish launching
+    afterwards; sessions that already existed are left alone."""
+
+    def __init__(self, launch=launch, concurrency=1):
+        self.launch = launch
+        self.concurrency = concurrency
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.launchers = {}
+            self.waiting = collections.deque()
+            self.running = 0
+            self.released = False
+            self.stats = {
+                "launched": 0, "failed": 0, "taken": 0, "missed": 0,
+                "released": 0, "launch": 0.0, "max_launch": 0.0, "wait": 0.0,
+                "saved": 0.0,
+            }
+
+    def start(self, names):
+        # Queues the applications that are not pooled yet.
+        with self.lock:
+            self.released = False
+            for name in names:
+                if name not in self.launchers and name not in self.waiting:
+                    self.waiting.append(name)
+            self._fill()
 
-from pywinauto.application import Application
-from pywinauto import Desktop, ElementNotFoundError, WindowNotFoundError, mouse
-import pyautogui, subprocess, random, os
+    def _fill(self):
+        # Starts the next launches, with the lock held.
+        while self.waiting and self.running < self.concurrency:
+            name = self.waiting.popleft()
+            self.launchers[name] = Launcher(name, self.launch, self.launched)
+            self.launchers[name].start()
+            self.running += 1
 
-from lib.common.abstracts import Auxiliary
-from lib.common.defines import (
-    KERNEL32, USER32, WM_GETTEXT, WM_GETTEXTLENGTH, WM_CLOSE, BM_CLICK,
-    EnumWindowsProc, EnumChildProc, create_unicode_buffer
-)
+    def launched(self, launcher):
+        latency = launcher.finished - launcher.started
+        METRICS.observe("pool.launch", latency)
+        with self.lock:
+            self.running -= 1
+            self.stats["launched" if launcher.session else "failed"] += 1
+            self.stats["launch"] += latency
+            self.stats["max_launch"] = max(self.stats["max_launch"], latency)
+            idle = self.released and self.launchers.get(launcher.name) is launcher
+            if idle:
+                del self.launchers[launcher.name]
+            else:
+                self._fill()
+        if idle:
+            self.close(launcher.session)
 
-# Cuckoo stuff
-log = logging.getLogger(__name__)
+    def take(self, name):
+        # The session of the pooled application, once it has launched, or
+        # None if it was not pooled, its launch did not begin yet or failed.
+        with self.lock:
+            if name in self.waiting:
+                self.waiting.remove(name)
+                self.stats["missed"] += 1
+            launcher = self.launchers.pop(name, None)
+        if launcher is None:
+            return None
 
-# Cuckoo stuff
-RESOLUTION = {
-    "x": USER32.GetSystemMetrics(0),
-    "y": USER32.GetSystemMetrics(1)
+        started = BACKEND.time()
+        session = launcher.result()
+        waited = BACKEND.time() - started
+        METRICS.observe("pool.wait", waited)
+        with self.lock:
+            self.stats["wait"] += waited
+            if session is not None:
+                self.stats["taken"] += 1
+                self.stats["saved"] += max(launcher.finished - launcher.started - waited, 0)
+        return session
+
+    def release(self):
+        with self.lock:
+            self.released = True
+            self.waiting.clear()
+            idle = [
+                launcher for launcher in self.launchers.values()
+                if launcher.finished is not None
+            ]
+            for launcher in idle:
+                del self.launchers[launcher.name]
+        for launcher in idle:
+            self.close(launcher.session)
+
+    def close(self, session):
+        if session is None or session.connected:
+            return
+
+        log.info("Closing the unused %s session.", session.name)
+        try:
+            session.app.kill()
+        except Exception:
+            log.exception("Error closing %s", session.name)
+        PROCESS_TABLE.invalidate()
+        with self.lock:
+            self.stats["released"] += 1
+
+    def pids(self):
+        # The processes of the sessions that launched and were not taken.
+        with self.lock:
+            return set(
+                launcher.session.pid for launcher in self.launchers.values()
+                if launcher.session is not None
+            )
+
+    def report(self):
+        with self.lock:
+            report = dict(self.stats)
+            report["pending"] = len(self.launchers) + len(self.waiting)
+        report["launch"] /= max(report["launched"] + report["failed"], 1)
+        return report
+
+
+APP_POOL = AppPool()
+
+
+# Where the session plan is uploaded to, so the run can be replayed with
+# the "human.plan" option.
+PLAN_PATH = "logs/human_plan.json"
+
+# Rough duration of every interaction, in seconds, used to fit the plan into
+# the analysis timeout.
+INTERACTION_ESTIMATES = {
+    "notepad": 60,
+    "paint": 45,
+    "word": 90,
+    "acrobat": 60,
+    "ie": 100,
+    "calculator": 45,
+    "vlc": 70,
 }
 
+# Interactions that need the output of another one, e.g., Acrobat converts
+# the text file Notepad saved.
+INTERACTION_REQUIRES = {
+    "acrobat": "notepad",
+}
 
-# Cuckoo Module
-def click(hwnd):
-    USER32.SetForegroundWindow(hwnd)
-    KERNEL32.Sleep(1000)
-    USER32.SendMessageW(hwnd, BM_CLICK, 0, 0)
+# Kinds of samples, by analysis package or file extension, in the order
+# they are checked.
+SAMPLE_KINDS = [
+    ("office", (
+        ["doc", "xls", "ppt", "pub"],
+        [".doc", ".docx", ".docm", ".dot", ".dotm", ".rtf", ".xls", ".xlsx",
+         ".xlsm", ".xlsb", ".ppt", ".pptx", ".pptm", ".pps", ".ppsx", ".pub"],
+    )),
+    ("pdf", (["pdf"], [".pdf"])),
+    ("url", (["ie", "ff", "chrome", "edge"], [".url", ".htm", ".html", ".mht"])),
+    ("script", (
+        ["js", "jse", "vbs", "vbe", "wsf", "ps1", "bat", "hta"],
+        [".js", ".jse", ".vbs", ".vbe", ".wsf", ".ps1", ".bat", ".cmd", ".hta"],
+    )),
+    ("executable", (
+        ["exe", "dll", "msi", "cpl", "generic"],
+        [".exe", ".dll", ".msi", ".scr", ".com", ".cpl"],
+    )),
+]
 
+# Interactions that are relevant to every kind of sample, most relevant
+# first. Can be overridden per kind with the "human.interactions.<kind>"
+# option, e.g., "human.interactions.pdf=notepad,acrobat". Samples of any
+# other kind get every enabled interaction.
+SAMPLE_INTERACTIONS = {
+    "office": ["word", "notepad"],
+    # Acrobat converts the file Notepad saved.
+    "pdf": ["notepad", "acrobat"],
+    "url": ["ie"],
+    "script": ["notepad", "calculator"],
+    "executable": ["notepad", "calculator", "paint"],
+}
 
-# Cuckoo module
-def foreach_child(hwnd, lparam):
-    # List of partial buttons labels to click.
-    buttons = [
-        "yes", "oui",
-        "ok",
-        "i accept",
-        "next", "suivant",
-        "new", "nouveau",
-        "install", "installer",
-        "file", "fichier",
-        "run", "start", "marrer", "cuter",
-        "extract",
-        "i agree", "accepte",
-        "enable", "activer", "accord", "valider",
-        "don't send", "ne pas envoyer",
-        "don't save",
-        "continue", "continuer",
-        "personal", "personnel",
-        "scan", "scanner",
-        "unzip", "dezip",
-        "open", "ouvrir",
-        "close the program",
-        "execute", "executer",
-        "launch", "lancer",
-        "save", "sauvegarder",
-        "download", "load", "charger",
-        "end", "fin", "terminer",
-        "later",
-        "finish",
-        "end",
-        "allow access",
-        "remind me later",
-        "save", "sauvegarder"
-    ]
 
-    # List of complete button texts to click. These take precedence.
-    buttons_complete = [
-        "&Ja",  # E.g., Dutch Office Word 2013.
-    ]
+def sample_kind(options, analyzer):
+    # The analysis package and target, if the analyzer has a config.
+    config = getattr(analyzer, "config", None)
+    if getattr(config, "category", None) == "url":
+        return "url"
 
-    # List of buttons labels to not click.
-    dontclick = [
-        "don't run",
-        "i do not accept"
-    ]
+    package = options.get("human.package") or getattr(config, "package", None) or ""
+    target = getattr(config, "file_name", None) or getattr(config, "target", None) or ""
+    extension = os.path.splitext(target)[1].lower()
+    for kind, (packages, extensions) in SAMPLE_KINDS:
+        if package in packages or extension in extensions:
+            return kind
 
-    classname = create_unicode_buffer(50)
-    USER32.GetClassNameW(hwnd, classname, 50)
 
-    # Check if the class of the child is button.
-    if "button" in classname.value.lower():
-        # Get the text of the button.
-        length = USER32.SendMessageW(hwnd, WM_GETTEXTLENGTH, 0, 0)
-        text = create_unicode_buffer(length + 1)
-        USER32.SendMessageW(hwnd, WM_GETTEXT, length + 1, text)
+SENTENCES = [
+    "Hello! This program is typing.",
+    "Lorem ipsum dolor sit amet, consectetur adipiscing elit.",
+    "Please find the quarterly figures attached.",
+    "Remember to call the bank before Friday.",
+    "The meeting has been moved to next Tuesday at ten.",
+    "Anyways, this is the third line. Bye!",
+    "Shopping list: milk, eggs, bread and coffee.",
+    "I will send the signed contract tomorrow morning.",
+]
 
-        if text.value in buttons_complete:
-            log.info("Found button %r, clicking it" % text.value)
-            click(hwnd)
-            return True
+SEARCH_QUERIES = [
+    "cat videos", "weather tomorrow", "cheap flights to lisbon",
+    "pasta recipes", "football results", "how to reset my password",
+]
 
-        # Check if the button is set as "clickable" and click it.
-        textval = text.value.replace("&", "").lower()
-        for button in buttons:
-            if button in textval:
-                for btn in dontclick:
-                    if btn in textval:
-                        break
-                else:
-                    log.info("Found button %r, clicking it" % text.value)
-                    click(hwnd)
+CALCULATOR_OPERATIONS = ["+", "-", "*", "/"]
 
-    # Recursively search for childs (USER32.EnumChildWindows).
-    return True
 
+def plan_notepad(rng):
+    return {"text": "\n\n".join(rng.sample(SENTENCES, 2)), "enters": rng.randint(10, 30)}
 
-# Cuckoo module
-# Callback procedure invoked for every enumerated window.
-# Purpose is to close any office window
-def get_office_window(hwnd, lparam):
-    if USER32.IsWindowVisible(hwnd):
-        text = create_unicode_buffer(1024)
-        USER32.GetWindowTextW(hwnd, text, 1024)
-        # TODO Would " - Microsoft (Word|Excel|PowerPoint)$" be better?
-        if re.search("- (Microsoft|Word|Excel|PowerPoint)", text.value):
-            USER32.SendNotifyMessageW(hwnd, WM_CLOSE, None, None)
-            log.info("Closed Office window.")
-    return True
 
+def plan_paint(rng):
+    return {"size": [rng.randint(200, 600), rng.randint(200, 600)]}
 
-# Cuckoo method
-def move_mouse():
-    x = random.randint(0, RESOLUTION["x"])
-    y = random.randint(0, RESOLUTION["y"])
 
-    # Originally was:
-    # USER32.mouse_event(0x8000, x, y, 0, None)
-    # Changed to SetCurorPos, since using GetCursorPos would not detect
-    # the mouse events. This actually moves the cursor around which might
-    # cause some unintended activity on the desktop. We might want to make
-    # this featur optional.
-    USER32.SetCursorPos(x, y)
+def plan_word(rng):
+    return {"lines": rng.sample(SENTENCES, 4), "enters": rng.randint(10, 30)}
 
 
-# Cuckoo method
-def click_mouse():
-    # Move mouse to top-middle position.
-    USER32.SetCursorPos(RESOLUTION["x"] / 2, 0)
-    # Mouse down.
-    USER32.mouse_event(2, 0, 0, 0, None)
-    KERNEL32.Sleep(50)
-    # Mouse up.
-    USER32.mouse_event(4, 0, 0, 0, None)
+def plan_calculator(rng):
+    return {"operations": [
+        [rng.randint(1, 99), rng.choice(CALCULATOR_OPERATIONS), rng.randint(1, 99)]
+        for _ in range(rng.randint(5, 14))
+    ]}
 
 
-# Cuckoo method
-# Callback procedure invoked for every enumerated window.
-def foreach_window(hwnd, lparam):
-    # If the window is visible, enumerate its child objects, looking
-    # for buttons.
-    if USER32.IsWindowVisible(hwnd):
-        USER32.EnumChildWindows(hwnd, EnumChildProc(foreach_child), 0)
-    return True
+def plan_ie(rng):
+    # The scroll position is relative to the search results window.
+    return {
+        "query": rng.choice(SEARCH_QUERIES),
+        "scroll": [round(rng.uniform(0.2, 0.8), 3), round(rng.uniform(0.3, 0.9), 3)],
+    }
 
 
-# -------- START MODIFICATIONS --------
-#
-#
-#
-#
-#
-#
-# -------- GENERAL NOTES --------
-# | Script function |
-#
-# This collection of methods utilizes pywinauto and pyautogui to simulate user interaction across multiple applications:
-# Notepad, Adobe Acrobat PDF Reader, Microsoft Word 2007, Paint, VLC, Internet Explorer, & Calculator.
-# In general, pywinauto is used for most operations since the goal is to directly interact with GUI elements.
-# However, pyautogui is used often for moving and clicking the mouse as well as pressing hotkeys.
-#
-# | Recommendations for future development |
-#
-# TODO: Move some pywinauto calls to their own respective flexible methods so we can use always_wait_until
-# TODO: General changes to make script less dependent on coordinate-based interactions
-# TODO: Optimize CPU usage
-# TODO: More error catching
-#
+def plan_vlc(rng):
+    return {"watch": rng.randint(20, 60)}
 
 
-# Check to see if process exists, if so we can connect to the existing session
-# Conveniently calls Win32 APIs.
-def process_exists(process_name):
-    call = 'TASKLIST', '/FI', 'imagename eq %s' % process_name
-    # use buildin check_output right away
-    output = subprocess.check_output(call).decode()
-    # check in last line for process name
-    last_line = output.strip().split('\r\n')[-1]
-    # because Fail message could be translated
-    return last_line.lower().startswith(process_name.lower())
+# Per interaction, a function that draws its parameters from an rng.
+INTERACTION_PLANNERS = {
+    "notepad": plan_notepad,
+    "paint": plan_paint,
+    "word": plan_word,
+    "calculator": plan_calculator,
+    "ie": plan_ie,
+    "vlc": plan_vlc,
+}
 
 
-# Open notepad, type some lines, save the file.
-def notepad_interaction():
-    # If process exists, connect to process - link Application to Notepad essentially
-    if process_exists("notepad.exe"):
-        print("Notepad session already exists. Connecting...")
+class Planner(object):
+    """Plans a whole session up front from a seed: which interactions run,
+    in which order and when, what they type, and the gaps between the runs
+    of every background task, drawn from a log-normal distribution around
+    its interval. Interactions that would not fit into "budget" seconds are
+    left out. The same seed and arguments always give the same plan, which
+    is a plain dict that serializes to JSON."""
 
-        # We are using the UIA backend here, which is the cornerstone of modern pywinauto
-        # and makes some things easier for developers.
-        # Some Windows applications can be entered as an argument without entering the full path.
-        app = Application(backend="uia").connect(title_re=".*Notepad*")
+    VERSION = 1
 
-        # Here we will create a dialog instance based off of Notepad's foremost window.
-        app_dialog = app.top_window()
+    # Mean think time between two interactions, in seconds.
+    THINK_TIME = 5.0
 
-        # Make sure that it has focus
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title='Untitled - Notepad', visible_only=False).restore()
-        print("Connected to existing Notepad session.")
+    # Background tasks are planned this far ahead when there is no budget.
+    HORIZON = 3600
 
-    # Else, start a new Notepad process. This general framework will be the same for most methods.
-    else:
-        print("Notepad process does not exist. Creating a new one...")
+    def __init__(self, seed, budget=None):
+        self.seed = seed
+        self.budget = budget
+        self.rng = random.Random(seed)
 
-        # For some reason, starting a new Notepad session did not work with ".*Notepad*." so here we are.
-        app = Application(backend="uia").start(r"notepad.exe", timeout=20)
-        print("Launched new Notepad session.")
+    def gap(self, mean, sigma):
+        # A log-normal inter-arrival time with the given mean.
+        mu = math.log(mean) - sigma ** 2 / 2
+        return round(self.rng.lognormvariate(mu, sigma), 3)
 
-        # This time, we'll create our dialog with more specific instructions since it's a new session.
-        app_dialog = app.window(title_re='Untitled - Notepad', visible_only=False)
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title_re='Untitled - Notepad', visible_only=False).restore()
-
-    # defining main dialog
-    dlg = app.UntitledNotepad
-
-    # This is used a lot throughout the course of the code, so to clarify:
-    # wait_cpu_usage_lower() will force the script to wait until its cpu usage is below a certain amount.
-    # This is especially good for VMs because they more often than not will have less than optimal processing power.
-    app.wait_cpu_usage_lower(threshold=20)
-
-    # type in the box with .1 second delay (Edit is the specific TextArea that we are interacting with)
-    dlg.Edit.type_keys("Hello! This program is typing.\n\n Lorem ipsum dolor sit amet latin latin latin",
-                       with_spaces=True,
-                       with_newlines=True,
-                       pause=.1,
-                       with_tabs=True)
-    n = 0
-
-    # Scroll
-    while n < 30:
-        pyautogui.press('enter')
-        n += 1
-    pyautogui.scroll(1000)
-
-    # Since pywinauto supports it, we can use an easier way of navigating to the Save As window (in Notepad only)
-    dlg['File'].select()
-    submenu = app['']
-    submenu['Save As'].click_input()
-    save_as = dlg.child_window(title_re="Save As", class_name="#32770")
-
-    # We will save this file as TestFile.txt on the Desktop.
-    # Originally, it was to be saved here so we could click on it later with pyautogui but alas, no dice with that.
-    save_as.FileNameCombo.type_keys(os.environ['USERPROFILE'] + "\Desktop\TestFile.txt")
-    save_as.Save.click()
-
-    dlg.close()
-
-
-# WORK IN PROGRESS
-# Opens Acrobat and creates a new PDF.
-def acrobat_interaction():
-    # Start new process - link Application to Acrobat
-    if process_exists("AcroRD32.exe"):
-        print("Acrobat session already exists. Connecting...")
-        app = Application(backend="uia").connect(
-            path=r"C:\Program Files (x86)\Adobe\Acrobat Reader DC\Reader\AcroRD32.exe")
-        app.wait_cpu_usage_lower(threshold=20)
-        app_dialog = app.top_window()
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title='Adobe Acrobat Reader DC (32-bit)', visible_only=False).restore()
-        print("Connected to existing Acrobat session.")
+    def gaps(self, mean, sigma, horizon):
+        gaps, total = [], 0.0
+        while total < horizon:
+            gaps.append(self.gap(mean, sigma))
+            total += gaps[-1]
+        return gaps
 
-    else:
-        print("Acrobat process does not exist. Creating a new one...")
-        app = Application(backend="uia").start(r"C:\Program Files (x86)\Adobe\Acrobat Reader DC\Reader\AcroRD32.exe",
-                                               timeout=20)
-        time.sleep(2)
-        app.wait_cpu_usage_lower(threshold=20)
-        app.connect(title='Adobe Acrobat Reader DC (32-bit)')
-        print("Launched new Acrobat session.")
-
-    app.wait_cpu_usage_lower(threshold=20)
-    adobe = app.window(class_name='AcrobatSDIWindow')
-
-    # Navigate to "Select Files to Convert to PDF" page
-    # we will use click() and set_edit_text() when possible because it allows for
-    # better performance when running multiple analysis machines
-    app_menu = adobe.child_window(title="Application", control_type="MenuBar")
-    app_menu.child_window(title="File").expand()
-    file_menu = adobe.child_window(title="File", control_type="Menu", found_index=0)
-    file_menu.child_window(title="Create PDF").click_input()
-    app.wait_cpu_usage_lower(threshold=20)
-
-    # Adobe doesn't list button as a control identifier, so we have to use pyautogui
-    pyautogui.moveTo(453, 372, 2)
-    pyautogui.click()
-    time.sleep(2)
-
-    app.wait_cpu_usage_lower(threshold=30)
-
-    # Select notepad file
-    file_dlg = app.AdobeAcrobatReaderDC.child_window(title_re="Select Files")
-    file_dlg.FileNameEdit.set_edit_text(os.environ['USERPROFILE'] + '\Desktop\TestFile.txt')
-    pyautogui.press('enter')
-    time.sleep(1)
-    pyautogui.click(x=360, y=436)
-
-    time.sleep(4)
-
-    # This next section is done mostly in pyautogui, because the pywinauto control hierarchy was an absolute mess.
-    # Future work on this program should include more pywinauto code because coordinate based control is shaky at best.
-    pyautogui.click(x=616, y=19)
-    pyautogui.click(x=414, y=227)  # email field
-    pyautogui.write('')  # insert email here
-    pyautogui.click(x=414, y=271)  # pw field
-    pyautogui.write('')  # insert password here
-    pyautogui.click(x=356, y=335)  # sign in
-    pyautogui.click(x=571, y=208)  # open pdf
-
-    # on first open, adobe creates a window that blocks opening pdf.
-    # we'll click on it and then let it navigate to ie, then refocus the window
-    app_dialog.minimize()
-    app_dialog.restore()
-    pyautogui.click(x=571,
-                    y=208)  # on first open, adobe creates a window that blocks opening pdf. we'll click on it and then let it navigate to ie, then refocus the window
-
-    app_dialog.close()
-
-
-# Open word, navigate through the setup, type some lines, scroll, save the file.
-def word_interaction():
-    if process_exists("WINWORD.exe"):
-        print("Word session already exists, connecting...")
-        app = Application(backend="uia").connect(path=r"C:\Program Files (x86)\Microsoft Office\Office12\WINWORD.exe",
-                                                 timeout=20)
-        print("Connected")
-        app.wait_cpu_usage_lower(threshold=30)
-        app_dialog = app.top_window()
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title="Document 1 - Microsoft Word non-commercial use",
-                                      visible_only=False).restore()
-    else:
-        print("Word session does not exist. Starting a new one...")
-        app = Application(backend="uia").start(r"C:\Program Files (x86)\Microsoft Office\Office12\WINWORD.exe",
-                                               timeout=20)
-        app.wait_cpu_usage_lower(threshold=30)
-        app_dialog = app.top_window()
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title="Document 1 - Microsoft Word non-commercial use",
-                                      visible_only=False).restore()
+    def plan(self, interactions, tasks, shuffle=True, selection=None, given=None):
+        # "interactions" are the enabled interaction names, in order unless
+        # shuffled, "tasks" maps the enabled background tasks to their
+        # (interval, jitter). "selection" is recorded as is. "given" maps
+        # interactions to their estimate and parameters, when not drawn; one
+        # given with "compress" is sped up, through its "speed" parameter,
+        # by up to that many times to fit into what is left of the budget.
+        names = list(interactions)
+        if shuffle:
+            self.rng.shuffle(names)
+        for name, required in INTERACTION_REQUIRES.items():
+            if name in names and required in names[names.index(name):]:
+                names.remove(name)
+                names.insert(names.index(required) + 1, name)
 
-        print("Connected.")
+        given = given or {}
+        planned, dropped, at = [], [], 0.0
+        for name in names:
+            gap = self.gap(self.THINK_TIME, 0.5)
+            estimate = INTERACTION_ESTIMATES.get(name, 60)
+            if name in given:
+                estimate = given[name]["estimate"]
+            speedup = 1.0
+            if self.budget and at + gap + estimate > self.budget:
+                left = int(self.budget - at - gap)
+                compress = given.get(name, {}).get("compress", 1.0)
+                if left <= 0 or estimate > left * compress:
+                    dropped.append(name)
+                    continue
+                speedup, estimate = float(estimate) / left, left
 
-    # If this is the first run of Office, it will generate a setup wizard which we can ignore by pressing the cancel button
-    try:
-        setup_dlg = app.Document1MicrosoftWord.child_window(title_re="Microsoft Office Activation Wizard",
-                                                            found_index=0)
-        setup_dlg.child_window(title="Cancel", control_type="Button").click_input()
-    except ElementNotFoundError:
-        pass
-    except WindowNotFoundError:
-        pass
+            planner = INTERACTION_PLANNERS.get(name)
+            if name in given:
+                params = given[name]["params"]
+                if speedup > 1:
+                    params = dict(params, speed=params["speed"] * speedup)
+            else:
+                params = planner(self.rng) if planner else {}
+            planned.append({
+                "name": name,
+                "start": round(at + gap, 3),
+                "estimate": estimate,
+                "params": params,
+            })
+            at += gap + estimate
 
-    # Here we can write!
-    app_dialog.type_keys("This is a test.",
-                         with_spaces=True,
-                         with_newlines=True,
-                         pause=.1,
-                         with_tabs=True)
-    pyautogui.press('enter')
-    app_dialog.type_keys("PyAutoGui is extremely buggy.",
-                         with_spaces=True,
-                         with_newlines=True,
-                         pause=.1,
-                         with_tabs=True)
-    pyautogui.press('enter')
-    pyautogui.press('tab')
-    app_dialog.type_keys("Anyways, this is the third line. Bye!",
-                         with_spaces=True,
-                         with_newlines=True,
-                         pause=.1,
-                         with_tabs=True)
-    pyautogui.doubleClick(x=397, y=466)
-    app_dialog.type_keys("SIKE! I'm still typing but I double clicked beforehand",
-                         with_spaces=True,
-                         with_newlines=True,
-                         pause=.1,
-                         with_tabs=True)
-    # Pressing enter a bunch of times to simulate going to a new page and also for scrolling purposes
-    n = 0
-    while n < 30:
-        pyautogui.press('enter')
-        n += 1
-
-    # Much like the pywinauto scroll module, the pyautogui one similarly works at random. Swap to a different libraryrecommended.
-    pyautogui.scroll(1000)
-    pyautogui.scroll(-1000)
-    pyautogui.scroll(1000)
-
-    # In order: Select all, copy, paste, save
-    pyautogui.hotkey('ctrl', 'a')
-    pyautogui.hotkey('ctrl', 'c')
-    pyautogui.hotkey('ctrl', 'v')
-    pyautogui.hotkey('ctrl', 's')
-
-    app.wait_cpu_usage_lower(threshold=15)
-
-    # Navigate through the Save As dialog
-    save_dlg = app.Document1MicrosoftWord.child_window(title_re="Save As", found_index=0)
-    save_dlg.child_window(title="Save", control_type="Button").click_input()
-
-    app_dialog.close()
-
-
-# Open Calculator, switch to scientific view, do 7 random operations, toggle history.
-def calculator_interaction():
-    if process_exists("calc.exe"):
-        print("Calculator session already exists, connecting...")
-        app = Application(backend="uia").connect(path=r"C:\Windows\System32\calc.exe", timeout=20)
-        print("Connected.")
-        app.wait_cpu_usage_lower(threshold=16)
-        app_dialog = app.top_window()
-        app_dialog.minimize()
-        Desktop(backend="uia").window(title='Calculator', visible_only=False).restore()
-    else:
-        print("Calculator session does not exist. Starting a new one...")
-        app = Application(backend="uia").start(r"C:\Windows\System32\calc.exe", timeout=20)
-        app.wait_cpu_usage_lower(threshold=16)
-        app_dialog = app.top_window()
-        print("Connected.")
-
-    # We will have the program execute a series of mathematical problems.
-    operations_list = ['+', '-', '*', '/']
-    n = 0
-    pyautogui.hotkey('alt', '2')
-    while n < 14:
-        operation = random.choice(operations_list)
-        rnum1 = random.randint(1, 99)
-        rnum2 = random.randint(1, 99)
-        app_dialog.type_keys("" + str(rnum1) + operation + str(rnum2))
-        pyautogui.press('enter')
-        time.sleep(2)
-        n += 1
-
-    # Show history
-    pyautogui.hotkey('ctrl', 'h')
-
-    # Clicking just for the hell of it
-    pyautogui.doubleClick()
-
-    app_dialog.close()
-
-
-# Open paint, open koala.jpg, change image attributes, save and exit
-def paint_interaction():
-    print("MS Paint session does not exist. Starting...")
-    app = Application(backend="uia").start(r"C:\Windows\System32\mspaint.exe", timeout=20)
-    app_dialog = app.window(title_re='.* - Paint', visible_only=False)
-    app_dialog.minimize()
-    Desktop(backend="uia").window(title_re='.* - Paint', visible_only=False).restore()
-    print("Connected.")
-
-    app.wait_cpu_usage_lower(threshold=20)
-
-    # Connecting to the Paint window, and navigating to the Open MenuItem/dialog
-    dlg = app.window(title_re='.* - Paint')
-    dlg.Applicationmenu.click_input()
-    dlg.child_window(title='Open', control_type='MenuItem', found_index=0).invoke()
-    file_dlg = app.UntitledPaint.child_window(title_re="Open", found_index=0)
-    file_dlg.FileNameEdit.set_edit_text('Koala.jpg')
-    pyautogui.press('enter')
-
-    app.wait_cpu_usage_lower(threshold=20)
-
-    # Changing image properties to 350x350
-    pyautogui.hotkey('ctrl', 'e')
-    attribute_dlg = app.KoalaPaint.child_window(title_re="Image Properties")
-    attribute_dlg.child_window(title="Width:", auto_id="264", control_type="Edit").set_edit_text("350")
-    attribute_dlg.child_window(title="Height:", auto_id="266", control_type="Edit").set_edit_text("350")
-    attribute_dlg.child_window(title="OK", auto_id="1", control_type="Button").click_input()
-    pyautogui.hotkey('ctrl', 's')
-
-    app_dialog.close()
-
-
-# Open Internet Explorer,
-def ie_interaction():
-    # We are directing this application to start by connecting to Google
-    app = Application(backend="uia").start(
-        r"C:\Program Files (x86)\Internet Explorer\iexplore.exe {}".format("https://google.com"), timeout=100)
-    app.wait_cpu_usage_lower(threshold=35)
-    ie_dialog = app.window(title_re="Google - Windows Internet Explorer")
-    ie_dialog.minimize()
-    Desktop(backend="uia").window(title_re="Google - Windows Internet Explorer", visible_only=False).restore()
-    time.sleep(4)
-    ie_dialog.set_focus()
-
-    # Pywinauto cannot detect elements of an HTML page, so we have to use coordinate based interaction here.
-    # Future development of pywinauto/some genius developer may change this fact.
-    pyautogui.click(x=305, y=334)
-    ie_dialog.type_keys("cat videos", with_spaces=True)
-    pyautogui.press('enter')
-    app.wait_cpu_usage_lower(threshold=35)
-    newpage_dialog = app.window(title_re="cat videos - Google Search - Windows Internet Explorer")
-
-    # Following pywinauto docs, this should scroll the mouse down the search page.
-    # However, being inconsistent in testing, future versions should include a different library for scrolling
-    ie_rect = newpage_dialog.rectangle()
-    coords = (random.randint(ie_rect.left, ie_rect.right), random.randint(ie_rect.top, ie_rect.bottom))
-    mouse.scroll(coords=coords, wheel_dist=-100)
-
-    newpage_dialog.close()
+        horizon = self.budget or self.HORIZON
+        return {
+            "version": self.VERSION,
+            "seed": self.seed,
+            "budget": self.budget,
+            "interactions": planned,
+            "dropped": dropped,
+            "selection": selection,
+            "tasks": dict(
+                (name, self.gaps(interval, max(float(jitter) / interval, 0.05), horizon))
+                for name, (interval, jitter) in sorted(tasks.items())
+            ),
+        }
 
 
 # Open VLC, open a video from the Sample Videos folder, play the video
-def vlc_interaction():
-    if process_exists("vlc.exe"):
-        print("VLC Media Player session already exists, connecting...")
-        app = Application(backend="uia").connect(path=r"C:\Program Files\VideoLAN\VLC\vlc.exe", timeout=20)
-        app.wait_cpu_usage_lower(threshold=25)
-        app_dialog = app.top_window()
+def vlc_interaction(session=None, params=None):
+    session = session or launch("vlc")
+    params = params or plan_vlc(random)
+    app, main, locator = session.app, session.main, session.locator
+
+    app_dialog = locator.get("vlc.main", main)
+    with INPUT_LOCK:
         app_dialog.minimize()
         app_dialog.restore()
-        print("Connected.")
-    else:
-        print("VLC Media Player session does not exist. Starting a new one...")
-        app = Application(backend="uia").start(r"C:\Program Files\VideoLAN\VLC\vlc.exe", timeout=20)
-        app.wait_cpu_usage_lower(threshold=25)
-        app_dialog = app.top_window()
-        print("Connected.")
 
     # On the first run, privacy dialog will appear. Since (ideally) the vm will be unmodified/unopened applications,
     # we will assume it's there
     try:
         privacy_dlg = app.VLCMediaPlayer.child_window(title_re="Privacy and Network Access Policy", found_index=0)
-        privacy_dlg.print_control_identifiers()
         # invoke because sometimes the window is generated with the bottom cut off
         privacy_dlg.child_window(title="Continue Enter", control_type="Button", found_index=0).invoke()
     except Exception as e:
-        print("Not first run. Privacy dialog does not exist.")
+        log.info("Not first run. Privacy dialog does not exist.")
 
     # Open dialog hotkey
-    pyautogui.hotkey('ctrl', 'o')
+    with INPUT_LOCK:
+        pyautogui.hotkey('ctrl', 'o')
 
     # Swap focus to Open dialog
     # VLC opens the default video folder which contains wmv files, we can open this
-    open_dlg = app_dialog.child_window(title_re="Select one or more files to open")
-    app.wait_cpu_usage_lower(threshold=10)  # Again, if VM was not allotted enough cores, may be script-killing
-    open_dlg.FileNameEdit.set_edit_text("C:\Users\Public\Videos\Sample Videos\Wildlife.wmv")
-    pyautogui.press('enter')  # Load video
-    time.sleep(3)
-    pyautogui.doubleClick(x=300, y=300)  # Another coord-based input, this should press the Play button
-    time.sleep(40)
-    app_dialog.close()
+    open_dlg = main.child_window(title_re="Select one or more files to open")
+    locator.get("vlc.open.filename", open_dlg.FileNameEdit, dialog=1).set_edit_text("C:\Users\Public\Videos\Sample Videos\Wildlife.wmv")
+    with INPUT_LOCK:
+        pyautogui.press('enter')  # Load video
+    locator.get("vlc.wildlife", app.window(title_re="Wildlife.*"))
+    play = locate_visual("vlc.play", app_dialog, (300, 300))
+    with INPUT_LOCK:
+        pyautogui.doubleClick(*play)  # This should press the Play button
+    WAITS.pause("vlc.watch", params["watch"])  # Actually watch the video for a while
+    with METRICS.step("close"):
+        app_dialog.close()
+    PROCESS_TABLE.invalidate()
+
+
+# Replays a recorded session, see SessionRecorder, within the main window of
+# "app" if given, otherwise across the whole screen.
+def replay_interaction(session=None, params=None):
+    params = params or {}
+    if session is None and params.get("app"):
+        session = launch(params["app"])
+
+    rect = None
+    if session is not None:
+        main = session.locator.get("%s.main" % session.name, session.main).rectangle()
+        rect = main.left, main.top, main.right, main.bottom
+
+    recording = Recording(params["path"])
+    try:
+        player = SessionPlayer(params.get("speed", 1.0), params.get("max_idle", 2.0))
+        with METRICS.step("replay"):
+            player.replay(recording, rect)
+    finally:
+        recording.close()
+
+
+# The interactions that are not scenarios, see BUILTIN_SCENARIOS for the
+# others.
+INTERACTIONS = {
+    "vlc": vlc_interaction,
+    "replay": replay_interaction,
+}
+
+
+# Bumped whenever the compiled form changes, so that stale cache entries
+# are not picked up.
+SCENARIO_ENGINE = 4
+
+# Where a scenario can look things up from: the application, its main
+# window, or the whole desktop. Aliases of located elements work too.
+SCENARIO_ROOTS = "app", "main", "desktop"
+
+# Fields every step may have, with their defaults. A step that fails is
+# tried again "retries" times, waiting "backoff" seconds before the first
+# retry and twice as long before every next one; its "timeout" is split
+# over the attempts. If it still fails, it is skipped, or the scenario is
+# aborted when "on_failure" says "abort". Optional steps are skipped at
+# once by default. Steps that refer to an element that was not located are
+# skipped without being tried.
+SCENARIO_COMMON = {
+    "name": None, "optional": False, "retries": None, "backoff": 1.0,
+    "on_failure": None,
+}
+
+# Retries per op, when a step doesn't say. Steps that send input (click,
+# scroll, type, hotkey and save) are not retried by default, as they may
+# have gone through already; the element they act on is still waited for
+# until their timeout. A step that is safe to send again sets "retries".
+SCENARIO_RETRIES = {
+    "launch": 1,
+    "connect": 1,
+    "locate": 2,
+    "wait_for": 2,
+    "close": 2,
+}
+
+# Steps without which nothing else can run abort the scenario by default,
+# as do the ones that locate an element for later steps, unless optional.
+SCENARIO_ABORTS = "launch", "connect"
+
+# Per step, its required fields and the defaults of its optional ones.
+SCENARIO_STEPS = {
+    # Starts the application, or connects to a running one. Applications
+    # that are not in APPLICATIONS can be described inline.
+    "launch": (["app"], {"command": None, "main": None, "process": None, "timeout": 20}),
+    # Connects to an application that must already be running.
+    "connect": (["app"], {}),
+    # Waits for an element to be visible and enabled, and keeps it as "as".
+    # With "focus", its window is minimized and restored first.
+    "locate": (["target"], {"as": None, "timeout": 20, "focus": False}),
+    # Waits for an element to exist, for a file to be written or just for
+    # a number of seconds.
+    "wait_for": ([], {"target": None, "as": None, "file": None, "seconds": None, "timeout": 20}),
+    # Types the text into the target, or sets it on edit controls.
+    "type": (["text"], {"target": None, "set": False, "timeout": 20}),
+    "hotkey": (["keys"], {"repeat": 1}),
+    # Calls "action" on the target, or clicks where the "visual" template is
+    # found within the "within" element, or else at "fallback".
+    "click": ([], {
+        "target": None, "action": "click_input", "visual": None, "within": None,
+        "fallback": None, "double": False, "timeout": 20,
+    }),
+    # Scrolls at "at", relative to the "within" element, or wherever the
+    # cursor is.
+    "scroll": (["clicks"], {"within": None, "at": None}),
+    # Presses the keys, types "path" into the "filename" control, clicks the
+    # "button" and waits for the file to be written.
+    "save": ([], {
+        "keys": ["ctrl", "s"], "filename": None, "path": None, "button": None,
+        "timeout": 20,
+    }),
+    "close": ([], {"target": "window", "timeout": 20}),
+    # Runs its steps for every item of the "each" parameter, as "{item}", or
+    # a number of "times".
+    "repeat": (["steps"], {"each": None, "times": None}),
+}
+
+# The interactions, as scenarios. Strings are formatted with the
+# parameters, the environment as "{env[...]}" and the regular expression
+# escaped parameters as "{escaped[...]}"; "$name" is a parameter as is.
+BUILTIN_SCENARIOS = {
+    "notepad": {
+        "name": "notepad",
+        "steps": [
+            {"op": "launch", "app": "notepad"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "type", "target": {"from": "main", "path": [{"best_match": "Edit"}]},
+             "text": "{text}", "name": "notepad.edit"},
+            {"op": "hotkey", "keys": ["enter"], "repeat": "$enters"},
+            {"op": "scroll", "clicks": 1000},
+            {"op": "click", "target": {"from": "main", "path": [{"best_match": "File"}]},
+             "action": "select", "name": "notepad.menu.file"},
+            {"op": "click", "target": {"from": "app", "path": [{"best_match": ""}, {"best_match": "Save As"}]},
+             "name": "notepad.menu.save_as"},
+            {"op": "save", "keys": None,
+             "filename": {"from": "main", "path": [
+                 {"title_re": "Save As", "dialog": True}, {"best_match": "FileNameCombo"}]},
+             "path": "{env[USERPROFILE]}\\Desktop\\TestFile.txt",
+             "button": {"from": "main", "path": [
+                 {"title_re": "Save As", "dialog": True}, {"best_match": "Save"}]},
+             "name": "notepad.save_as"},
+            {"op": "close"},
+        ],
+    },
+    "acrobat": {
+        "name": "acrobat",
+        "steps": [
+            {"op": "launch", "app": "acrobat"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "click", "action": "expand", "name": "acrobat.menu.file", "target": {"from": "main", "path": [
+                {"title": "Application", "control_type": "MenuBar"}, {"title": "File"}]}},
+            {"op": "click", "name": "acrobat.menu.create_pdf", "target": {"from": "main", "path": [
+                {"title": "File", "control_type": "Menu", "found_index": 0}, {"title": "Create PDF"}]}},
+            {"op": "wait_for", "name": "acrobat.create_pdf", "timeout": 10, "target": {"from": "main", "path": [
+                {"title": "Select a File", "control_type": "Button", "found_index": 0}]}},
+            {"op": "click", "visual": "acrobat.select_files", "within": "window", "fallback": [453, 372]},
+            {"op": "type", "set": True, "name": "acrobat.select_files.filename",
+             "text": "{env[USERPROFILE]}\\Desktop\\TestFile.txt",
+             "target": {"from": "app", "path": [
+                 {"best_match": "AdobeAcrobatReaderDC"},
+                 {"title_re": "Select Files", "dialog": True},
+                 {"best_match": "FileNameEdit"}]}},
+            {"op": "hotkey", "keys": ["enter"]},
+            {"op": "wait_for", "name": "acrobat.selected", "timeout": 10, "target": {"from": "main", "path": [
+                {"title": "Convert", "control_type": "Button", "found_index": 0}]}},
+            {"op": "click", "visual": "acrobat.convert", "within": "window", "fallback": [360, 436]},
+            {"op": "wait_for", "name": "acrobat.converted", "timeout": 30, "target": {"from": "app", "path": [
+                {"title_re": "TestFile.* - Adobe Acrobat Reader DC.*"}]}},
+            {"op": "click", "visual": "acrobat.sign_in_menu", "within": "window", "fallback": [616, 19]},
+            {"op": "click", "visual": "acrobat.email", "within": "window", "fallback": [414, 227]},
+            {"op": "click", "visual": "acrobat.password", "within": "window", "fallback": [414, 271]},
+            {"op": "click", "visual": "acrobat.sign_in", "within": "window", "fallback": [356, 335]},
+            {"op": "click", "visual": "acrobat.open_pdf", "within": "window", "fallback": [571, 208]},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "click", "visual": "acrobat.open_pdf", "within": "window", "fallback": [571, 208]},
+            {"op": "close"},
+        ],
+    },
+    "word": {
+        "name": "word",
+        "steps": [
+            {"op": "launch", "app": "word"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "click", "optional": True, "timeout": 2, "name": "word.setup.cancel",
+             "target": {"from": "main", "path": [
+                 {"title_re": "Microsoft Office Activation Wizard", "found_index": 0},
+                 {"title": "Cancel", "control_type": "Button"}]}},
+            {"op": "type", "target": "window", "text": "{lines[0]}"},
+            {"op": "hotkey", "keys": ["enter"]},
+            {"op": "type", "target": "window", "text": "{lines[1]}"},
+            {"op": "hotkey", "keys": ["enter"]},
+            {"op": "hotkey", "keys": ["tab"]},
+            {"op": "type", "target": "window", "text": "{lines[2]}"},
+            {"op": "click", "visual": "word.body", "within": "window", "fallback": [397, 466], "double": True},
+            {"op": "type", "target": "window", "text": "{lines[3]}"},
+            {"op": "hotkey", "keys": ["enter"], "repeat": "$enters"},
+            {"op": "scroll", "clicks": 1000},
+            {"op": "scroll", "clicks": -1000},
+            {"op": "scroll", "clicks": 1000},
+            {"op": "hotkey", "keys": ["ctrl", "a"]},
+            {"op": "hotkey", "keys": ["ctrl", "c"]},
+            {"op": "hotkey", "keys": ["ctrl", "v"]},
+            {"op": "save", "name": "word.save_as",
+             "filename": {"from": "main", "path": [
+                 {"title_re": "Save As", "dialog": True, "found_index": 0},
+                 {"title": "File name:", "control_type": "Edit"}]},
+             "path": "{env[USERPROFILE]}\\Desktop\\TestFile.docx",
+             "button": {"from": "main", "path": [
+                 {"title_re": "Save As", "dialog": True, "found_index": 0},
+                 {"title": "Save", "control_type": "Button"}]}},
+            {"op": "close"},
+        ],
+    },
+    "calculator": {
+        "name": "calculator",
+        "steps": [
+            {"op": "launch", "app": "calculator"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "hotkey", "keys": ["alt", "2"]},
+            {"op": "repeat", "each": "$operations", "steps": [
+                {"op": "type", "target": "window", "text": "{item[0]}{item[1]}{item[2]}"},
+                {"op": "hotkey", "keys": ["enter"]},
+                {"op": "wait_for", "name": "calculator.result", "target": {"from": "main", "path": [
+                    {"auto_id": "CalculatorExpression",
+                     "title_re": "Expression is {item[0]} \\S {item[2]}="}]}},
+            ]},
+            {"op": "hotkey", "keys": ["ctrl", "h"]},
+            {"op": "click", "double": True},
+            {"op": "close"},
+        ],
+    },
+    "paint": {
+        "name": "paint",
+        "steps": [
+            {"op": "launch", "app": "paint"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True},
+            {"op": "click", "name": "paint.menu",
+             "target": {"from": "main", "path": [{"best_match": "Applicationmenu"}]}},
+            {"op": "click", "action": "invoke", "name": "paint.menu.open",
+             "target": {"from": "main", "path": [{"title": "Open", "control_type": "MenuItem", "found_index": 0}]}},
+            {"op": "type", "set": True, "name": "paint.open.filename",
+             "text": "{env[PUBLIC]}\\Pictures\\Sample Pictures\\Koala.jpg",
+             "target": {"from": "app", "path": [
+                 {"best_match": "UntitledPaint"},
+                 {"title_re": "Open", "dialog": True, "found_index": 0},
+                 {"best_match": "FileNameEdit"}]}},
+            {"op": "hotkey", "keys": ["enter"]},
+            {"op": "locate", "target": {"from": "app", "path": [{"title_re": "Koala.* - Paint"}]},
+             "name": "paint.koala"},
+            {"op": "hotkey", "keys": ["ctrl", "e"]},
+            {"op": "type", "set": True, "text": "{size[0]}", "name": "paint.properties.width",
+             "target": {"from": "app", "path": [
+                 {"best_match": "KoalaPaint"},
+                 {"title_re": "Image Properties", "dialog": True},
+                 {"title": "Width:", "auto_id": "264", "control_type": "Edit"}]}},
+            {"op": "type", "set": True, "text": "{size[1]}", "name": "paint.properties.height",
+             "target": {"from": "app", "path": [
+                 {"best_match": "KoalaPaint"},
+                 {"title_re": "Image Properties", "dialog": True},
+                 {"title": "Height:", "auto_id": "266", "control_type": "Edit"}]}},
+            {"op": "click", "name": "paint.properties.ok",
+             "target": {"from": "app", "path": [
+                 {"best_match": "KoalaPaint"},
+                 {"title_re": "Image Properties", "dialog": True},
+                 {"title": "OK", "auto_id": "1", "control_type": "Button"}]}},
+            {"op": "save", "path": "{env[PUBLIC]}\\Pictures\\Sample Pictures\\Koala.jpg"},
+            {"op": "close"},
+        ],
+    },
+    "ie": {
+        "name": "ie",
+        "steps": [
+            {"op": "launch", "app": "ie"},
+            {"op": "locate", "target": {"from": "main"}, "as": "window", "focus": True, "timeout": 100},
+            {"op": "click", "visual": "ie.search_box", "within": "window", "fallback": [305, 334]},
+            {"op": "type", "target": "window", "text": "{query}"},
+            {"op": "hotkey", "keys": ["enter"]},
+            {"op": "locate", "as": "search", "timeout": 60,
+             "target": {"from": "app", "path": [
+                 {"title_re": "{escaped[query]} - Google Search - Windows Internet Explorer"}]}},
+            {"op": "scroll", "within": "search", "at": "$scroll", "clicks": -100},
+            {"op": "close", "target": "search"},
+        ],
+    },
+}
+
+
+class ScenarioError(ValueError):
+    pass
+
+
+def compile_value(value):
+    # Parameter references and templates are told apart once, here.
+    if isinstance(value, basestring):
+        if value.startswith("$"):
+            return {"param": value[1:]}
+        if "{" in value:
+            return {"format": value}
+    return value
+
+
+def compile_target(target, aliases, where):
+    if target is None:
+        return None
+
+    if isinstance(target, basestring):
+        if target not in aliases:
+            raise ScenarioError("%s: nothing was located as %r before" % (where, target))
+        return target
+
+    if not isinstance(target, dict) or set(target) - set(["from", "path"]):
+        raise ScenarioError("%s: a target is an alias or {\"from\": ..., \"path\": [...]}" % where)
+
+    root = target.get("from", "main")
+    if root in SCENARIO_ROOTS and root not in aliases:
+        raise ScenarioError("%s: launch or connect to an application first" % where)
+    if root not in aliases:
+        raise ScenarioError("%s: unknown root %r" % (where, root))
+
+    path = target.get("path", [])
+    if not isinstance(path, list) or not all(isinstance(criteria, dict) for criteria in path):
+        raise ScenarioError("%s: the path of a target is a list of search criteria" % where)
+    if not path and root in ("app", "desktop"):
+        raise ScenarioError("%s: a target within %s needs a path" % (where, root))
+
+    # "dialog" marks the criteria of a standard dialog, that the win32
+    # backend can find by its class. It is not a search criterion.
+    dialogs = [idx for idx, criteria in enumerate(path) if criteria.get("dialog")]
+    if len(dialogs) > 1:
+        raise ScenarioError("%s: a target goes through one dialog at most" % where)
+
+    return {"from": root, "dialog": dialogs[0] if dialogs else None, "path": [
+        dict(
+            (key, compile_value(value)) for key, value in criteria.items()
+            if key != "dialog"
+        )
+        for criteria in path
+    ]}
+
+
+def target_alias(target):
+    # The located element a compiled target refers to, if any.
+    if isinstance(target, dict):
+        target = target["from"]
+    if target is None or target in SCENARIO_ROOTS:
+        return None
+    return target
+
+
+def compile_steps(name, steps, aliases, where=""):
+    if not isinstance(steps, list) or not steps:
+        raise ScenarioError("%s%s: steps is a non-empty list" % (name, where))
+
+    compiled = []
+    for idx, step in enumerate(steps):
+        at = "%s%s step %d" % (name, where, idx + 1)
+        if not isinstance(step, dict) or step.get("op") not in SCENARIO_STEPS:
+            raise ScenarioError("%s: unknown op %r" % (at, step.get("op") if isinstance(step, dict) else step))
+
+        op = step["op"]
+        required, optional = SCENARIO_STEPS[op]
+        fields = dict(SCENARIO_COMMON, **optional)
+        unknown = set(step) - set(fields) - set(required) - set(["op"])
+        if unknown:
+            raise ScenarioError("%s: unknown fields %s" % (at, ", ".join(sorted(unknown))))
+        missing = [field for field in required if field not in step]
+        if missing:
+            raise ScenarioError("%s: missing fields %s" % (at, ", ".join(missing)))
+
+        fields.update(step)
+        if op in ("launch", "connect"):
+            aliases.update(SCENARIO_ROOTS)
+
+        if fields["retries"] is None:
+            fields["retries"] = 0 if fields["optional"] else SCENARIO_RETRIES.get(op, 0)
+        if fields["on_failure"] is None:
+            aborts = op in SCENARIO_ABORTS or fields.get("as")
+            fields["on_failure"] = "abort" if aborts and not fields["optional"] else "skip"
+        if not isinstance(fields["retries"], int) or fields["retries"] < 0:
+            raise ScenarioError("%s: retries is a number of times" % at)
+        if not isinstance(fields["backoff"], (int, float)) or fields["backoff"] < 0:
+            raise ScenarioError("%s: backoff is a number of seconds" % at)
+        if fields["on_failure"] not in ("skip", "abort"):
+            raise ScenarioError("%s: on_failure is skip or abort" % at)
+
+        fields["needs"] = []
+        for field in ("target", "within", "filename", "button"):
+            if field in fields:
+                fields[field] = compile_target(fields[field], aliases, at)
+                alias = target_alias(fields[field])
+                if alias is not None and alias not in fields["needs"]:
+                    fields["needs"].append(alias)
+        for field in ("text", "repeat", "each", "times", "at", "clicks", "path", "file", "seconds"):
+            if field in fields:
+                fields[field] = compile_value(fields[field])
+
+        if op == "repeat":
+            if (fields["each"] is None) == (fields["times"] is None):
+                raise ScenarioError("%s: repeat needs either each or times" % at)
+            fields["steps"] = compile_steps(name, fields["steps"], aliases, " step %d" % (idx + 1))
+        if op == "wait_for" and [fields["target"], fields["file"], fields["seconds"]].count(None) != 2:
+            raise ScenarioError("%s: wait_for needs one of target, file or seconds" % at)
+        if op == "click" and fields["target"] is not None and fields["visual"] is not None:
+            raise ScenarioError("%s: click either a target or a visual" % at)
+        if op == "click" and fields["visual"] is not None and fields["within"] is None:
+            raise ScenarioError("%s: a visual is looked for within an element" % at)
+        if op == "click" and fields["visual"] is not None and not (
+                isinstance(fields["fallback"], list) and len(fields["fallback"]) == 2 and
+                all(isinstance(value, (int, float)) for value in fields["fallback"])):
+            # Without a template for it, a visual is clicked at its fallback.
+            raise ScenarioError("%s: a visual click needs a fallback [x, y]" % at)
+        if op == "type" and fields["set"] and fields["target"] is None:
+            raise ScenarioError("%s: setting text needs a target" % at)
+
+        if fields["name"] is None:
+            fields["name"] = "%s.%s" % (name, fields.get("as") or "%s%d" % (op, idx + 1))
+        if fields.get("as"):
+            aliases.add(fields["as"])
+        compiled.append(fields)
+    return compiled
+
+
+def compile_scenario(source):
+    # Validates a scenario and resolves its references, with defaults filled
+    # in. Raises ScenarioError on the first problem.
+    if not isinstance(source, dict) or not isinstance(source.get("name"), basestring):
+        raise ScenarioError("A scenario is an object with a name")
+
+    unknown = set(source) - set(["name", "description", "estimate", "params", "steps"])
+    if unknown:
+        raise ScenarioError("%s: unknown fields %s" % (source["name"], ", ".join(sorted(unknown))))
+
+    return {
+        "engine": SCENARIO_ENGINE,
+        "name": source["name"],
+        "estimate": source.get("estimate"),
+        "params": source.get("params", {}),
+        "steps": compile_steps(source["name"], source.get("steps"), set()),
+    }
+
+
+class Scenario(object):
+    """A compiled scenario. Calling it runs the scenario like an interaction,
+    with the session handed to it, if any, and its parameters."""
+
+    def __init__(self, compiled):
+        self.name = compiled["name"]
+        self.estimate = compiled["estimate"]
+        self.params = compiled["params"]
+        self.steps = compiled["steps"]
+
+    def __call__(self, session=None, params=None):
+        if params is None and self.name in INTERACTION_PLANNERS:
+            params = INTERACTION_PLANNERS[self.name](random)
+        ScenarioRun(self, session, dict(self.params, **(params or {}))).run(self.steps)
+
+
+class StepStats(object):
+    """How every scenario step fared over all runs: how often it ran,
+    succeeded, needed retries, was given up on or skipped, and the time it
+    took including its retries, so the steps that waste the most time
+    stand out."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.steps = {}
+
+    def stats(self, name):
+        # With the lock held.
+        return self.steps.setdefault(name, {
+            "runs": 0, "succeeded": 0, "retried": 0, "retries": 0,
+            "failed": 0, "skipped": 0, "seconds": 0.0,
+        })
+
+    def record(self, name, retries, succeeded, elapsed):
+        with self.lock:
+            stats = self.stats(name)
+            stats["runs"] += 1
+            stats["succeeded"] += int(succeeded)
+            stats["failed"] += int(not succeeded)
+            stats["retried"] += int(retries > 0)
+            stats["retries"] += retries
+            stats["seconds"] += elapsed
+
+    def skip(self, name):
+        with self.lock:
+            self.stats(name)["skipped"] += 1
+
+    def report(self):
+        with self.lock:
+            report = dict((name, dict(stats)) for name, stats in self.steps.items())
+        for stats in report.values():
+            stats["success_rate"] = float(stats["succeeded"]) / max(stats["runs"], 1)
+            stats["retry_rate"] = float(stats["retried"]) / max(stats["runs"], 1)
+        return report
+
+
+STEP_STATS = StepStats()
+
+
+class ScenarioRun(object):
+    """One run of a scenario: its session, its parameters and the elements
+    its steps located so far. Every step is a checkpoint: a step that fails
+    is retried on its own, according to its policy, and then skipped or
+    the run is aborted, without running the steps before it again."""
+
+    def __init__(self, scenario, session, params):
+        self.scenario = scenario
+        self.session = session
+        self.context = dict(params)
+        self.context["env"] = os.environ
+        self.context["escaped"] = dict(
+            (key, re.escape(value)) for key, value in params.items()
+            if isinstance(value, basestring)
+        )
+        self.specs = {}
+        self.elements = {}
+        self.completed = 0
+
+    def run(self, steps):
+        for step in steps:
+            self.attempt(step)
+
+    def attempt(self, step):
+        name, retries = step["name"], step["retries"]
+        missing = [alias for alias in step["needs"] if alias not in self.elements]
+        if missing:
+            log.info("Skipping the step %s, %s was not located.", name, ", ".join(missing))
+            STEP_STATS.skip(name)
+            METRICS.count("steps.skipped")
+            return
+
+        started = BACKEND.time()
+        for attempt in range(retries + 1):
+            if attempt:
+                METRICS.count("steps.retries")
+                WAITS.pause("%s.retry" % name, step["backoff"] * 2 ** (attempt - 1))
+                if self.session is not None:
+                    self.session.locator.invalidate(name)
+            try:
+                getattr(self, "do_" + step["op"])(step)
+            except Cancelled:
+                raise
+            except Exception as e:
+                error = e
+                log.warning(
+                    "Step %s failed (attempt %d of %d): %s", name, attempt + 1,
+                    retries + 1, e
+                )
+                continue
+
+            STEP_STATS.record(name, attempt, True, BACKEND.time() - started)
+            self.completed += 1
+            return
+
+        STEP_STATS.record(name, retries, False, BACKEND.time() - started)
+        if step["on_failure"] == "abort":
+            log.warning(
+                "Aborting the %s scenario at step %s, after %d steps.",
+                self.scenario.name, name, self.completed
+            )
+            raise error
+        log.info("Skipping the step %s.", name)
+        METRICS.count("steps.skipped")
+
+    def value(self, value):
+        if isinstance(value, dict):
+            if "param" in value:
+                return self.context[value["param"]]
+            return value["format"].format(**self.context)
+        return value
+
+    def spec(self, target):
+        # A pywinauto window specification for a compiled target.
+        if target["from"] == "desktop":
+            found = pywinauto.Desktop(backend="uia")
+        else:
+            found = self.specs[target["from"]]
+        for idx, criteria in enumerate(target["path"]):
+            criteria = dict((key, self.value(value)) for key, value in criteria.items())
+            if idx == 0 and target["from"] in ("app", "desktop"):
+                found = found.window(**criteria)
+            else:
+                found = found.child_window(**criteria)
+        return found
+
+    def locate(self, name, target, timeout=20, ready=True):
+        # The specification of a compiled target and its element, once it
+        # is there.
+        spec, dialog = self.spec(target), target["dialog"]
+        if dialog is not None:
+            # The path comes last in the criteria of the specification.
+            dialog += len(spec.criteria) - len(target["path"])
+        return spec, self.session.locator.get(
+            name, spec, timeout, ready=ready, dialog=dialog
+        )
+
+    def element(self, target, name, timeout, ready=True):
+        if isinstance(target, basestring):
+            return self.elements[target]
+        return self.locate(name, target, timeout, ready)[1]
+
+    def timeout(self, step):
+        # Every attempt of a step gets its share of the timeout, so that
+        # retries don't add up to several times what the step allows.
+        return float(step["timeout"]) / (step["retries"] + 1)
+
+    def do_launch(self, step):
+        app = step["app"]
+        if step["command"] is not None:
+            APPLICATIONS.setdefault(app, dict(
+                (key, step[key]) for key in ("command", "main", "process", "timeout")
+                if step[key] is not None
+            ))
+        if self.session is None or self.session.name != app:
+            self.session = launch(app)
+        self.specs["app"], self.specs["main"] = self.session.app, self.session.main
+
+    def do_connect(self, step):
+        config = APPLICATIONS.get(step["app"], {})
+        if "process" not in config or not PROCESS_TABLE.pids(config["process"]):
+            raise ScenarioError("%s is not running" % step["app"])
+        self.do_launch(dict(step, command=None))
+
+    def do_locate(self, step):
+        spec, wrapper = self.locate(step["name"], step["target"], self.timeout(step))
+        if step["focus"]:
+            with INPUT_LOCK:
+                wrapper.minimize()
+                wrapper.restore()
+                wrapper.set_focus()
+        if step["as"]:
+            self.specs[step["as"]], self.elements[step["as"]] = spec, wrapper
+
+    def do_wait_for(self, step):
+        if step["seconds"] is not None:
+            WAITS.pause(step["name"], float(self.value(step["seconds"])))
+        elif step["file"] is not None:
+            path, since = self.value(step["file"]), time.time()
+            WAITS.until(step["name"], lambda: file_written(path, since), self.timeout(step))
+        else:
+            # Waits for the target as it is now, not as it was cached.
+            self.session.locator.invalidate(step["name"])
+            spec, wrapper = self.locate(
+                step["name"], step["target"], self.timeout(step), ready=False
+            )
+            if step["as"]:
+                self.specs[step["as"]], self.elements[step["as"]] = spec, wrapper
+
+    def do_type(self, step):
+        wrapper = None
+        if step["target"] is not None:
+            wrapper = self.element(step["target"], step["name"], self.timeout(step))
+        text = self.value(step["text"])
+        if step["set"]:
+            wrapper.set_edit_text(text)
+        else:
+            TYPIST.type(wrapper, text)
+
+    def do_hotkey(self, step):
+        with INPUT_LOCK:
+            for _ in range(int(self.value(step["repeat"]))):
+                pyautogui.hotkey(*step["keys"])
+
+    def do_click(self, step):
+        if step["visual"] is not None:
+            within = self.elements[step["within"]]
+            x, y = locate_visual(step["visual"], within, step["fallback"])
+            with INPUT_LOCK:
+                MOUSE_MOVER.move_to(x, y)
+                (pyautogui.doubleClick if step["double"] else pyautogui.click)(x, y)
+        elif step["target"] is not None:
+            wrapper = self.element(step["target"], step["name"], self.timeout(step))
+            with INPUT_LOCK:
+                if step["double"]:
+                    wrapper.double_click_input()
+                else:
+                    getattr(wrapper, step["action"])()
+        else:
+            with INPUT_LOCK:
+                (pyautogui.doubleClick if step["double"] else pyautogui.click)()
+
+    def do_scroll(self, step):
+        clicks = int(self.value(step["clicks"]))
+        if step["within"] is None:
+            with INPUT_LOCK:
+                pyautogui.scroll(clicks)
+            return
+
+        rect = self.elements[step["within"]].rectangle()
+        fx, fy = self.value(step["at"]) or (0.5, 0.5)
+        coords = (int(rect.left + fx * (rect.right - rect.left)),
+                  int(rect.top + fy * (rect.bottom - rect.top)))
+        with INPUT_LOCK:
+            mouse.scroll(coords=coords, wheel_dist=clicks)
+
+    def do_save(self, step):
+        timeout = self.timeout(step)
+        with METRICS.step("save"):
+            if step["keys"]:
+                with INPUT_LOCK:
+                    pyautogui.hotkey(*step["keys"])
+            path = self.value(step["path"])
+            if step["filename"] is not None:
+                TYPIST.type(self.element(step["filename"], step["name"] + ".filename", timeout), path)
+            saved = time.time()
+            if step["button"] is not None:
+                button = self.element(step["button"], step["name"] + ".save", timeout)
+                with INPUT_LOCK:
+                    button.click_input()
+            if path is not None:
+                WAITS.until(step["name"], lambda: file_written(path, saved), timeout)
+
+    def do_close(self, step):
+        with METRICS.step("close"):
+            self.element(step["target"], step["name"], self.timeout(step)).close()
+        PROCESS_TABLE.invalidate()
+
+    def do_repeat(self, step):
+        if step["each"] is not None:
+            items = self.value(step["each"])
+        else:
+            items = range(int(self.value(step["times"])))
+        for item in items:
+            self.context["item"] = item
+            self.run(step["steps"])
+
+
+class ScenarioLibrary(object):
+    """Loads scenarios by name, from the built-in ones, or from JSON files,
+    and keeps them in memory by that name or path. The guest is reverted
+    after every analysis, so compiled scenarios are only kept on disk, by
+    the hash of their source, when "directory" is given; it has to be part
+    of the guest image to be of any use."""
+
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.loaded = {}
+        self.stats = {"memory": 0, "disk": 0, "compiled": 0}
+
+    def load(self, ref):
+        # "ref" is the name of a built-in scenario or the path of a file.
+        if ref in self.loaded:
+            self.stats["memory"] += 1
+            return self.loaded[ref]
+
+        if ref in BUILTIN_SCENARIOS:
+            source = BUILTIN_SCENARIOS[ref]
+        else:
+            with open(ref) as f:
+                source = json.load(f)
+        self.loaded[ref] = self.compile(source)
+        return self.loaded[ref]
+
+    def compile(self, source):
+        path = compiled = None
+        if self.directory is not None:
+            key = hashlib.sha1(json.dumps(
+                [SCENARIO_ENGINE, source], sort_keys=True
+            ).encode("utf8")).hexdigest()
+            path = os.path.join(self.directory, "%s.json" % key)
+
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    compiled = json.load(f)
+                self.stats["disk"] += 1
+            except ValueError:
+                log.warning("Ignoring the corrupt compiled scenario %s", path)
+
+        if compiled is None:
+            with METRICS.timer("scenario.compile"):
+                compiled = compile_scenario(source)
+            self.stats["compiled"] += 1
+            if path is not None:
+                self.store(path, compiled)
+
+        return Scenario(compiled)
+
+    def store(self, path, compiled):
+        # Written to a temporary file first, so that a concurrent load never
+        # sees half of it.
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            fd, temp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(compiled, f)
+            if os.path.exists(path):
+                os.remove(temp)
+            else:
+                os.rename(temp, path)
+        except (IOError, OSError):
+            log.exception("Unable to cache the compiled scenario %s", path)
+
+
+# Where compiled scenarios are kept by default. The guest is reverted after
+# every analysis, so they are only found there once the directory is part of
+# the guest image: run an analysis with the scenarios in use before taking
+# the snapshot. The "human.scenario_cache" option moves it, or turns it off
+# when empty.
+SCENARIO_CACHE = os.path.join(tempfile.gettempdir(), "human-scenarios")
+
+SCENARIOS = ScenarioLibrary(SCENARIO_CACHE)
+
+
+
+class InteractionWorker(threading.Thread):
+    """Runs one interaction on a thread of its own, so that the session can
+    give up on it once its deadline passes. cancel() makes the waits of the
+    interaction raise Cancelled and kills the application it was handed, so
+    that pywinauto calls blocked on its windows fail. Errors are logged and
+    kept instead of ending the session."""
+
+    def __init__(self, interaction, func, session=None, params=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interaction = interaction
+        self.func = func
+        self.session = session
+        self.params = params
+        self.cancelled = threading.Event()
+        self.error = None
+
+    # The workers that are running and were not abandoned.
+    active = set()
+
+    def run(self):
+        WAITS.local.cancel = self.cancelled
+        InteractionWorker.active.add(self)
+        TRACE.record("interaction", title=self.interaction)
+        try:
+            with GOVERNOR.metered(), METRICS.interaction(self.interaction):
+                self.func(self.session, self.params)
+        except Cancelled:
+            log.info("Cancelled the %s interaction.", self.interaction)
+        except Exception as e:
+            log.exception("Error in the %s interaction", self.interaction)
+            self.error = e
+        finally:
+            WAITS.local.cancel = None
+            InteractionWorker.active.discard(self)
+            TRACE.record("interaction_done", title=self.interaction)
+
+    def cancel(self):
+        # An application that was already running before is not ours to
+        # kill; the interaction is detached from it instead.
+        self.cancelled.set()
+        if self.session is None:
+            return
+
+        if self.session.connected:
+            log.info("Detaching the %s interaction from its session.", self.interaction)
+            self.session.locator.invalidate()
+            return
+
+        try:
+            self.session.app.kill()
+        except Exception:
+            log.exception("Error killing %s", self.interaction)
+        PROCESS_TABLE.invalidate()
+
+    def abandon(self):
+        # Lets the next interactions and the background tasks go on without
+        # this one, which may be stuck holding the input lock.
+        INPUT_LOCK.revoke(self)
+        InteractionWorker.active.discard(self)
 
 
 # Half cuckoo method, half my method
 class Human(threading.Thread, Auxiliary):
     """Human after all"""
 
+    # An interaction is given this many times its estimate to finish, unless
+    # the "human.interaction_timeout" option says otherwise.
+    OVERRUN = 3
+
+    # Seconds a cancelled interaction gets to unwind and let go of the input.
+    CANCEL_GRACE = 5
+
     def __init__(self, options={}, analyzer=None):
         threading.Thread.__init__(self)
         Auxiliary.__init__(self, options, analyzer)
         self.do_run = True
+        self.scheduler = Scheduler(BACKEND.time, BACKEND.wait, GOVERNOR.update)
+        self.plan = None
+        self.interactions = dict(INTERACTIONS)
+        self.scenarios = []
+
+    def start(self):
+        # The whole session is planned before the thread is started, and
+        # the applications the first interactions need start launching
+        # while the analyzer starts up. The analyzer starts regardless.
+        try:
+            self.prepare()
+        except Exception:
+            log.exception("Error preparing the human session, preparing it again once it runs")
+            self.plan = None
+        else:
+            self.prewarm(self.plan["interactions"][:self.prewarm_ahead()])
+        threading.Thread.start(self)
 
     def stop(self):
         self.do_run = False
+        self.scheduler.stop()
+        APP_POOL.release()
+        TRACE.flush()
 
-    def run(self):
-        seconds = 0
+    def finish(self):
+        # Upload a compact summary of where the time went, and the plan so
+        # that the session can be replayed, once the action trace is.
+        TRACE.stop()
+        self.upload_json(METRICS.summary(), METRICS_PATH)
+        if self.plan is not None:
+            self.upload_json(self.plan, PLAN_PATH)
+
+    def upload_json(self, data, dump_path):
+        fd, path = tempfile.mkstemp(suffix=".json")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(data, f, sort_keys=True)
+            upload_to_host(path, dump_path)
+        except Exception:
+            log.exception("Error uploading %s", dump_path)
+        finally:
+            os.remove(path)
 
+    def prepare(self):
         # Global disable flag.
         if "human" in self.options:
             self.do_move_mouse = int(self.options["human"])
@@ -614,42 +4159,391 @@ class Human(threading.Thread, Auxiliary):
         if "human.click_buttons" in self.options:
             self.do_click_buttons = int(self.options["human.click_buttons"])
 
-        while self.do_run:
-            if seconds and not seconds % 60:
-                USER32.EnumWindows(EnumWindowsProc(get_office_window), 0)
+        if "human.time_scale" in self.options:
+            WAITS.scale = float(self.options["human.time_scale"])
+
+        if "human.typing_cpm" in self.options:
+            TYPIST.cpm = float(self.options["human.typing_cpm"])
+
+        if "human.typing_typos" in self.options:
+            TYPIST.typo_rate = float(self.options["human.typing_typos"])
+
+        if "human.typing_fast" in self.options:
+            TYPIST.fast = int(self.options["human.typing_fast"])
+
+        # CPU budget of the auxiliary, as a fraction of a CPU, and the guest
+        # load above which it backs off.
+        GOVERNOR.reset()
+        GOVERNOR.enabled = int(self.options.get("human.governor", 0))
+
+        if "human.cpu_budget" in self.options:
+            GOVERNOR.budget = float(self.options["human.cpu_budget"])
+
+        if "human.busy_load" in self.options:
+            GOVERNOR.busy = float(self.options["human.busy_load"])
+
+        if "human.visual" in self.options:
+            VISUAL.enabled = int(self.options["human.visual"])
+
+        if "human.templates" in self.options:
+            VISUAL.directory = self.options["human.templates"]
+
+        # Seconds between two button clicks, and before the same window is
+        # clicked again.
+        if "human.click_pacing" in self.options:
+            CLICK_QUEUE.pacing = float(self.options["human.click_pacing"])
+
+        if "human.click_cooldown" in self.options:
+            CLICK_QUEUE.cooldown = float(self.options["human.click_cooldown"])
+
+        # How many applications the pool launches at the same time.
+        APP_POOL.reset()
+        if "human.pool_concurrency" in self.options:
+            APP_POOL.concurrency = int(self.options["human.pool_concurrency"])
+
+        # The action trace, and how often it is uploaded.
+        if "human.trace" in self.options:
+            TRACE.enabled = int(self.options["human.trace"])
+
+        if "human.trace_interval" in self.options:
+            TRACE.interval = float(self.options["human.trace_interval"])
+
+        if "human.trace_capacity" in self.options:
+            TRACE.capacity = int(self.options["human.trace_capacity"])
+        TRACE.reset()
+
+        if "human.button_locales" in self.options:
+            BUTTON_MATCHER.load_locales(
+                self.options["human.button_locales"].split(",")
+            )
+
+        # Where compiled scenarios are kept, a directory of the guest image.
+        SCENARIOS.directory = self.options.get("human.scenario_cache", SCENARIO_CACHE) or None
+
+        # Most interactions are built-in scenarios, run as checkpointed steps.
+        self.interactions, self.scenarios = dict(INTERACTIONS), []
+        for name in BUILTIN_SCENARIOS:
+            try:
+                self.interactions[name] = SCENARIOS.load(name)
+            except (IOError, OSError, ValueError):
+                log.exception("Unable to load the %s scenario", name)
+
+        # Scenarios to run instead of the interactions, by built-in name or
+        # path, in order. They replace the interactions of the same name.
+        for ref in filter(None, self.options.get("human.scenarios", "").split(",")):
+            try:
+                scenario = SCENARIOS.load(ref)
+            except (IOError, OSError, ValueError):
+                log.exception("Unable to load the scenario %s", ref)
+                continue
+            self.interactions[scenario.name] = scenario
+            self.scenarios.append(scenario)
+
+        # Plan the session, or replay the plan of an earlier run.
+        if "human.plan" in self.options:
+            with open(self.options["human.plan"]) as f:
+                self.plan = json.load(f)
+        else:
+            self.plan = self.make_plan()
+
+        # Makes the mouse paths and keystroke timings reproducible too.
+        MOUSE_MOVER.seed(self.plan["seed"])
+        TYPIST.rng = random.Random(self.plan["seed"])
+        log.info(
+            "Planned interactions %s (seed %s, left out %s).",
+            ", ".join(entry["name"] for entry in self.plan["interactions"]) or "none",
+            self.plan["seed"], ", ".join(self.plan["dropped"]) or "none"
+        )
+
+    def make_plan(self):
+        interactions = [
+            (self.do_notepad_interaction, "notepad"),
+            (self.do_paint_interaction, "paint"),
+            (self.do_word_interaction, "word"),
+            (self.do_acrobat_interaction, "acrobat"),
+            (self.do_ie_interaction, "ie"),
+            (self.do_calculator_interaction, "calculator"),
+        ]
+        tasks = [
+            (self.do_move_mouse, "move_mouse"),
+            (self.do_click_mouse, "click_mouse"),
+        ]
+
+        if "human.seed" in self.options:
+            seed = int(self.options["human.seed"])
+        else:
+            seed = random.SystemRandom().randint(0, 2 ** 31 - 1)
+
+        names, selection = self.select_interactions([
+            name for enabled, name in interactions
+            if enabled and name in self.interactions
+        ])
+        given = {}
+        if self.scenarios:
+            names = [scenario.name for scenario in self.scenarios]
+            selection = {"scenarios": names}
+            for scenario in self.scenarios:
+                if scenario.name not in INTERACTION_PLANNERS:
+                    given[scenario.name] = {
+                        "estimate": scenario.estimate or INTERACTION_ESTIMATES.get(scenario.name, 60),
+                        "params": scenario.params,
+                    }
+        replay = self.replay_params()
+        if replay is not None:
+            names.append("replay")
+            given["replay"] = replay
+        return Planner(seed, self.budget()).plan(
+            names,
+            dict((name, self.task_interval(name)) for enabled, name in tasks if enabled),
+            shuffle=selection is None, selection=selection, given=given
+        )
+
+    def replay_params(self):
+        # The estimate and parameters of replaying the recording given with
+        # the "human.replay" option, if any.
+        if "human.replay" not in self.options:
+            return None
+
+        params = {
+            "path": self.options["human.replay"],
+            "speed": float(self.options.get("human.replay_speed", 1.0)),
+            "max_idle": float(self.options.get("human.replay_max_idle", 2.0)),
+            "app": self.options.get("human.replay_app"),
+        }
+        try:
+            recording = Recording(params["path"])
+            try:
+                player = SessionPlayer(params["speed"], params["max_idle"])
+                estimate = int(math.ceil(player.duration(recording))) + 5
+            finally:
+                recording.close()
+        except (IOError, OSError, ValueError):
+            log.exception("Unable to read the recording %s", params["path"])
+            return None
+
+        # A recording that does not fit the analysis is sped up, up to
+        # "human.replay_max_speed" times.
+        max_speed = float(self.options.get("human.replay_max_speed", 4.0))
+        return {
+            "estimate": estimate,
+            "params": params,
+            "compress": max(max_speed / params["speed"], 1.0),
+        }
+
+    def select_interactions(self, names):
+        # Only runs the enabled interactions relevant to the sample, most
+        # relevant first. Returns the names and what was selected, if
+        # anything, with the estimated seconds saved.
+        if not names or not int(self.options.get("human.select", 1)):
+            return names, None
+
+        kind = sample_kind(self.options, self.analyzer)
+        if kind is None:
+            return names, None
+
+        relevant = SAMPLE_INTERACTIONS.get(kind, [])
+        if "human.interactions.%s" % kind in self.options:
+            relevant = self.options["human.interactions.%s" % kind].split(",")
+
+        selected = [name for name in relevant if name in names]
+        skipped = [name for name in names if name not in selected]
+        saved = sum(INTERACTION_ESTIMATES.get(name, 60) for name in skipped)
+        log.info(
+            "Sample looks like %s, running %s and skipping %s (about %ds saved).",
+            kind, ", ".join(selected) or "nothing", ", ".join(skipped) or "nothing", saved
+        )
+        return selected, {
+            "kind": kind, "selected": selected, "skipped": skipped, "saved": saved,
+        }
+
+    def budget(self):
+        # Seconds the session may take, by default most of the analysis
+        # timeout so that the analyzer has time to wrap up.
+        if "human.budget" in self.options:
+            return float(self.options["human.budget"])
+
+        timeout = getattr(getattr(self.analyzer, "config", None), "timeout", None)
+        if timeout:
+            return int(timeout) * 0.9
+
+    def run(self):
+        if self.plan is None:
+            self.prepare()
+
+        handlers = dict(WINDOW_HANDLERS)
+        if not self.do_click_buttons:
+            handlers.pop("click_buttons", None)
+
+        # Only hand new or changed windows to the button clicker, which
+        # keeps track of the buttons still on screen.
+        tracker = WindowTracker(
+            WINDOW_SOURCE, int(self.options.get("human.incremental", 1))
+        )
+        WINDOW_SOURCE.start()
+
+        if self.do_move_mouse:
+            self.add_task("move_mouse", move_mouse)
+
+        if self.do_click_mouse:
+            self.add_task("click_mouse", click_mouse)
+
+        # Matched buttons are clicked by the click queue.
+        if self.do_click_buttons:
+            BUTTON_CLICKER.reset()
+            CLICK_QUEUE.reset()
+            if BACKEND.realtime:
+                CLICK_QUEUE.start()
+            else:
+                self.scheduler.add(
+                    "clicks", CLICK_QUEUE.step, max(CLICK_QUEUE.pacing, 0.1)
+                )
+
+        if TRACE.enabled:
+            self.scheduler.add("trace", TRACE.flush, TRACE.interval, delay=TRACE.interval)
+
+        # A single task walks the desktop for all window handlers.
+        if handlers:
+            dispatcher = WindowDispatcher(tracker, handlers, BACKEND.time)
+            self.scheduler.add(
+                "windows", dispatcher, dispatcher.interval,
+                delay=dispatcher.interval
+            )
+
+        # Interactions run on their own thread, so that the background tasks
+        # keep their cadence. Virtual time only passes on the scheduler's
+        # thread, so there they run as a task.
+        self.started = BACKEND.time()
+        if BACKEND.realtime:
+            runner = threading.Thread(target=self.run_interactions)
+            runner.daemon = True
+            runner.start()
+        else:
+            self.scheduler.add("interactions", self.run_interactions)
+
+        try:
+            with METRICS.timer("human"), GOVERNOR.metered():
+                self.scheduler.run()
+        finally:
+            WINDOW_SOURCE.stop()
+            CLICK_QUEUE.stop()
+            APP_POOL.release()
+            TRACE.flush()
+            report = GOVERNOR.report()
+            log.info(
+                "Throttled for %.1fs (%d of %d samples, factor up to %.1f), "
+                "deferred %d interactions by %.1fs.",
+                report["throttled_seconds"], report["throttled"],
+                report["samples"], report["max_factor"], report["deferred"],
+                report["deferred_seconds"]
+            )
+
+    def task_interval(self, name):
+        interval, jitter = TASK_INTERVALS[name]
+        interval = float(self.options.get("human.%s.interval" % name, interval))
+        jitter = float(self.options.get("human.%s.jitter" % name, jitter))
+        return interval, jitter
+
+    def add_task(self, name, func):
+        # Runs at the planned times first, then every interval.
+        interval, jitter = self.task_interval(name)
+        self.scheduler.add(
+            name, func, interval, jitter, gaps=self.plan["tasks"].get(name)
+        )
 
-            if self.do_click_mouse:
-                click_mouse()
+    def run_interactions(self):
+        with GOVERNOR.metered():
+            planned = self.plan["interactions"]
+            deadline = None
+            if self.plan["budget"]:
+                deadline = self.started + self.plan["budget"]
 
-            if self.do_move_mouse:
-                move_mouse()
+            ahead = self.prewarm_ahead()
+            for idx, entry in enumerate(planned):
+                # Normally start() got the pool going for the first ones.
+                self.prewarm(planned[idx:idx + ahead])
 
-            if self.do_click_buttons:
-                USER32.EnumWindows(EnumWindowsProc(foreach_window), 0)
+                name = entry["name"]
+                delay = self.started + entry["start"] - BACKEND.time()
+                if not self.do_run or BACKEND.wait(self.scheduler.stopped, delay):
+                    break
 
-            if self.do_notepad_interaction:
-                notepad_interaction()
-                self.do_notepad_interaction = False
+                session = APP_POOL.take(name)
 
-            if self.do_paint_interaction:
-                paint_interaction()
-                self.do_paint_interaction = False
+                # Don't start what can't finish before the analysis times out.
+                if deadline is not None and BACKEND.time() + entry["estimate"] > deadline:
+                    log.info("Skipping the %s interaction, it would not finish in time.", name)
+                    METRICS.count("interactions.skipped")
+                    APP_POOL.close(session)
+                    continue
 
-            if self.do_word_interaction:
-                word_interaction()
-                self.do_word_interaction = False
+                GOVERNOR.defer(name)
+                timeout = float(self.options.get(
+                    "human.interaction_timeout", entry["estimate"] * self.OVERRUN
+                ))
+                if deadline is not None:
+                    timeout = min(timeout, max(deadline - BACKEND.time(), 0))
+                self.interact(name, session, entry["params"], timeout)
+
+    def prewarm_ahead(self):
+        # How many of the planned interactions have their applications
+        # launched ahead of time.
+        if not int(self.options.get("human.overlap", 1)):
+            return 0
+        return int(self.options.get("human.prewarm", 2))
+
+    def prewarm(self, entries):
+        # The applications of these planned interactions are launched in the
+        # background, and handed to their interactions when they are due.
+        # Those that fail to are launched by their interactions instead.
+        try:
+            APP_POOL.start(
+                entry["name"] for entry in entries if entry["name"] in APPLICATIONS
+            )
+        except Exception:
+            log.exception("Error launching applications ahead of their interactions")
+
+    def interact(self, name, session, params, timeout):
+        # Runs an interaction on a worker, and moves on once it finished or
+        # "timeout" seconds passed. Without real time, the interaction runs
+        # inline and can only be reported as overrun afterwards.
+        worker = InteractionWorker(name, self.interactions[name], session, params)
+        started = BACKEND.time()
+        if not BACKEND.realtime:
+            worker.run()
+        else:
+            worker.start()
+            while worker.is_alive() and not self.scheduler.stopped.is_set():
+                remaining = started + timeout - BACKEND.time()
+                if remaining <= 0:
+                    break
+                worker.join(min(remaining, 1.0))
 
-            if self.do_adobe_interaction:
-                acrobat_interaction()
-                self.do_acrobat_interaction = False
+        elapsed = BACKEND.time() - started
+        METRICS.observe("interactions.elapsed", elapsed)
+        if worker.error is not None:
+            METRICS.count("interactions.errors")
 
-            if self.do_ie_interaction:
-                ie_interaction()
-                self.do_ie_interaction = False
+        if worker.is_alive():
+            log.warning(
+                "The %s interaction did not finish within %ds, cancelling it.",
+                name, timeout
+            )
+            METRICS.count("interactions.timeouts")
+            worker.cancel()
+            worker.join(self.CANCEL_GRACE)
+            if worker.is_alive():
+                log.warning("The %s interaction is still running in the background.", name)
+                METRICS.count("interactions.abandoned")
+                worker.abandon()
+        elif elapsed > timeout:
+            log.warning("The %s interaction took %ds, over its %ds.", name, elapsed, timeout)
+            METRICS.count("interactions.overruns")
 
-            if self.do_calculator_interaction:
-                calculator_interaction()
-                self.do_calculator_interaction = False
 
-            KERNEL32.Sleep(1000)
-            seconds += 1
+if __name__ == "__main__":
+    # "python human.py record <path> <seconds>" records a real session to
+    # replay with the "human.replay" option. The benchmarks are run with
+    # "python human_bench.py".
+    if sys.argv[1:2] != ["record"] or len(sys.argv) != 4:
+        sys.exit("usage: python human.py record <path> <seconds>")
+    SessionRecorder(sys.argv[2]).record(float(sys.argv[3]))
@@ -0,0 +1,1228 @@
+# Copyright (C) 2012-2013 Claudio Guarnieri.
+# Copyright (C) 2014-2018 Cuckoo Foundation.
+# This file is part of Cuckoo Sandbox - http://www.cuckoosandbox.org
+# See the file 'docs/LICENSE' for copying permission.
+
+# Benchmarks for the human auxiliary module, and the fake desktop they run
+# against, so no Windows is needed. None of this is needed in the guest.
+# "python human_bench.py" prints the results as JSON so they can be compared
+# between versions. Timings are wall clock seconds unless noted otherwise.
+
+import ast
+import collections
+import heapq
+import itertools
+import json
+import math
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import human
+from human import (
+    ActionTrace, AppPool, Backend, BUILTIN_SCENARIOS, BUTTON_CLICKER,
+    BUTTON_KEYWORDS, ButtonMatcher, CLICK_QUEUE, GOVERNOR, Human, INPUT_LOCK,
+    INTERACTIONS, InteractionWorker, Launcher,
+    METRICS, MouseMover, PROCESS_TABLE, Planner, ProcessSource, ProcessTable,
+    RECORDING_HEADER, Recording, STEP_STATS, Scenario, ScenarioLibrary,
+    Scheduler, Session, SessionPlayer, SessionRecorder, TASK_INTERVALS, TRACE,
+    Typist, VisualLocator, WAITS, Window, WindowDelta, WindowSnapshot,
+    WindowSource, WindowTracker, click, click_buttons, compile_scenario,
+    iter_windows, log, numpy, process_exists, use_backend
+)
+
+
+class FakeDesktop(Backend, WindowSource, ProcessSource):
+    """An in-memory desktop with windows, children, processes and a virtual
+    clock, so the background tasks and scripted interactions can run (and be
+    benchmarked) without Windows. Time only moves when something sleeps or
+    waits; changes scheduled with at() are applied as it passes them."""
+
+    realtime = False
+
+    def __init__(self, width=1024, height=768, click_delay=1.0):
+        self.width = width
+        self.height = height
+        # Clicking a real button takes a second, see Win32Backend.
+        self.click_delay = click_delay
+        self.now = 0.0
+        # Guest load between 0 and 1, and the CPU time it accumulated.
+        self.load = 0.0
+        self.busy_time = 0.0
+        self.events = []
+        self.counter = itertools.count()
+        self.hwnd_counter = itertools.count(0x10000, 2)
+        self.pid_counter = itertools.count(1000, 4)
+        self.windows = {}
+        self.top_level = []
+        self.procs = {}
+        self.dirty = True
+        self.cursor = 0, 0
+        # Grayscale pixels of the whole screen, if anything looks at them.
+        self.screen = None
+        self.clicked = []
+        self.actions = collections.Counter()
+        # What a user holds down, and the rect of the foreground window.
+        self.keys = set()
+        self.foreground = None
+        self.window_source = self.process_source = self
+
+    # Virtual clock.
+    def time(self):
+        return self.now
+
+    def at(self, when, func):
+        heapq.heappush(self.events, (when, next(self.counter), func))
+
+    def advance(self, seconds, event=None):
+        target = self.now + max(seconds, 0)
+        while self.events and self.events[0][0] <= target:
+            when, _, func = heapq.heappop(self.events)
+            self._move(max(self.now, when))
+            func()
+            if event is not None and event.is_set():
+                return
+        self._move(target)
+
+    def _move(self, when):
+        self.busy_time += (when - self.now) * self.load
+        self.now = when
+
+    def sleep(self, seconds):
+        self.advance(seconds)
+
+    def wait(self, event, timeout):
+        if not event.is_set():
+            self.advance(timeout, event)
+        return event.is_set()
+
+    def system_times(self):
+        return self.now - self.busy_time, self.now
+
+    # Windows.
+    def add_window(self, classname, title="", parent=None, visible=True,
+                   on_click=None, pid=None):
+        hwnd = next(self.hwnd_counter)
+        self.windows[hwnd] = {
+            "classname": classname, "title": title, "parent": parent,
+            "visible": visible, "children": [], "on_click": on_click,
+            "pid": pid,
+        }
+        if parent is None:
+            self.top_level.append(hwnd)
+        else:
+            self.windows[parent]["children"].append(hwnd)
+        self.dirty = True
+        return hwnd
+
+    def remove_window(self, hwnd):
+        window = self.windows.pop(hwnd, None)
+        if window is None:
+            return
+
+        for child in window["children"]:
+            self.remove_window(child)
+        if window["parent"] is None:
+            self.top_level.remove(hwnd)
+        elif window["parent"] in self.windows:
+            self.windows[window["parent"]]["children"].remove(hwnd)
+        self.dirty = True
+
+    def set_title(self, hwnd, title):
+        self.windows[hwnd]["title"] = title
+        self.dirty = True
+
+    def find_window(self, title):
+        for hwnd in self.top_level:
+            window = self.windows[hwnd]
+            if window["visible"] and window["title"] == title:
+                return hwnd
+
+    def find_windows(self, classname=None):
+        return [
+            (hwnd, self.windows[hwnd]["title"], self.windows[hwnd]["pid"])
+            for hwnd in self.top_level
+            if self.windows[hwnd]["visible"] and
+            classname in (None, self.windows[hwnd]["classname"])
+        ]
+
+    def window_pid(self, hwnd):
+        return self.windows[hwnd]["pid"]
+
+    def has_changes(self):
+        return self.dirty
+
+    def snapshot(self):
+        # Same shape as Win32WindowSource: visible top-level windows, all of
+        # their descendants, and child titles for buttons only.
+        self.dirty = False
+        snap = WindowSnapshot()
+        for hwnd in self.top_level:
+            window = self.windows[hwnd]
+            if window["visible"]:
+                snap.windows.append(Window(
+                    hwnd, window["classname"], window["title"], None
+                ))
+                snap.children[hwnd] = []
+                self._walk(hwnd, hwnd, snap.children[hwnd])
+        return snap
+
+    def _walk(self, hwnd, top, children):
+        for child in self.windows[hwnd]["children"]:
+            window = self.windows[child]
+            title = ""
+            if "button" in window["classname"].lower():
+                title = window["title"]
+            children.append(Window(child, window["classname"], title, top))
+            self._walk(child, top, children)
+
+    # Processes.
+    def add_process(self, name):
+        pid = next(self.pid_counter)
+        self.procs[pid] = name
+        return pid
+
+    def kill_process(self, pid):
+        self.procs.pop(pid, None)
+
+    def processes(self):
+        return list(self.procs.items())
+
+    # Actions.
+    def screen_size(self):
+        return self.width, self.height
+
+    def capture(self, rect):
+        if self.screen is None:
+            return None
+        left, top, right, bottom = rect
+        return self.screen[max(top, 0):bottom, max(left, 0):right]
+
+    def set_cursor(self, x, y):
+        self.actions["set_cursor"] += 1
+        self.cursor = x, y
+
+    def cursor_position(self):
+        return self.cursor
+
+    def move_cursor(self, points):
+        self.actions["move_cursor"] += 1
+        self.cursor = tuple(points[-1])
+
+    def foreground_rect(self):
+        return self.foreground
+
+    def pressed_keys(self):
+        return set(self.keys)
+
+    def press(self, vk, down):
+        self.actions["press"] += 1
+        if down:
+            self.keys.add(vk)
+        else:
+            self.keys.discard(vk)
+
+    def mouse_click(self):
+        self.actions["mouse_click"] += 1
+        self.sleep(0.05)
+
+    def click_button(self, hwnd):
+        self.actions["click_button"] += 1
+        self.sleep(self.click_delay)
+        window = self.windows.get(hwnd)
+        if window is not None:
+            self.clicked.append(hwnd)
+            if window["on_click"]:
+                window["on_click"]()
+
+    def close_window(self, hwnd):
+        self.actions["close_window"] += 1
+        self.remove_window(hwnd)
+
+
+# A real-time fake desktop, for measuring timings.
+class RealTimeDesktop(FakeDesktop):
+    realtime = True
+    time = Backend.time
+    sleep = Backend.sleep
+    wait = Backend.wait
+
+
+class FakeWindowSpec(object):
+    """Stands in for a pywinauto window specification of a FakeDesktop
+    window, by title."""
+
+    def __init__(self, desktop, title=None, criteria=()):
+        self.desktop = desktop
+        self.title = title
+        self.criteria = list(criteria)
+
+    def window(self, **criteria):
+        return FakeWindowSpec(
+            self.desktop, criteria.get("title"), self.criteria + [criteria]
+        )
+
+    child_window = window
+
+
+class FakeWrapper(object):
+    """Stands in for the pywinauto wrapper of a FakeDesktop window. Clicks
+    do not go through "failures" of the time."""
+
+    def __init__(self, desktop, hwnd, failures=0.0, rng=random):
+        self.desktop = desktop
+        self.hwnd = hwnd
+        self.failures = failures
+        self.rng = rng
+
+    def minimize(self):
+        pass
+
+    restore = set_focus = minimize
+
+    def click_input(self):
+        if self.rng.random() < self.failures:
+            raise RuntimeError("The click did not go through")
+        self.desktop.click_button(self.hwnd)
+
+    def close(self):
+        self.desktop.close_window(self.hwnd)
+
+
+class FakeLocator(object):
+    """Stands in for a LocatorCache over a FakeDesktop."""
+
+    def __init__(self, desktop, failures=0.0, rng=random):
+        self.desktop = desktop
+        self.failures = failures
+        self.rng = rng
+
+    def get(self, name, spec, timeout=20, ready=True, dialog=None):
+        return FakeWrapper(self.desktop, WAITS.until(
+            name, lambda: self.desktop.find_window(spec.title), timeout,
+            raise_on_timeout=True
+        ), self.failures, self.rng)
+
+    def invalidate(self, name=None):
+        pass
+
+
+class FakeApplication(object):
+    """Stands in for a pywinauto Application of a FakeDesktop process."""
+
+    def __init__(self, desktop, pid):
+        self.desktop = desktop
+        self.process = pid
+
+    def kill(self):
+        self.desktop.kill_process(self.process)
+
+
+# Top-level windows with a static, an edit and some buttons each, about one
+# in ten buttons carrying a label the button clicker acts upon.
+def populate_desktop(desktop, windows, buttons=2, seed=0):
+    rng = random.Random(seed)
+    words = ["setup", "wizard", "cancel", "back", "help", "details", "more"]
+    keywords = BUTTON_KEYWORDS["en"]["click"]
+    for idx in range(windows):
+        hwnd = desktop.add_window("Window%d" % (idx % 7), "Window %d" % idx)
+        desktop.add_window("Static", "Some text", hwnd)
+        desktop.add_window("Edit", "", hwnd)
+        for _ in range(buttons):
+            if rng.random() < 0.1:
+                label = rng.choice(keywords).capitalize()
+            else:
+                label = rng.choice(words).capitalize()
+            desktop.add_window("Button", "&" + label, hwnd)
+
+
+# Cost of a snapshot and of a full versus an incremental button clicker
+# tick, per tick, over desktops of different sizes.
+def benchmark_enumeration(sizes=(10, 100, 1000), ticks=20, seed=0):
+    results = {}
+    for size in sizes:
+        desktop = FakeDesktop(click_delay=0)
+        populate_desktop(desktop, size, seed=seed)
+        previous = use_backend(desktop)
+        try:
+            result = {"windows": size}
+            started = time.time()
+            for _ in range(ticks):
+                desktop.snapshot()
+            result["snapshot"] = (time.time() - started) / ticks
+
+            for mode in ("full", "incremental"):
+                tracker = WindowTracker(desktop, mode == "incremental")
+                del desktop.clicked[:]
+                BUTTON_CLICKER.reset()
+                CLICK_QUEUE.reset()
+                started = time.time()
+                for _ in range(ticks):
+                    # Something changes on every tick.
+                    desktop.dirty = True
+                    click_buttons(*tracker.update())
+                    CLICK_QUEUE.drain()
+                result[mode] = (time.time() - started) / ticks
+                result["%s_clicks" % mode] = len(desktop.clicked)
+        finally:
+            use_backend(previous)
+        results[str(size)] = result
+    return results
+
+
+# Lookups answered from the cached process table versus a fresh snapshot
+# for every lookup, per lookup.
+def benchmark_process_lookup(processes=300, lookups=1000):
+    desktop = FakeDesktop()
+    for idx in range(processes):
+        desktop.add_process("process%d.exe" % idx)
+    desktop.add_process("notepad.exe")
+
+    table = ProcessTable(desktop, clock=desktop.time)
+    started = time.time()
+    for _ in range(lookups):
+        table.pids("notepad.exe")
+    cached = (time.time() - started) / lookups
+
+    started = time.time()
+    for _ in range(lookups):
+        table.invalidate()
+        table.pids("notepad.exe")
+    uncached = (time.time() - started) / lookups
+
+    return {
+        "processes": processes,
+        "cached": cached,
+        "uncached": uncached,
+        "speedup": uncached / max(cached, 1e-9),
+    }
+
+
+# How far apart, in real time, periodic tasks actually run compared with
+# their interval. Returns the deviations in milliseconds.
+def benchmark_scheduler(duration=1.0, intervals=(0.01, 0.025, 0.05)):
+    scheduler = Scheduler()
+    deviations = []
+
+    def task(interval):
+        last = []
+
+        def run():
+            now = time.time()
+            if last:
+                deviations.append(abs(now - last[0] - interval) * 1000)
+            last[:] = [now]
+        return run
+
+    for interval in intervals:
+        scheduler.add("benchmark.%s" % interval, task(interval), interval)
+    scheduler.add("benchmark.stop", scheduler.stop, delay=duration)
+    scheduler.run()
+
+    deviations.sort()
+    count = len(deviations)
+    return {
+        "runs": count,
+        "mean": sum(deviations) / max(count, 1),
+        "p95": deviations[int(count * 0.95)] if count else 0.0,
+        "max": deviations[-1] if count else 0.0,
+    }
+
+
+# The background tasks of Human.run over "duration" virtual seconds. Wall
+# time per virtual second is the overhead of a tick.
+def benchmark_human(windows=100, duration=600, seed=0):
+    desktop = FakeDesktop()
+    populate_desktop(desktop, windows, seed=seed)
+    previous = use_backend(desktop)
+    try:
+        human = Human({"human": "1"})
+        desktop.at(duration, human.stop)
+        started = time.time()
+        human.run()
+        wall = time.time() - started
+    finally:
+        use_backend(previous)
+
+    return {
+        "windows": windows,
+        "virtual": desktop.time(),
+        "wall": wall,
+        "wall_per_second": wall / max(desktop.time(), 1e-9),
+        "actions": dict(desktop.actions),
+    }
+
+
+# A Notepad-like session in virtual time: launch, type, save through a
+# dialog and close. "virtual" is how long it would take on a real desktop.
+def benchmark_interaction(launch_delay=2.5, windows=20, seed=0):
+    desktop = FakeDesktop()
+    populate_desktop(desktop, windows, seed=seed)
+    typist = Typist(rng=random.Random(seed))
+    text = "The quick brown fox jumps over the lazy dog. " * 8
+    title = "Untitled - Notepad"
+
+    def save():
+        dialog = desktop.add_window("#32770", "Save As")
+        desktop.add_window(
+            "Button", "&Save", dialog,
+            on_click=lambda: desktop.remove_window(dialog)
+        )
+
+    previous = use_backend(desktop)
+    started = time.time()
+    try:
+        # The process shows up at once, its window once it has loaded.
+        pid = desktop.add_process("notepad.exe")
+        PROCESS_TABLE.invalidate()
+        desktop.at(desktop.time() + launch_delay,
+                   lambda: desktop.add_window("Notepad", title))
+        hwnd = WAITS.until(
+            "benchmark.launch", lambda: desktop.find_window(title),
+            raise_on_timeout=True
+        )
+
+        keys = typist.schedule(text)
+        desktop.sleep(keys[-1][0])
+
+        desktop.at(desktop.time() + 0.5, save)
+        dialog = WAITS.until(
+            "benchmark.save_dialog", lambda: desktop.find_window("Save As"),
+            raise_on_timeout=True
+        )
+        click(desktop.windows[dialog]["children"][0])
+        WAITS.until(
+            "benchmark.saved", lambda: not desktop.find_window("Save As"),
+            raise_on_timeout=True
+        )
+
+        desktop.close_window(hwnd)
+        desktop.kill_process(pid)
+        PROCESS_TABLE.invalidate()
+        WAITS.until(
+            "benchmark.close", lambda: not process_exists("notepad.exe"),
+            raise_on_timeout=True
+        )
+    finally:
+        use_backend(previous)
+
+    return {
+        "keys": len(keys),
+        "virtual": desktop.time(),
+        "wall": time.time() - started,
+    }
+
+
+# How long typing "chars" characters takes with the default Typist, versus
+# the 0.1s a character of the type_keys() it replaced, and how many
+# SendInput calls the batching leaves.
+def benchmark_typing(chars=2000, seed=0):
+    rng = random.Random(seed)
+    typist = Typist(rng=random.Random(seed))
+    text = "".join(rng.choice("abcdefghijklmnopqrstuvwxyz  ") for _ in range(chars))
+    keys = typist.schedule(text)
+    return {
+        "keys": len(keys),
+        "send_input_calls": sum(1 for _ in typist.batches(keys)),
+        "seconds": keys[-1][0],
+        "type_keys_seconds": chars * 0.1,
+    }
+
+
+# Runs in a fresh interpreter: how long importing the human module takes,
+# and how long importing the heavy dependencies up front would add to that.
+IMPORT_PROBE = """
+import sys, time
+started = time.time()
+module = __import__(sys.argv[1])
+imported = time.time() - started
+started = time.time()
+try:
+    for name in module.HEAVY_MODULES:
+        __import__(name)
+    heavy = time.time() - started
+except ImportError:
+    heavy = None
+sys.stdout.write(repr((imported, heavy)))
+"""
+
+
+# Startup cost when only the Cuckoo mouse and button features are enabled,
+# which never touch the heavy dependencies. "heavy" is None where they are
+# not installed.
+def benchmark_import():
+    directory, filename = os.path.split(os.path.abspath(human.__file__))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([directory] + sys.path)
+    output = subprocess.check_output([
+        sys.executable, "-c", IMPORT_PROBE, os.path.splitext(filename)[0]
+    ], env=env)
+    imported, heavy = ast.literal_eval(output)
+    return {
+        "import": imported,
+        "heavy": heavy,
+        "eager_import": imported + heavy if heavy is not None else None,
+    }
+
+
+# Background activity of Human.run over "duration" virtual seconds, with
+# and without the governor, while the sample keeps the guest busy between
+# the "busy" virtual seconds.
+def benchmark_governor(duration=600, busy=(120, 300), seed=0):
+    results = {}
+    for enabled in (0, 1):
+        desktop = FakeDesktop()
+        populate_desktop(desktop, 20, seed=seed)
+        desktop.load = 0.2
+        desktop.at(busy[0], lambda desktop=desktop: setattr(desktop, "load", 0.95))
+        desktop.at(busy[1], lambda desktop=desktop: setattr(desktop, "load", 0.2))
+        previous = use_backend(desktop)
+        try:
+            human = Human({"human": "1", "human.governor": str(enabled)})
+            desktop.at(duration, human.stop)
+            human.run()
+        finally:
+            use_backend(previous)
+        results["governed" if enabled else "ungoverned"] = {
+            "actions": dict(desktop.actions),
+            "governor": GOVERNOR.report(),
+        }
+    return results
+
+
+# How long planning a session takes, how big the plan is as JSON and
+# whether the same seed gives the same plan.
+def benchmark_planner(budget=600, rounds=20, seed=0):
+    names = ["notepad", "paint", "word", "acrobat", "ie", "calculator"]
+    tasks = dict((name, TASK_INTERVALS[name]) for name in TASK_INTERVALS)
+    started = time.time()
+    for idx in range(rounds):
+        Planner(seed + idx, budget).plan(names, tasks)
+    elapsed = (time.time() - started) / rounds
+
+    plan = json.dumps(Planner(seed, budget).plan(names, tasks), sort_keys=True)
+    again = json.dumps(Planner(seed, budget).plan(names, tasks), sort_keys=True)
+    return {
+        "plan": elapsed,
+        "bytes": len(plan),
+        "reproducible": plan == again,
+        "planned": [entry["name"] for entry in json.loads(plan)["interactions"]],
+    }
+
+
+# A synthetic screenshot: a smooth background with noise and some button
+# like rectangles with stripes as labels. Returns the screen and the
+# (y, x, height, width) of every button.
+def synthetic_screen(width=1024, height=768, buttons=12, seed=0):
+    np = numpy
+    rng = np.random.RandomState(seed)
+    yy, xx = np.mgrid[0:height, 0:width]
+    screen = 120 + 40 * np.sin(xx / 90.0) * np.cos(yy / 70.0)
+    screen += rng.normal(0, 4, screen.shape)
+
+    placed = []
+    for _ in range(buttons):
+        bh, bw = rng.randint(24, 48), rng.randint(60, 160)
+        y, x = rng.randint(0, height - bh), rng.randint(0, width - bw)
+        screen[y:y + bh, x:x + bw] = rng.randint(150, 230)
+        for stripe in range(rng.randint(2, 6)):
+            sx = x + 6 + rng.randint(0, bw - 12)
+            screen[y + bh // 3:y + 2 * bh // 3, sx:sx + rng.randint(2, 6)] = rng.randint(0, 80)
+        placed.append((y, x, bh, bw))
+    return np.clip(screen, 0, 255), placed
+
+
+# Accuracy and latency of the visual locator on synthetic screenshots, for
+# the first search and for the recent-hit check.
+def benchmark_visual(screens=5, seed=0):
+    desktop = FakeDesktop()
+    previous = use_backend(desktop)
+    found = total = 0
+    cold, warm = [], []
+    try:
+        for idx in range(screens):
+            desktop.screen, placed = synthetic_screen(seed=seed + idx)
+            locator = VisualLocator()
+            rect = 0, 0, desktop.width, desktop.height
+            # Templates are cut from the final screen, so buttons placed on
+            # top of each other still match.
+            for number, (y, x, bh, bw) in enumerate(placed[-4:]):
+                name = "button%d" % number
+                locator.register(name, desktop.screen[y:y + bh, x:x + bw].copy())
+                expected = x + bw // 2, y + bh // 2
+                for timings in (cold, warm):
+                    started = time.time()
+                    point = locator.locate(name, rect)
+                    timings.append(time.time() - started)
+                    total += 1
+                    if point and abs(point[0] - expected[0]) <= 2 and abs(point[1] - expected[1]) <= 2:
+                        found += 1
+    finally:
+        use_backend(previous)
+
+    return {
+        "lookups": total,
+        "accuracy": float(found) / max(total, 1),
+        "search": sum(cold) / max(len(cold), 1),
+        "recent": sum(warm) / max(len(warm), 1),
+    }
+
+
+# How a session with a hung interaction goes: whether the next interaction
+# still runs, how many interactions timed out, and the longest gap between
+# two runs of a background task that should run every "tick" seconds. A
+# "stuck" interaction ignores its cancellation and keeps the input lock, so
+# it has to be abandoned.
+def benchmark_watchdog(timeout=0.3, tick=0.02, stuck=False):
+    desktop = RealTimeDesktop()
+    ran, ticks = [], []
+
+    def hung(session=None, params=None):
+        if stuck:
+            time.sleep(timeout * 4)
+        else:
+            WAITS.until("benchmark.hung", lambda: False, timeout=60)
+
+    def quick(session=None, params=None):
+        ran.append(desktop.time())
+
+    previous, interactions = use_backend(desktop), dict(INTERACTIONS)
+    INTERACTIONS.update({"hung": hung, "quick": quick})
+    METRICS.counters.pop("interactions.timeouts", None)
+    METRICS.counters.pop("interactions.abandoned", None)
+    try:
+        human = Human({"human": "0", "human.interaction_timeout": str(timeout)})
+        human.CANCEL_GRACE = timeout
+        human.prepare()
+        human.plan = {
+            "budget": None, "tasks": {},
+            "interactions": [
+                {"name": "hung", "start": 0, "estimate": timeout, "params": {}},
+                {"name": "quick", "start": 0, "estimate": timeout, "params": {}},
+            ],
+        }
+        human.scheduler.add("tick", lambda: ticks.append(time.time()), tick)
+        stopper = threading.Timer(timeout * 3, human.stop)
+        stopper.start()
+        started = time.time()
+        human.run()
+        wall = time.time() - started
+    finally:
+        use_backend(previous)
+        INTERACTIONS.clear()
+        INTERACTIONS.update(interactions)
+
+    return {
+        "wall": wall,
+        "next_ran": bool(ran),
+        "timeouts": METRICS.counters["interactions.timeouts"],
+        "abandoned": METRICS.counters.get("interactions.abandoned", 0),
+        "ticks": len(ticks),
+        "max_tick_gap": max(b - a for a, b in zip(ticks, ticks[1:])),
+    }
+
+
+# Cost of recording an action into the trace, of a disabled log message with
+# eager and lazy formatting, and the batches the trace of a ten minute
+# session in virtual time is uploaded in.
+def benchmark_trace(actions=20000, duration=600, seed=0):
+    trace = ActionTrace(capacity=actions)
+    started = time.time()
+    for idx in range(actions):
+        trace.record("move", x=idx, y=idx)
+    record = time.time() - started
+
+    started = time.time()
+    for idx in range(actions):
+        log.debug("Starting a new %s session in the background..." % idx)
+    eager = time.time() - started
+
+    started = time.time()
+    for idx in range(actions):
+        log.debug("Starting a new %s session in the background...", idx)
+    lazy = time.time() - started
+
+    uploads = []
+    desktop = FakeDesktop()
+    populate_desktop(desktop, 20, seed=seed)
+    previous = use_backend(desktop)
+    TRACE.upload = lambda path, dump_path: uploads.append(
+        (dump_path, sum(1 for _ in open(path)))
+    )
+    try:
+        human = Human({"human": "1"})
+        desktop.at(duration, human.stop)
+        human.run()
+        TRACE.stop()
+    finally:
+        TRACE.upload = None
+        use_backend(previous)
+
+    return {
+        "record_per_action": record / actions,
+        "eager_log_per_action": eager / actions,
+        "lazy_log_per_action": lazy / actions,
+        "batches": len(uploads),
+        "traced": sum(count for _, count in uploads),
+        "dropped": TRACE.report()["dropped"],
+    }
+
+
+# A minute of synthetic user activity recorded off a FakeDesktop, and
+# replayed onto a larger screen, within a window that moved, at double
+# speed. "error" is how far the replayed cursor ended up from where the
+# recorded one maps to, in pixels.
+def benchmark_replay(duration=60, seed=0):
+    rng = random.Random(seed)
+    desktop = FakeDesktop(1024, 768)
+    desktop.foreground = 100, 100, 500, 400
+    at = 0.0
+    while at < duration:
+        at += rng.expovariate(20)
+        point = rng.randint(100, 499), rng.randint(100, 399)
+        desktop.at(at, lambda point=point: setattr(desktop, "cursor", point))
+        if rng.random() < 0.05:
+            vk = rng.choice([0x01, 0x41, 0x42, 0x0D])
+            desktop.at(at, lambda vk=vk: desktop.keys.add(vk))
+            desktop.at(at + 0.08, lambda vk=vk: desktop.keys.discard(vk))
+        if rng.random() < 0.002:
+            at += 10
+
+    fd, path = tempfile.mkstemp(suffix=".hrec")
+    os.close(fd)
+    previous = use_backend(desktop)
+    try:
+        records = SessionRecorder(path).record(duration + 1)
+        final = desktop.cursor
+
+        target = FakeDesktop(1920, 1080)
+        use_backend(target)
+        rect = 300, 200, 1100, 800
+        recording = Recording(path)
+        try:
+            started = time.time()
+            events = sum(1 for _ in recording)
+            read = time.time() - started
+            player = SessionPlayer(speed=2.0, max_idle=1.0)
+            replayed = player.replay(recording, rect)
+        finally:
+            recording.close()
+        scale = 1920 / 1024.0, 1080 / 768.0
+        expected = player.remap(final, scale, desktop.foreground, rect)
+        size = os.path.getsize(path)
+    finally:
+        use_backend(previous)
+        os.remove(path)
+
+    return {
+        "records": records,
+        "events": events,
+        "bytes": size,
+        "bytes_per_record": float(size - RECORDING_HEADER.size) / max(records, 1),
+        "read_per_record": read / max(records, 1),
+        "recorded": duration,
+        "replayed": target.time(),
+        "replayed_events": replayed,
+        "presses": target.actions["press"],
+        "error": math.hypot(target.cursor[0] - expected[0], target.cursor[1] - expected[1]),
+    }
+
+
+# Loading a library of "copies" variants of every built-in scenario from
+# JSON files: when it has to be validated and compiled, when the compiled
+# scenarios are in a cache directory, and when they are already in memory.
+# Seconds per scenario.
+def benchmark_scenarios(copies=50):
+    directory, cache = tempfile.mkdtemp(), tempfile.mkdtemp()
+    paths = []
+    for idx in range(copies):
+        for name, source in sorted(BUILTIN_SCENARIOS.items()):
+            paths.append(os.path.join(directory, "%s%d.json" % (name, idx)))
+            with open(paths[-1], "w") as f:
+                json.dump(dict(source, name="%s%d" % (name, idx)), f)
+    cold, warm = ScenarioLibrary(cache), ScenarioLibrary(cache)
+
+    def load(scenarios):
+        started = time.time()
+        for path in paths:
+            scenarios.load(path)
+        return (time.time() - started) / len(paths)
+
+    results = {"scenarios": len(paths)}
+    try:
+        results["compile"] = load(cold)
+        results["disk"] = load(warm)
+        results["memory"] = load(warm)
+        results["stats"] = warm.stats
+    finally:
+        for path in (directory, cache):
+            for filename in os.listdir(path):
+                os.remove(os.path.join(path, filename))
+            os.rmdir(path)
+    return results
+
+
+# A scenario run "runs" times with and without retries. Its button click,
+# which is safe to send again, does not go through "failures" of the time,
+# and its dialog shows up after 0 to 4 virtual seconds in half of the runs
+# and never in the others, while the step locating it allows 6 seconds. The
+# click on the dialog is skipped when it was not found. "clicked" is how often the button click went
+# through, "dialog" the mean seconds spent on locating the dialog and
+# "virtual" the mean length of a run.
+def benchmark_steps(runs=50, failures=0.3, seed=0):
+    source = {
+        "name": "flaky",
+        "steps": [
+            {"op": "launch", "app": "flaky"},
+            {"op": "locate", "target": {"from": "main", "path": [{"title": "Main"}]},
+             "as": "window", "name": "flaky.main"},
+            {"op": "click", "target": {"from": "main", "path": [{"title": "Button"}]},
+             "retries": 2, "name": "flaky.button"},
+            {"op": "locate", "target": {"from": "main", "path": [{"title": "Dialog"}]},
+             "as": "dialog", "timeout": 6, "on_failure": "skip", "name": "flaky.dialog"},
+            {"op": "click", "target": "dialog", "name": "flaky.dialog.ok"},
+            {"op": "close"},
+        ],
+    }
+    without = dict(source, steps=[dict(step, retries=0) for step in source["steps"]])
+
+    def run(scenario):
+        rng, clicks = random.Random(seed), random.Random(seed + 1)
+        desktop = FakeDesktop(click_delay=0.1)
+        use_backend(desktop)
+        STEP_STATS.steps = {}
+        for _ in range(runs):
+            desktop.add_window("Main", "Main")
+            desktop.add_window("Button", "Button")
+            if rng.random() < 0.5:
+                desktop.at(desktop.time() + rng.uniform(0, 4),
+                           lambda: desktop.add_window("#32770", "Dialog"))
+            session = Session(
+                "flaky", None, FakeWindowSpec(desktop),
+                FakeLocator(desktop, failures, clicks), False
+            )
+            scenario(session, {})
+            for title in ("Main", "Button", "Dialog"):
+                hwnd = desktop.find_window(title)
+                while hwnd:
+                    desktop.remove_window(hwnd)
+                    hwnd = desktop.find_window(title)
+            desktop.sleep(4)
+        report = STEP_STATS.report()
+        return {
+            "clicked": report["flaky.button"]["success_rate"],
+            "dialog": report["flaky.dialog"]["seconds"] / runs,
+            "skipped": report["flaky.dialog.ok"]["skipped"],
+            "virtual": (desktop.time() - 4 * runs) / runs,
+        }
+
+    previous, steps = human.BACKEND, STEP_STATS.steps
+    try:
+        return {
+            "retries": run(Scenario(compile_scenario(source))),
+            "no_retries": run(Scenario(compile_scenario(without))),
+        }
+    finally:
+        STEP_STATS.steps = steps
+        use_backend(previous)
+
+
+# How long "apps" interactions of "work" seconds each take when every one of
+# them launches its application first, versus with the applications warmed
+# up by the pool, "concurrency" at a time. The last application is pooled
+# but never used, so it has to be released.
+def benchmark_pool(apps=4, launch_delay=0.2, work=0.05, concurrency=1):
+    desktop = RealTimeDesktop()
+    names = ["app%d" % idx for idx in range(apps)]
+
+    def fake_launch(name, background=False):
+        pid = desktop.add_process("%s.exe" % name)
+        desktop.sleep(launch_delay)
+        desktop.add_window("Fake", name)
+        return Session(name, FakeApplication(desktop, pid), None, None, False, pid)
+
+    def interact(session):
+        desktop.sleep(work)
+        session.app.kill()
+
+    previous = use_backend(desktop)
+    pool = AppPool(fake_launch, concurrency)
+    try:
+        started = time.time()
+        for name in names[:-1]:
+            interact(fake_launch(name))
+        inline = time.time() - started
+
+        started = time.time()
+        pool.start(names)
+        for name in names[:-1]:
+            interact(pool.take(name))
+        pooled = time.time() - started
+        pool.release()
+        for launcher in threading.enumerate():
+            if isinstance(launcher, Launcher):
+                launcher.join()
+    finally:
+        use_backend(previous)
+
+    report = pool.report()
+    return {
+        "concurrency": concurrency,
+        "inline": inline,
+        "pooled": pooled,
+        "speedup": inline / pooled,
+        "launch": report["launch"],
+        "wait": report["wait"],
+        "saved": report["saved"],
+        "released": report["released"],
+        "leftover": len(desktop.procs),
+    }
+
+
+# How long a tick with matching buttons takes when they are clicked inline
+# (as they used to be) versus queued, and the throughput and latency of the
+# click worker. The same buttons are offered twice to exercise deduplication.
+def benchmark_click_queue(buttons=20, click_delay=0.05):
+    desktop = RealTimeDesktop(click_delay=click_delay)
+    for idx in range(buttons):
+        dialog = desktop.add_window("#32770", "Setup %d" % idx)
+        desktop.add_window("Button", "&Next", dialog)
+
+    previous, pacing = use_backend(desktop), CLICK_QUEUE.pacing
+    try:
+        snapshot = desktop.snapshot()
+        delta = WindowDelta(list(iter_windows(snapshot)), [], [])
+        started = time.time()
+        for window in delta.created:
+            if window.parent is not None:
+                click(window.hwnd)
+        inline = time.time() - started
+
+        BUTTON_CLICKER.reset()
+        CLICK_QUEUE.reset()
+        CLICK_QUEUE.pacing = 0
+        CLICK_QUEUE.start()
+        started = time.time()
+        click_buttons(snapshot, delta)
+        queued = time.time() - started
+        click_buttons(snapshot, delta)
+        WAITS.until(
+            "benchmark.clicks",
+            lambda: CLICK_QUEUE.report()["clicked"] >= buttons, timeout=30
+        )
+        drained = time.time() - started
+        CLICK_QUEUE.stop()
+    finally:
+        use_backend(previous)
+        CLICK_QUEUE.pacing = pacing
+
+    report = CLICK_QUEUE.report()
+    return {
+        "buttons": buttons,
+        "inline_tick": inline,
+        "queued_tick": queued,
+        "throughput": report["clicked"] / max(drained, 1e-9),
+        "latency": report["latency"],
+        "max_latency": report["max_latency"],
+        "deduplicated": report["duplicates"] + report["cooling_down"],
+    }
+
+
+# An interaction that sends some input, then waits "wait" seconds for a
+# window that never shows up, while a button is queued for the click
+# worker. The button should be clicked during the wait, not after it.
+def benchmark_input_wait(wait=1.0, click_delay=0.05):
+    desktop = RealTimeDesktop(click_delay=click_delay)
+    dialog = desktop.add_window("#32770", "Setup")
+    button = desktop.add_window("Button", "&Next", dialog)
+    waiting = threading.Event()
+
+    def interaction(session=None, params=None):
+        with INPUT_LOCK:
+            desktop.sleep(0.05)
+        waiting.set()
+        WAITS.until("benchmark.never", lambda: desktop.find_window("Never"), timeout=wait)
+
+    previous, pacing = use_backend(desktop), CLICK_QUEUE.pacing
+    try:
+        CLICK_QUEUE.reset()
+        CLICK_QUEUE.pacing = 0
+        CLICK_QUEUE.start()
+        worker = InteractionWorker("waiting", interaction)
+        started = time.time()
+        worker.start()
+        waiting.wait(5)
+        CLICK_QUEUE.push(button, "&Next")
+        WAITS.until(
+            "benchmark.clicked",
+            lambda: CLICK_QUEUE.report()["clicked"], timeout=wait * 2
+        )
+        clicked = time.time() - started
+        worker.join()
+        finished = time.time() - started
+        CLICK_QUEUE.stop()
+    finally:
+        use_backend(previous)
+        CLICK_QUEUE.pacing = pacing
+
+    return {
+        "clicked": clicked,
+        "interaction": finished,
+        "during_wait": clicked < wait,
+        "deferred": CLICK_QUEUE.report()["deferred"],
+    }
+
+
+# A setup wizard whose "Next >" button keeps its window and title from page
+# to page, clicked through by the button clicker with a tick a virtual
+# second. Returns the page it got to and when.
+def benchmark_wizard(pages=5, duration=120):
+    desktop = FakeDesktop()
+    dialog = desktop.add_window("#32770", "Setup Wizard")
+    label = desktop.add_window("Static", "Page 1", dialog)
+    state = {"page": 1, "finished": None}
+
+    def next_page():
+        state["page"] += 1
+        desktop.set_title(label, "Page %d" % state["page"])
+        if state["page"] == pages:
+            desktop.remove_window(dialog)
+            state["finished"] = desktop.time()
+
+    desktop.add_window("Button", "&Next >", dialog, on_click=next_page)
+    previous = use_backend(desktop)
+    try:
+        tracker = WindowTracker(desktop)
+        BUTTON_CLICKER.reset()
+        CLICK_QUEUE.reset()
+        while desktop.time() < duration and state["finished"] is None:
+            click_buttons(*tracker.update())
+            CLICK_QUEUE.drain()
+            desktop.sleep(1)
+    finally:
+        use_backend(previous)
+
+    return {
+        "pages": pages,
+        "reached": state["page"],
+        "virtual": state["finished"],
+    }
+
+
+# Points planned per second, in batches of "targets" paths, and the replay
+# timing error in milliseconds.
+def benchmark_mouse(targets=1000, rounds=5, replays=5, seed=0):
+    mover = MouseMover(seed=seed)
+    rng = random.Random(seed)
+    points, started = 0, time.time()
+    for _ in range(rounds):
+        paths = mover.plan((0, 0), [
+            (rng.randint(0, 1023), rng.randint(0, 767)) for _ in range(targets)
+        ], (1024, 768))
+        points += sum(len(path) for path in paths)
+    generation = time.time() - started
+
+    desktop = RealTimeDesktop()
+    previous = use_backend(desktop)
+    errors = []
+    try:
+        for _ in range(replays):
+            errors.extend(mover.move_to(rng.randint(0, 1023), rng.randint(0, 767)))
+    finally:
+        use_backend(previous)
+
+    errors = sorted(error * 1000 for error in errors)
+    return {
+        "points": points,
+        "points_per_second": points / max(generation, 1e-9),
+        "replay_batches": len(errors),
+        "replay_error_mean": sum(errors) / max(len(errors), 1),
+        "replay_error_p95": errors[int(len(errors) * 0.95)] if errors else 0.0,
+        "replay_error_max": errors[-1] if errors else 0.0,
+    }
+
+
+# Compare the matcher against the previous per-callback nested substring
+# scan, over synthetic button labels that are seen again on every tick.
+# Returns the timings in seconds.
+def benchmark_button_matcher(windows=500, ticks=20, seed=0):
+    rng = random.Random(seed)
+    words = ["setup", "wizard", "the", "program", "cancel", "back", "help",
+             "details", "options", "accept", "more", "now"]
+    keywords, dontclick = [], []
+    for pack in BUTTON_KEYWORDS.values():
+        keywords.extend(pack["click"])
+        dontclick.extend(pack["dontclick"])
+
+    labels = []
+    for hwnd in range(windows):
+        label = " ".join(rng.choice(words) for _ in range(rng.randint(1, 4)))
+        if rng.random() < 0.3:
+            label = "&" + rng.choice(keywords).capitalize() + " " + label
+        labels.append((hwnd, "Button", label))
+
+    def scan(text):
+        # The lists used to be rebuilt and fully scanned on every callback.
+        buttons, dont = list(keywords), list(dontclick)
+        textval = text.replace("&", "").lower()
+        clicks = 0
+        for button in buttons:
+            if button in textval:
+                for btn in dont:
+                    if btn in textval:
+                        break
+                else:
+                    clicks += 1
+        return clicks
+
+    matcher = ButtonMatcher()
+    results = {"windows": windows, "ticks": ticks}
+
+    started = time.time()
+    for _ in range(ticks):
+        for hwnd, classname, text in labels:
+            scan(text)
+    results["scan"] = time.time() - started
+
+    started = time.time()
+    for _ in range(ticks):
+        for hwnd, classname, text in labels:
+            matcher.should_click(hwnd, classname, text)
+    results["matcher"] = time.time() - started
+    results["speedup"] = results["scan"] / max(results["matcher"], 1e-9)
+    return results
+
+
+def run_benchmarks():
+    return {
+        "mouse": benchmark_mouse(),
+        "governor": benchmark_governor(),
+        "planner": benchmark_planner(),
+        "visual": benchmark_visual(),
+        "click_queue": benchmark_click_queue(),
+        "wizard": benchmark_wizard(),
+        "input_wait": benchmark_input_wait(),
+        "pool": benchmark_pool(),
+        "watchdog": benchmark_watchdog(),
+        "watchdog_stuck": benchmark_watchdog(stuck=True),
+        "trace": benchmark_trace(),
+        "replay": benchmark_replay(),
+        "scenarios": benchmark_scenarios(),
+        "steps": benchmark_steps(),
+        "import": benchmark_import(),
+        "enumeration": benchmark_enumeration(),
+        "button_matcher": benchmark_button_matcher(),
+        "process_lookup": benchmark_process_lookup(),
+        "scheduler": benchmark_scheduler(),
+        "human": benchmark_human(),
+        "interaction": benchmark_interaction(),
+        "typing": benchmark_typing(),
+    }
+
+
+if __name__ == "__main__":
+    print(json.dumps(run_benchmarks(), indent=2, sort_keys=True))